@@ -5,6 +5,15 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Expiration time of cached permissions in seconds.
+PERMISSION_CACHE_TTL = int(os.getenv('PERMISSION_CACHE_TTL', '600'))
+
+# Expiration time of cached attribute schemas in seconds.
+ATTRIBUTE_SCHEMA_CACHE_TTL = int(os.getenv('ATTRIBUTE_SCHEMA_CACHE_TTL', '3600'))
+
+# Maximum expiration time of cached presigned urls in seconds.
+PRESIGN_CACHE_TTL = int(os.getenv('PRESIGN_CACHE_TTL', '3600'))
+
 class TatorCache:
     """Interface for caching responses.
     """
@@ -36,6 +45,158 @@ class TatorCache:
         group = f'creds_{project_id}'
         self.rds.delete(group)
 
+    def get_permission_cache(self, user_id, project_id):
+        """ Returns the cached membership permission value of a user in a project, an empty
+            string if the user is cached as a non-member, or None on a cache miss.
+        """
+        val = self.rds.hget(f'perm_{project_id}', user_id)
+        if val is not None:
+            val = val.decode()
+        return val
+
+    def set_permission_cache(self, user_id, project_id, val):
+        """ Stores a membership permission value. Use an empty string for non-members.
+            Permissions of a project are kept in one hash so they can be invalidated
+            together, see `invalidate_project_cache`. The expiration is only set when the
+            hash is created, so entries never outlive it by more than `PERMISSION_CACHE_TTL`.
+        """
+        group = f'perm_{project_id}'
+        pipe = self.rds.pipeline()
+        pipe.hset(group, user_id, val)
+        pipe.ttl(group)
+        _, ttl = pipe.execute()
+        if ttl == -1:
+            self.rds.expire(group, PERMISSION_CACHE_TTL)
+
+    def invalidate_permission_cache(self, user_id, project_id):
+        """ Invalidates cached permissions for a user in a project, including the
+            credential cache used for media file authorization.
+        """
+        self.rds.hdel(f'perm_{project_id}', user_id)
+        self.rds.hdel(f'creds_{project_id}', f'creds_{project_id}_{user_id}')
+
+    def invalidate_project_cache(self, project_id):
+        """ Invalidates cached permissions of all users in a project and cached
+            object-to-project lookups pointing at it.
+        """
+        keys = [key.decode() for key in self.rds.smembers(f'project_objects_{project_id}')]
+        self.rds.delete(f'perm_{project_id}', f'creds_{project_id}',
+                        f'project_objects_{project_id}', *keys)
+
+    def get_project_cache(self, model, pk):
+        """ Returns the cached project ID of an object, or None on a cache miss.
+        """
+        val = self.rds.get(f'project_of_{model}_{pk}')
+        if val is not None:
+            val = int(val)
+        return val
+
+    def set_project_cache(self, model, pk, project_id):
+        """ Stores the project ID of an object. The project of an object never changes, so
+            this only expires to bound memory usage. The key is also tracked per project so
+            it is removed when the project is changed or deleted.
+        """
+        key = f'project_of_{model}_{pk}'
+        pipe = self.rds.pipeline()
+        pipe.set(key, project_id, ex=PERMISSION_CACHE_TTL)
+        pipe.sadd(f'project_objects_{project_id}', key)
+        pipe.expire(f'project_objects_{project_id}', PERMISSION_CACHE_TTL)
+        pipe.execute()
+
+    def get_presigned_urls(self, bucket_name, expiration, paths):
+        """ Returns cached presigned urls for a list of paths, with None for cache misses.
+        """
+        if not paths:
+            return []
+        keys = [f'presign_{bucket_name}_{expiration}_{path}' for path in paths]
+        return [None if val is None else val.decode() for val in self.rds.mget(keys)]
+
+    def set_presigned_urls(self, bucket_name, expiration, urls, ttl):
+        """ Caches presigned urls given as a mapping from path to url. The ttl should be a
+            fraction of the expiration so that cached urls remain valid for most of it.
+        """
+        pipe = self.rds.pipeline(transaction=False)
+        for path, url in urls.items():
+            pipe.set(f'presign_{bucket_name}_{expiration}_{path}', url, ex=ttl)
+        pipe.execute()
+
+    def push_index_outbox(self, prefix, members):
+        """ Adds documents to the search index outbox of an index prefix. Members already in
+            the outbox are coalesced.
+        """
+        if members:
+            self.rds.sadd(f'{prefix}index_outbox', *members)
+
+    def pop_index_outbox(self, prefix, count):
+        """ Atomically removes and returns up to `count` members of the search index outbox.
+        """
+        return [member.decode() for member in self.rds.spop(f'{prefix}index_outbox', count)]
+
+    def push_index_failed(self, prefix, members):
+        """ Records documents that were rejected by the search index, so they are kept for
+            inspection instead of being retried by every flush.
+        """
+        if members:
+            self.rds.sadd(f'{prefix}index_outbox_failed', *members)
+
+    def retry_index_failed(self, prefix):
+        """ Moves rejected documents back to the search index outbox. Returns the number of
+            documents moved.
+        """
+        members = self.rds.smembers(f'{prefix}index_outbox_failed')
+        if members:
+            pipe = self.rds.pipeline()
+            pipe.sadd(f'{prefix}index_outbox', *members)
+            pipe.srem(f'{prefix}index_outbox_failed', *members)
+            pipe.execute()
+        return len(members)
+
+    def get_reindex_ranges(self, project_id, section):
+        """ Returns the ID ranges of a reindex checkpoint and the ranges that were completed,
+            or (None, set()) if there is no checkpoint.
+        """
+        ranges = self.rds.get(f'reindex_ranges_{project_id}_{section}')
+        if ranges is None:
+            return None, set()
+        ranges = [tuple(id_range) for id_range in json.loads(ranges)]
+        done = {tuple(json.loads(id_range))
+                for id_range in self.rds.smembers(f'reindex_done_{project_id}_{section}')}
+        return ranges, done
+
+    def set_reindex_ranges(self, project_id, section, ranges):
+        self.rds.set(f'reindex_ranges_{project_id}_{section}', json.dumps(ranges))
+
+    def add_reindex_done(self, project_id, section, id_range):
+        self.rds.sadd(f'reindex_done_{project_id}_{section}', json.dumps(id_range))
+
+    def clear_reindex_ranges(self, project_id, section):
+        self.rds.delete(f'reindex_ranges_{project_id}_{section}',
+                        f'reindex_done_{project_id}_{section}')
+
+    def get_attribute_schema(self, project_id):
+        """ Returns the cached attribute schema of a project, or None on a cache miss.
+        """
+        val = self.rds.get(f'attrs_{project_id}')
+        if val is not None:
+            val = json.loads(val)
+        return val
+
+    def set_attribute_schema(self, project_id, schema):
+        self.rds.set(f'attrs_{project_id}', json.dumps(schema), ex=ATTRIBUTE_SCHEMA_CACHE_TTL)
+
+    def invalidate_attribute_schema(self, project_id):
+        self.rds.delete(f'attrs_{project_id}')
+
+    def lock(self, name, timeout, blocking_timeout=None):
+        """ Returns a redis lock shared by all workers. It is released automatically after
+            `timeout` seconds, and acquiring it waits up to `blocking_timeout` seconds
+            (defaults to `timeout`). Use a timeout longer than the work done while holding
+            the lock, otherwise it may expire first and releasing it raises LockError.
+        """
+        if blocking_timeout is None:
+            blocking_timeout = timeout
+        return self.rds.lock(f'lock_{name}', timeout=timeout, blocking_timeout=blocking_timeout)
+
     def set_job(self, job):
         """ Stores a job for cancellation or authentication. Job is a dict including
             uid, gid, user id, project id, algorithm id (-1 if not an algorithm), 
@@ -102,7 +263,8 @@ class TatorCache:
     def invalidate_all(self):
         """Invalidates all caches.
         """
-        for prefix in ['creds_']:
+        for prefix in ['creds_', 'perm_', 'project_of_', 'project_objects_', 'presign_',
+                       'attrs_']:
             for key in self.rds.scan_iter(match=prefix + '*'):
                 logger.info(f"Deleting cache key {key}...")
                 self.rds.delete(key)
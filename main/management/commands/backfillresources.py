@@ -0,0 +1,35 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from main.models import Resource
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Records size, ETag and storage class of resources that do not have them yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', type=int, default=None,
+                            help="Only backfill resources of media in this project.")
+        parser.add_argument('--batch_size', type=int, default=1000)
+
+    def handle(self, **options):
+        resources = Resource.objects.filter(Q(size__isnull=True) | Q(size__lt=0))
+        if options['project'] is not None:
+            resources = resources.filter(media__project=options['project']).distinct()
+        resources = resources.order_by('id')
+        num_updated = 0
+        last_id = 0
+        while True:
+            # Objects that still cannot be found keep a null or negative size, so iterate by
+            # ID to visit each resource once.
+            ids = list(resources.filter(id__gt=last_id)
+                       .values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            last_id = ids[-1]
+            num_updated += Resource.backfill_object_info(Resource.objects.filter(pk__in=ids),
+                                                          retry_missing=True)
+            logger.info(f"Backfilled object info for {num_updated} resources...")
+        logger.info(f"Backfilled object info for {num_updated} resources total.")
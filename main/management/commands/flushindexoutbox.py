@@ -0,0 +1,37 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from main.cache import TatorCache
+from main.search import TatorSearch
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Indexes documents queued in the search index outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help="If given, keep flushing every `interval` seconds.")
+        parser.add_argument('--retry_failed', action='store_true',
+                            help="Queue documents that were rejected by a previous flush again.")
+
+    def handle(self, **options):
+        if options['retry_failed']:
+            count = TatorCache().retry_index_failed(TatorSearch().prefix)
+            logger.info(f"Queued {count} previously rejected documents again.")
+        while True:
+            if options['interval'] is None:
+                count = TatorSearch().flush_outbox()
+            else:
+                # Failed batches are put back in the outbox, so keep running and retry them.
+                try:
+                    count = TatorSearch().flush_outbox()
+                except Exception:
+                    logger.error("Failed to flush search index outbox!", exc_info=True)
+                    count = 0
+            if count:
+                logger.info(f"Indexed {count} queued documents.")
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
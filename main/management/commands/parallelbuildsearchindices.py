@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from main.util import parallelBuildSearchIndices
+
+class Command(BaseCommand):
+    help = 'Builds search documents for a project section with a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('project_id', type=int)
+        parser.add_argument('section', type=str)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--max_age_days', type=int, default=None)
+        parser.add_argument('--restart', action='store_true',
+                            help="Discard checkpoints of a previous interrupted run.")
+
+    def handle(self, **options):
+        parallelBuildSearchIndices(options['project_id'], options['section'], options['workers'],
+                                   options['max_age_days'], options['restart'])
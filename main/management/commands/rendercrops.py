@@ -0,0 +1,48 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from main.models import Localization
+from main.rest.localization_graphic import parse_force_scale, render_crops
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Renders and caches localization graphics so galleries are served from the cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', type=int, required=True)
+        parser.add_argument('--ids', type=int, nargs='+', default=None,
+                            help="Only render these localizations.")
+        parser.add_argument('--type', type=int, default=None,
+                            help="Only render localizations of this type.")
+        parser.add_argument('--margin_x', type=int, default=None,
+                            help="Pixel margin, uses default margins if not given.")
+        parser.add_argument('--margin_y', type=int, default=None,
+                            help="Pixel margin, uses default margins if not given.")
+        parser.add_argument('--force_scale', type=str, default=None,
+                            help="Size of rendered graphics, for example 100x100.")
+        parser.add_argument('--image_format', type=str, default='png', choices=['png', 'jpg'])
+        parser.add_argument('--batch_size', type=int, default=500)
+
+    def handle(self, **options):
+        qs = Localization.objects.filter(project=options['project'], deleted=False)
+        if options['ids'] is not None:
+            qs = qs.filter(pk__in=options['ids'])
+        if options['type'] is not None:
+            qs = qs.filter(meta=options['type'])
+        params = {
+            'use_default_margins': options['margin_x'] is None and options['margin_y'] is None,
+            'margin_x': options['margin_x'] or 0,
+            'margin_y': options['margin_y'] or 0,
+        }
+        force_scale = parse_force_scale(options['force_scale'])
+
+        # Order by media so each batch is rendered in as few passes as possible.
+        ids = list(qs.order_by('media', 'frame', 'id').values_list('id', flat=True))
+        num_rendered = 0
+        for idx in range(0, len(ids), options['batch_size']):
+            batch = Localization.objects.filter(pk__in=ids[idx:idx+options['batch_size']])
+            batch = list(batch.select_related('meta', 'media', 'project'))
+            render_crops(batch, params, force_scale, options['image_format'])
+            num_rendered += len(batch)
+            logger.info(f"Rendered graphics for {num_rendered}/{len(ids)} localizations...")
@@ -24,14 +24,17 @@ from django.contrib.gis.db.models import EmailField
 from django.contrib.gis.db.models import PROTECT
 from django.contrib.gis.db.models import CASCADE
 from django.contrib.gis.db.models import SET_NULL
+from django.contrib.gis.db.models import Index
 from django.contrib.gis.geos import Point
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.models import UserManager
 from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
 from django.core.validators import MinValueValidator
 from django.core.validators import RegexValidator
 from django.db.models import FloatField, Transform,UUIDField
+from django.db.models import Q
 from django.db.models.signals import post_save
 from django.db.models.signals import pre_delete
 from django.db.models.signals import post_delete
@@ -43,10 +46,12 @@ from enumfields import Enum
 from enumfields import EnumField
 from django_ltree.fields import PathField
 from django.db import transaction
+from botocore.errorfactory import ClientError
 
 from .search import TatorSearch
+from .cache import TatorCache
 from .download import download_file
-from .store import get_tator_store, ObjectStore, get_storage_lookup
+from .store import get_tator_store, ObjectStore, get_storage_lookup, invalidate_tator_store
 from .cognito import TatorCognito
 
 from collections import UserDict
@@ -447,6 +452,14 @@ class Bucket(Model):
             storage_type,
         )
 
+@receiver(post_save, sender=Bucket)
+def bucket_save(sender, instance, **kwargs):
+    invalidate_tator_store(instance.pk)
+
+@receiver(post_delete, sender=Bucket)
+def bucket_delete(sender, instance, **kwargs):
+    invalidate_tator_store(instance.pk)
+
 
 class Project(Model):
     name = CharField(max_length=128)
@@ -518,6 +531,14 @@ class Version(Model):
             out += f" | {self.description}"
         return out
 
+def invalidate_attribute_schema(project_id):
+    """ Invalidates the cached attribute schema of a project, see
+        `rest._attribute_query.get_attribute_schema`. Invalidation is repeated on commit so
+        that a schema cached from uncommitted entity types is discarded.
+    """
+    TatorCache().invalidate_attribute_schema(project_id)
+    transaction.on_commit(lambda: TatorCache().invalidate_attribute_schema(project_id))
+
 def make_default_version(instance):
     return Version.objects.create(
         name="Baseline",
@@ -529,6 +550,7 @@ def make_default_version(instance):
 
 @receiver(post_save, sender=Project)
 def project_save(sender, instance, created, **kwargs):
+    TatorCache().invalidate_project_cache(instance.pk)
     TatorSearch().create_index(instance.pk)
     if created:
         make_default_version(instance)
@@ -537,6 +559,7 @@ def project_save(sender, instance, created, **kwargs):
 
 @receiver(post_delete, sender=Project)
 def project_delete(sender, instance, **kwargs):
+    TatorCache().invalidate_project_cache(instance.pk)
     if instance.thumb:
         safe_delete(instance.thumb)
 
@@ -554,6 +577,14 @@ class Membership(Model):
     def __str__(self):
         return f'{self.user} | {self.permission} | {self.project}'
 
+@receiver(post_save, sender=Membership)
+def membership_save(sender, instance, **kwargs):
+    TatorCache().invalidate_permission_cache(instance.user_id, instance.project_id)
+
+@receiver(post_delete, sender=Membership)
+def membership_delete(sender, instance, **kwargs):
+    TatorCache().invalidate_permission_cache(instance.user_id, instance.project_id)
+
 def getVideoDefinition(path, codec, resolution, **kwargs):
     """ Convenience function to generate video definiton dictionary """
     obj = {"path": path,
@@ -619,6 +650,8 @@ class TemporaryFile(Model):
     """ Time that the file was created """
     eol_datetime = DateTimeField()
     """ Time the file expires (reaches EoL) """
+    segment_info = JSONField(null=True, blank=True)
+    """ Start and end frames of the segments making up a clip, used to serve cached clips """
 
     def expire(self):
         """ Set a given temporary file as expired """
@@ -627,8 +660,10 @@ class TemporaryFile(Model):
         self.eol_datetime = past
         self.save()
 
-    def from_local(path, name, project, user, lookup, hours, is_upload=False):
-        """ Given a local file create a temporary file storage object
+    def from_local(path, name, project, user, lookup, hours, is_upload=False, segment_info=None,
+                   move=False):
+        """ Given a local file create a temporary file storage object. If move is true the
+            local file is moved instead of copied.
         :returns A saved TemporaryFile:
         """
         extension = os.path.splitext(name)[-1]
@@ -636,6 +671,8 @@ class TemporaryFile(Model):
         os.makedirs(os.path.dirname(destination_fp), exist_ok=True)
         if is_upload:
             download_file(path, destination_fp)
+        elif move:
+            shutil.move(path, destination_fp)
         else:
             shutil.copyfile(path, destination_fp)
 
@@ -648,7 +685,8 @@ class TemporaryFile(Model):
                                   path=destination_fp,
                                   lookup=lookup,
                                   created_datetime=now,
-                                  eol_datetime = eol)
+                                  eol_datetime = eol,
+                                  segment_info=segment_info)
         temp_file.save()
         return temp_file
 
@@ -729,6 +767,11 @@ class MediaType(Model):
 @receiver(post_save, sender=MediaType)
 def media_type_save(sender, instance, **kwargs):
     TatorSearch().create_mapping(instance)
+    invalidate_attribute_schema(instance.project_id)
+
+@receiver(post_delete, sender=MediaType)
+def media_type_delete(sender, instance, **kwargs):
+    invalidate_attribute_schema(instance.project_id)
 
 class LocalizationType(Model):
     dtype = CharField(max_length=16,
@@ -776,6 +819,11 @@ class LocalizationType(Model):
 @receiver(post_save, sender=LocalizationType)
 def localization_type_save(sender, instance, **kwargs):
     TatorSearch().create_mapping(instance)
+    invalidate_attribute_schema(instance.project_id)
+
+@receiver(post_delete, sender=LocalizationType)
+def localization_type_delete(sender, instance, **kwargs):
+    invalidate_attribute_schema(instance.project_id)
 
 class StateType(Model):
     dtype = CharField(max_length=16, choices=[('state', 'state')], default='state')
@@ -833,6 +881,11 @@ class StateType(Model):
 @receiver(post_save, sender=StateType)
 def state_type_save(sender, instance, **kwargs):
     TatorSearch().create_mapping(instance)
+    invalidate_attribute_schema(instance.project_id)
+
+@receiver(post_delete, sender=StateType)
+def state_type_delete(sender, instance, **kwargs):
+    invalidate_attribute_schema(instance.project_id)
 
 class LeafType(Model):
     dtype = CharField(max_length=16, choices=[('leaf', 'leaf')], default='leaf')
@@ -872,6 +925,11 @@ class LeafType(Model):
 @receiver(post_save, sender=LeafType)
 def leaf_type_save(sender, instance, **kwargs):
     TatorSearch().create_mapping(instance)
+    invalidate_attribute_schema(instance.project_id)
+
+@receiver(post_delete, sender=LeafType)
+def leaf_type_delete(sender, instance, **kwargs):
+    invalidate_attribute_schema(instance.project_id)
 
 
 # Entities (stores actual data)
@@ -983,48 +1041,138 @@ class Media(Model, ModelDiffMixin):
         Project, on_delete=SET_NULL, null=True, blank=True, related_name='recycled_from'
     )
 
-    def get_file_sizes(self):
+    def get_file_sizes(self, resource_sizes=None):
         """ Returns total size and download size for this media object.
+
+        :param resource_sizes: [Optional] Mapping from path to size as returned by
+                               `Resource.get_sizes`. Pass this in when computing sizes for many
+                               media at once to avoid a query per media.
         """
         total_size = 0
         download_size = None
         if not self.media_files:
             return (total_size, download_size)
 
-        resources = Resource.objects.filter(media__in=[self])
-        store_lookup = get_storage_lookup(resources)
-        store_default = get_tator_store(self.project.bucket)
+        if resource_sizes is None:
+            resource_sizes = Resource.get_sizes([self.pk])
+        store_default = None
+        store_lookup = None
+
+        def _get_size(path):
+            nonlocal store_default, store_lookup
+            if path not in resource_sizes:
+                # Paths without a resource use the default project bucket.
+                if store_default is None:
+                    store_default = get_tator_store(self.project.bucket)
+                size = store_default.get_size(path)
+            else:
+                size = resource_sizes[path]
+                if size is None:
+                    # The object info of this resource could not be retrieved, retry in its
+                    # own bucket and record the result.
+                    if store_lookup is None:
+                        store_lookup = get_storage_lookup(Resource.objects.filter(media=self.pk))
+                    size = store_lookup[path].get_size(path)
+                    Resource.objects.filter(media=self.pk, path=path).update(size=size)
+                    resource_sizes[path] = size
+            # Missing objects are recorded with a negative size and do not count towards totals.
+            return max(size, 0)
 
         for key in ["archival", "streaming", "image", "audio", "thumbnail", "thumbnail_gif", "attachment"]:
             if key not in self.media_files:
                 continue
 
             for media_def in self.media_files[key]:
-                tator_store = store_lookup.get(media_def["path"], store_default)
-                size = tator_store.get_size(media_def["path"])
+                size = _get_size(media_def["path"])
                 total_size += size
                 if key in ["archival", "streaming", "image"] and download_size is None:
                     download_size = size
                 if key == "streaming":
-                    total_size += tator_store.get_size(media_def.get('segment_info'))
+                    total_size += _get_size(media_def.get('segment_info'))
         return (total_size, download_size)
 
 class Resource(Model):
     path = CharField(db_index=True, max_length=256)
     media = ManyToManyField(Media, related_name='resource_media')
     bucket = ForeignKey(Bucket, on_delete=PROTECT, null=True, blank=True)
+    size = BigIntegerField(null=True, blank=True)
+    """ Size of the object in bytes. Null if not yet retrieved from the object store and -1 if
+        the object could not be found.
+    """
+    etag = CharField(max_length=128, null=True, blank=True)
+    storage_class = CharField(max_length=32, null=True, blank=True)
+
+    def update_object_info(self, tator_store=None):
+        """ Retrieves size, ETag and storage class from the object store. The resource is not
+            saved. If the object does not exist the size is set to -1. If it cannot be retrieved
+            for another reason the size is left unchanged so that it is retried by the next
+            backfill.
+        """
+        if tator_store is None:
+            tator_store = get_tator_store(self.bucket)
+        try:
+            response = tator_store.head_object(self.path)
+        except (ValueError, ClientError):
+            logger.warning(f"Could not find object {self.path}!")
+            self.size = -1
+        except Exception:
+            logger.warning(f"Could not retrieve info for object {self.path}!", exc_info=True)
+        else:
+            self.size = response["ContentLength"]
+            self.etag = response.get("ETag")
+            self.storage_class = response.get("StorageClass")
+
+    def backfill_object_info(resources, retry_missing=False):
+        """ Retrieves object info for resources in a queryset that do not have a size yet and
+            saves it. Returns the number of resources updated.
+
+            :param retry_missing: Also retry resources whose object could not be found.
+        """
+        filters = Q(size__isnull=True)
+        if retry_missing:
+            filters |= Q(size__lt=0)
+        resources = list(resources.filter(filters))
+        if not resources:
+            return 0
+        buckets = {resource.bucket_id for resource in resources}
+        bucket_objs = Bucket.objects.in_bulk([bucket for bucket in buckets if bucket])
+        updated = []
+        for resource in resources:
+            size = resource.size
+            bucket = bucket_objs.get(resource.bucket_id)
+            resource.update_object_info(get_tator_store(bucket))
+            if resource.size is not None and resource.size != size:
+                updated.append(resource)
+        Resource.objects.bulk_update(updated, ['size', 'etag', 'storage_class'])
+        return len(updated)
+
+    def get_sizes(media_ids):
+        """ Returns a mapping from path to size for all resources of the given media. Sizes that
+            have not been recorded yet are retrieved from the object store and saved.
+        """
+        resources = Resource.objects.filter(media__in=media_ids)
+        Resource.backfill_object_info(resources)
+        return dict(resources.values_list('path', 'size').distinct())
 
-    @transaction.atomic
     def add_resource(path_or_link, media):
         if os.path.islink(path_or_link):
             path = os.readlink(path_or_link)
         else:
             path = path_or_link
-        if media is None:
-            obj, created = Resource.objects.get_or_create(path=path, bucket=None)
-        else:
-            obj, created = Resource.objects.get_or_create(path=path, bucket=media.project.bucket)
-            obj.media.add(media)
+        with transaction.atomic():
+            if media is None:
+                obj, created = Resource.objects.get_or_create(path=path, bucket=None)
+            else:
+                obj, created = Resource.objects.get_or_create(path=path,
+                                                              bucket=media.project.bucket)
+                obj.media.add(media)
+        # Object info is retrieved outside of the transaction to avoid holding it open during
+        # a request to the object store.
+        if obj.size is None:
+            obj.update_object_info()
+            if obj.size is not None:
+                Resource.objects.filter(pk=obj.pk).update(size=obj.size, etag=obj.etag,
+                                                          storage_class=obj.storage_class)
 
     @transaction.atomic
     def delete_resource(path_or_link):
@@ -1100,7 +1248,7 @@ class Resource(Model):
 
 @receiver(post_save, sender=Media)
 def media_save(sender, instance, created, **kwargs):
-    TatorSearch().create_document(instance)
+    TatorSearch().queue_document(instance)
     if instance.media_files and created:
         for key in ['streaming', 'archival', 'audio', 'image', 'thumbnail', 'thumbnail_gif', 'attachment']:
             for fp in instance.media_files.get(key, []):
@@ -1197,7 +1345,7 @@ class Localization(Model, ModelDiffMixin):
 @receiver(post_save, sender=Localization)
 def localization_save(sender, instance, created, **kwargs):
     if getattr(instance,'_inhibit', False) == False:
-        TatorSearch().create_document(instance)
+        TatorSearch().queue_document(instance)
     else:
         pass
 
@@ -1251,7 +1399,7 @@ class State(Model, ModelDiffMixin):
 
 @receiver(post_save, sender=State)
 def state_save(sender, instance, created, **kwargs):
-    TatorSearch().create_document(instance)
+    TatorSearch().queue_document(instance)
 
 @receiver(pre_delete, sender=State)
 def state_delete(sender, instance, **kwargs):
@@ -1312,6 +1460,9 @@ class Leaf(Model, ModelDiffMixin):
         return str(self.path)
 
     def depth(self):
+        # Use the depth annotation if the leaf was loaded with one.
+        if hasattr(self, 'path_depth'):
+            return self.path_depth
         return Leaf.objects.annotate(depth=Depth('path')).get(pk=self.pk).depth
 
     def subcategories(self, minLevel=1):
@@ -1332,7 +1483,7 @@ class Leaf(Model, ModelDiffMixin):
 
 @receiver(post_save, sender=Leaf)
 def leaf_save(sender, instance, **kwargs):
-    TatorSearch().create_document(instance)
+    TatorSearch().queue_document(instance)
 
 @receiver(pre_delete, sender=Leaf)
 def leaf_delete(sender, instance, **kwargs):
@@ -1417,8 +1568,25 @@ class ChangeLog(Model):
         value: 52
       }]
     }
+    For a bulk change, only the changes shared by all objects are stored here.
+    """
+    ref_table = ForeignKey(ContentType, on_delete=SET_NULL, null=True, blank=True)
+    """ The model of the objects changed by a bulk change """
+    ref_ids = ArrayField(PositiveIntegerField(), null=True, blank=True)
+    """ The ids of the objects changed by a bulk change, null for other changes """
+    ref_changes = JSONField(null=True, blank=True)
+    """
+    The remaining changes of each object of a bulk change, aligned with `ref_ids`. Each element
+    has the same format as `description_of_change`.
     """
 
+    class Meta:
+        indexes = [
+            GinIndex(fields=['ref_ids']),
+            Index(fields=['project', 'modified_datetime', 'id']),
+            Index(fields=['user', 'modified_datetime', 'id']),
+        ]
+
 class ChangeToObject(Model):
     """ Association table that correlates a ChangeLog object to one or more objects """
     ref_table = ForeignKey(ContentType, on_delete=SET_NULL, null=True)
@@ -1428,6 +1596,12 @@ class ChangeToObject(Model):
     change_id = ForeignKey(ChangeLog, on_delete=SET_NULL, null=True)
     """ The change that affected the object """
 
+    class Meta:
+        indexes = [
+            Index(fields=['ref_id', 'ref_table', 'change_id']),
+            Index(fields=['ref_table', 'ref_id']),
+        ]
+
 class Announcement(Model):
     """ Message that may be displayed to users.
     """
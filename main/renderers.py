@@ -1,7 +1,9 @@
 from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
 
 import csv
 import io
+import json
 import ujson
 import logging
 
@@ -44,6 +46,47 @@ class CsvRenderer(BaseRenderer):
         finally:
             return return_value
 
+def _flatten(entry):
+    row = {}
+    for field, value in entry.items():
+        if type(value) in [OrderedDict, dict]:
+            row.update(value)
+        else:
+            row[field] = value
+    return row
+
+def stream_csv(rows, field_names, buffer_size=65536):
+    """ Renders an iterable of objects as CSV, flattening them like CsvRenderer. Rows are
+        written as they arrive and yielded in chunks of about `buffer_size` characters.
+    """
+    temp_file = io.StringIO()
+    writer = csv.DictWriter(temp_file, fieldnames=field_names, extrasaction='ignore')
+    writer.writeheader()
+    for entry in rows:
+        writer.writerow(_flatten(entry))
+        if temp_file.tell() >= buffer_size:
+            yield temp_file.getvalue()
+            temp_file.seek(0)
+            temp_file.truncate()
+    yield temp_file.getvalue()
+
+def stream_json(rows, buffer_size=65536):
+    """ Renders an iterable of objects as a JSON array. Objects are encoded as they arrive
+        and yielded in chunks of about `buffer_size` characters.
+    """
+    chunk = ['[']
+    size = 0
+    for idx, entry in enumerate(rows):
+        text = json.dumps(entry, cls=JSONEncoder)
+        chunk.append(f',{text}' if idx else text)
+        size += len(text)
+        if size >= buffer_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(']')
+    yield ''.join(chunk)
+
 class PprintRenderer(BaseRenderer):
     """ renders an object (list of objects) to a CSV file """
     media_type = 'application/json'
@@ -25,6 +25,7 @@ from .file import FileListAPI
 from .file import FileDetailAPI
 from .get_clip import GetClipAPI
 from .get_frame import GetFrameAPI
+from .frame_extraction import FrameExtractionAPI
 from .image_file import ImageFileListAPI
 from .image_file import ImageFileDetailAPI
 from .invitation import InvitationListAPI
@@ -45,6 +46,7 @@ from .localization_count import LocalizationCountAPI
 from .localization_type import LocalizationTypeListAPI
 from .localization_type import LocalizationTypeDetailAPI
 from .localization_graphic import LocalizationGraphicAPI
+from .localization_graphic import LocalizationGraphicListAPI
 from .media import MediaListAPI
 from .media import MediaDetailAPI
 from .media_count import MediaCountAPI
@@ -251,17 +251,19 @@ def get_annotation_count(project, params, annotation_type):
     if use_es:
         # If using ES, do the search and get the count.
         query = get_annotation_es_query(project, params, annotation_type)
-        annotation_ids, _  = TatorSearch().search(project, query)
 
         # Apply excludeParents if no pagination.
         exclude_parents = params.get('excludeParents')
         if exclude_parents:
+            annotation_ids, _  = TatorSearch().search(project, query)
             qs = ANNOTATION_LOOKUP[annotation_type].objects.filter(pk__in=annotation_ids)
             parent_set = ANNOTATION_LOOKUP[annotation_type].objects.filter(pk__in=Subquery(qs.values('parent')))
             qs = qs.difference(parent_set)
             count = qs.count()
         else:
-            count = len(annotation_ids)
+            # States may be indexed once per media, so count distinct IDs.
+            count = TatorSearch().count_ids(project, query,
+                                            duplicates=(annotation_type == 'state'))
     else:
         # If using PSQL, construct the queryset.
         qs = _get_annotation_psql_queryset(project, filter_ops, params, annotation_type)
@@ -8,11 +8,42 @@ from dateutil.parser import parse as dateutil_parse
 from ..models import LocalizationType
 from ..models import StateType
 from ..search import TatorSearch
+from ..cache import TatorCache
 
 from ._attributes import KV_SEPARATOR
 
 logger = logging.getLogger(__name__)
 
+def get_attribute_schema(project):
+    """ Returns a mapping from attribute name to (relation, dtype) for a project. Relation is
+        'annotation' for attributes of localization and state types and 'media' otherwise.
+        Dtype is the elasticsearch mapping type, or None if no mapping exists. The schema is
+        cached in redis and invalidated whenever an entity type is saved.
+    """
+    schema = TatorCache().get_attribute_schema(project)
+    if schema is None:
+        child_attrs = set()
+        for state_type in StateType.objects.filter(project=project).iterator():
+            child_attrs.update(attr['name'] for attr in state_type.attribute_types or [])
+        for localization_type in LocalizationType.objects.filter(project=project).iterator():
+            child_attrs.update(attr['name'] for attr in localization_type.attribute_types or [])
+
+        index_name = TatorSearch().index_name(project)
+        mappings = TatorSearch().es.indices.get_mapping(index=index_name)
+        mappings = mappings[index_name]['mappings']['properties']
+
+        schema = {}
+        for name, mapping in mappings.items():
+            if 'path' in mapping:
+                dtype = mapping['path'].split('_', 1)[1]
+            else:
+                dtype = mapping.get('type')
+            schema[name] = ['annotation' if name in child_attrs else 'media', dtype]
+        for name in child_attrs:
+            schema.setdefault(name, ['annotation', None])
+        TatorCache().set_attribute_schema(project, schema)
+    return schema
+
 def get_attribute_es_query(query_params, query, bools, project,
                            is_media=True, annotation_bools=None, modified=None):
     """ TODO: add documentation for this """
@@ -30,12 +61,7 @@ def get_attribute_es_query(query_params, query, bools, project,
         'attribute_distance': query_params.get('attribute_distance', None),
         'attribute_null': query_params.get('attribute_null', None),
     }
-    child_attrs = []
-    for state_type in StateType.objects.filter(project=project).iterator():
-        child_attrs += state_type.attribute_types
-    for localization_type in LocalizationType.objects.filter(project=project).iterator():
-        child_attrs += localization_type.attribute_types
-    child_attrs = [attr['name'] for attr in child_attrs]
+    schema = get_attribute_schema(project)
     attr_query = {
         'media': {
             'must_not': [],
@@ -51,7 +77,7 @@ def get_attribute_es_query(query_params, query, bools, project,
             for kv_pair in attr_filter_params[o_p]:
                 if o_p == 'attribute_distance':
                     key, dist_km, lat, lon = kv_pair.split(KV_SEPARATOR)
-                    relation = 'annotation' if key in child_attrs else 'media'
+                    relation = schema.get(key, ['media'])[0]
                     attr_query[relation]['filter'].append({
                         'geo_distance': {
                             'distance': f'{dist_km}km',
@@ -60,7 +86,7 @@ def get_attribute_es_query(query_params, query, bools, project,
                     })
                 else:
                     key, val = kv_pair.split(KV_SEPARATOR)
-                    relation = 'annotation' if key in child_attrs else 'media'
+                    relation = schema.get(key, ['media'])[0]
                     if o_p == 'attribute_eq':
                         attr_query[relation]['filter'].append({'match': {key: val}})
                     elif o_p == 'attribute_lt':
@@ -200,15 +226,12 @@ def _convert_boolean(value):
         value = bool(value)
     return value
 
-def _convert_attribute_filter_value(pair, mappings, operation):
+def _convert_attribute_filter_value(pair, schema, operation):
     kv = pair.split(KV_SEPARATOR, 1)
     key, value = kv
-    if key not in mappings:
+    if (key not in schema) or (schema[key][1] is None):
         raise ValueError(f"Attribute '{key}' could not be found in project!")
-    if 'path' in mappings[key]:
-        dtype = mappings[key]['path'].split('_', 1)[1]
-    else:
-        dtype = mappings[key]['type']
+    dtype = schema[key][1]
     if dtype not in ALLOWED_TYPES[operation]:
         raise ValueError(f"Filter operation '{operation}' not allowed for dtype '{dtype}'!")
     if dtype == 'boolean':
@@ -225,15 +248,12 @@ def get_attribute_filter_ops(project, params):
     filter_ops = []
     use_es = False
     if any([(filt in params) for filt in ALLOWED_TYPES.keys()]):
-        search = TatorSearch()
-        index_name = search.index_name(project)
-        mappings = TatorSearch().es.indices.get_mapping(index=index_name)
-        mappings = mappings[index_name]['mappings']['properties']
+        schema = get_attribute_schema(project)
 
         for op in ALLOWED_TYPES.keys():
             if op in params:
                 for kv in params[op]:
-                    key, value, dtype = _convert_attribute_filter_value(kv, mappings, op)
+                    key, value, dtype = _convert_attribute_filter_value(kv, schema, op)
                     # Don't deal with type conversions required for date and geo_point filtering
                     # in PSQL
                     if (dtype in ['date', 'geo_point']) or (op == 'attribute_distance'):
@@ -1,7 +1,10 @@
 """ TODO: add documentation for this """
 from typing import List
 import logging
+import json
 
+from django.db import connection
+from django.db.models import Model
 from django.db.models.expressions import Func
 from django.contrib.gis.measure import D as GisDistance
 from django.contrib.gis.geos import Point
@@ -14,29 +17,6 @@ logger = logging.getLogger(__name__)
 KV_SEPARATOR = '::'
 
 
-class ReplaceValue(Func): #pylint: disable=abstract-method
-    """
-    Updates the value of the attribute field named `keyname` with `new_value`. See
-    https://www.postgresql.org/docs/current/functions-json.html for documentation on the function
-    template.
-    """
-    function = 'jsonb_set'
-    template = "%(function)s(%(expressions)s, '{\"%(keyname)s\"}','%(new_value)s', %(create_missing)s)" #pylint: disable=line-too-long
-    arity = 1
-
-    def __init__(
-            self, expression: str, keyname: str, new_value: str,
-            create_missing: bool = False, **extra,
-    ):
-        super().__init__(
-            expression,
-            keyname=keyname,
-            new_value=new_value,
-            create_missing='true' if create_missing else 'false',
-            **extra,
-        )
-
-
 class ReplaceKey(Func): #pylint: disable=abstract-method
     """
     Renames the attribute field named `old_key` to `new_key` and does not modify the value. See
@@ -237,32 +217,42 @@ def patch_attributes(new_attrs, obj):
     return obj
 
 
-def _process_for_bulk_op(raw_value):
+def bulk_patch_attributes(new_attrs, q_s, **fields):
     """
-    Converts a raw value into the accepted format for jsonb in PostgreSQL.
-    """
-    if isinstance(raw_value, str):
-        raw_value = raw_value.replace("\\","\\\\")
-        raw_value = raw_value.replace("\n","\\n")
-        raw_value = raw_value.replace('\"','\\"')
-        return f'"{raw_value}"'
-    if isinstance(raw_value, bool):
-        return f"{str(raw_value).lower()}"
-
-    return raw_value
-
+    Updates attribute values, and any other fields given as keyword arguments, of all objects
+    in the queryset with a single UPDATE. New values are merged into the attributes with the
+    jsonb `||` operator and the queryset is only sent to the database once, as a subquery.
 
-def bulk_patch_attributes(new_attrs, q_s):
+    :returns: IDs of the updated objects.
     """
-    Updates attribute values.
-    """
-    for key, raw_val in new_attrs.items():
-        q_s.update(attributes=ReplaceValue(
-            'attributes',
-            keyname=key,
-            new_value=_process_for_bulk_op(raw_val),
-            create_missing=True,
-        ))
+    model = q_s.model
+    pk_column = model._meta.pk.column
+    assignments = []
+    params = []
+    if new_attrs:
+        assignments.append('"attributes" = COALESCE("attributes", \'{}\'::jsonb) || %s::jsonb')
+        params.append(json.dumps(new_attrs))
+    for name, value in fields.items():
+        field = model._meta.get_field(name)
+        if field.is_relation and isinstance(value, Model):
+            value = value.pk
+        assignments.append(f'"{field.column}" = %s')
+        params.append(field.get_db_prep_save(value, connection=connection))
+    if not assignments:
+        return list(q_s.values_list('pk', flat=True))
+
+    id_query = q_s.values('pk').query.clone()
+    # Ordering decides which rows a sliced queryset (start/stop) selects, so it may only be
+    # dropped from unsliced subqueries.
+    if id_query.low_mark == 0 and id_query.high_mark is None:
+        id_query.clear_ordering(True)
+    id_query.select_for_update = False
+    id_sql, id_params = id_query.sql_with_params()
+    sql = (f'UPDATE "{model._meta.db_table}" SET {", ".join(assignments)} '
+           f'WHERE "{pk_column}" IN ({id_sql}) RETURNING "{pk_column}"')
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + list(id_params))
+        return [row[0] for row in cursor.fetchall()]
 
 
 def bulk_rename_attributes(new_attrs, q_s):
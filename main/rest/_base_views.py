@@ -8,6 +8,7 @@ from rest_framework.exceptions import PermissionDenied
 from rest_framework import status
 from django.core.exceptions import ObjectDoesNotExist
 from django.http import response
+from django.http.response import HttpResponseBase
 
 from ..schema import parse
 
@@ -45,6 +46,9 @@ class GetMixin:
         resp = Response({})
         params = parse(request)
         response_data = self._get(params)
+        if isinstance(response_data, HttpResponseBase):
+            # Streaming responses are returned as is
+            return response_data
         resp = Response(response_data, status=status.HTTP_200_OK)
         return resp
 
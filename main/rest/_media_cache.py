@@ -0,0 +1,153 @@
+""" Local disk cache of segment info and byte ranges fetched by MediaUtil. """
+import logging
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Directory holding cached files. Shared by all workers on a host.
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', '/tmp/tator_media_cache')
+
+# Maximum size of the cache directory in bytes, zero disables the cache.
+MEDIA_CACHE_SIZE = int(os.getenv('MEDIA_CACHE_SIZE', str(2 * 1024 ** 3)))
+
+# Fraction of the maximum size that eviction shrinks the cache to.
+EVICT_TARGET = 0.8
+
+# Minimum number of seconds between size checks of the cache directory, shared by all
+# workers on a host.
+EVICT_INTERVAL = float(os.getenv('MEDIA_CACHE_EVICT_INTERVAL', '60'))
+
+# File in the cache directory used to lock eviction and record when it last ran.
+EVICT_FILENAME = '.evict'
+
+class MediaCache:
+    """ LRU cache of media bytes on local disk. Entries are written atomically by
+        renaming a completed temporary file, so any number of gunicorn workers may
+        share the same directory. Recency is tracked with file modification times,
+        which are bumped on every hit. The directory size is checked by at most one
+        process per host every EVICT_INTERVAL seconds, in a background thread.
+    """
+    lock = threading.Lock()
+    last_check = 0.0
+
+    def __init__(self, cache_dir=MEDIA_CACHE_DIR, max_size=MEDIA_CACHE_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        if self.enabled:
+            os.makedirs(self._cache_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self._max_size > 0
+
+    def _filename(self, *key):
+        digest = hashlib.sha256('|'.join(str(part) for part in key).encode()).hexdigest()
+        return os.path.join(self._cache_dir, digest)
+
+    def _read(self, filename):
+        try:
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+            os.utime(filename)
+        except FileNotFoundError:
+            data = None
+        return data
+
+    def _write(self, filename, data):
+        fd, temp_name = tempfile.mkstemp(dir=self._cache_dir, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.replace(temp_name, filename)
+        except OSError:
+            logger.warning(f"Failed to write media cache file {filename}!", exc_info=True)
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            return
+        self._schedule_evict()
+
+    def _schedule_evict(self):
+        """ Starts eviction in a background thread if no process on this host has checked
+            the cache size within EVICT_INTERVAL seconds.
+        """
+        now = time.time()
+        with MediaCache.lock:
+            if now - MediaCache.last_check < EVICT_INTERVAL:
+                return
+            MediaCache.last_check = now
+        try:
+            if now - os.stat(os.path.join(self._cache_dir, EVICT_FILENAME)).st_mtime \
+               < EVICT_INTERVAL:
+                return
+        except FileNotFoundError:
+            pass
+        threading.Thread(target=self.evict, daemon=True).start()
+
+    def evict(self):
+        """ Removes least recently used files until the cache is below its target size.
+            Returns without evicting if another process is already evicting.
+        """
+        evict_filename = os.path.join(self._cache_dir, EVICT_FILENAME)
+        with open(evict_filename, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            # Record the check so other processes skip it until the interval has passed.
+            os.utime(evict_filename)
+            entries = []
+            total = 0
+            with os.scandir(self._cache_dir) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            if total <= self._max_size:
+                return
+            entries.sort()
+            target = self._max_size * EVICT_TARGET
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        logger.info(f"Evicted media cache to {total} bytes.")
+
+    def get_segment_info(self, storage, path):
+        """ Returns parsed segment info JSON at the given path.
+        """
+        if not self.enabled:
+            return json.loads(storage.get_object(path).decode('utf-8'))
+        filename = self._filename(storage.bucket_name, path)
+        data = self._read(filename)
+        if data is None:
+            data = storage.get_object(path)
+            self._write(filename, data)
+        return json.loads(data.decode('utf-8'))
+
+    def get_range(self, storage, path, offset, size):
+        """ Returns `size` bytes of the object at the given path starting at `offset`.
+        """
+        stop = offset + size - 1 # Byte range is inclusive
+        if not self.enabled:
+            return storage.get_object(path, start=offset, stop=stop)
+        filename = self._filename(storage.bucket_name, path, offset, size)
+        data = self._read(filename)
+        if data is None:
+            data = storage.get_object(path, start=offset, stop=stop)
+            self._write(filename, data)
+        return data
@@ -277,8 +277,7 @@ def get_media_count(project, params):
     if use_es:
         # If using ES, do the search and get the count.
         query = get_media_es_query(project, params)
-        media_ids, _  = TatorSearch().search(project, query)
-        count = len(media_ids)
+        count = TatorSearch().count_ids(project, query)
     else:
         # If using PSQL, construct the queryset.
         qs = _get_media_psql_queryset(project, section_uuid, filter_ops, params)
@@ -1,22 +1,88 @@
 """ TODO: add documentation for this """
 import logging
 import os
-import json
 import subprocess
 import math
 import io
 import textwrap
 import mmap
 import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from django.conf import settings
 
-from ..store import get_storage_lookup
+from ..store import get_tator_store
+from ..store import get_tator_store_generation
 from ..models import Resource
+from ._media_cache import MediaCache
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of temporary videos decoded by one ffmpeg process.
+BATCH_SIZE = 30
+
+# Size of chunks read from ffmpeg when streaming its output.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of concurrent ranged GETs issued per request.
+MEDIA_FETCH_WORKERS = int(os.getenv('MEDIA_FETCH_WORKERS', '8'))
+
+# Maximum number of media setups (storage, segment info) cached per process.
+MEDIA_SETUP_CACHE_SIZE = int(os.getenv('MEDIA_SETUP_CACHE_SIZE', '128'))
+
+# Expiration time of cached media setups in seconds.
+MEDIA_SETUP_CACHE_TTL = int(os.getenv('MEDIA_SETUP_CACHE_TTL', '300'))
+
+_setup_cache = OrderedDict()
+_setup_cache_lock = threading.Lock()
+
+def _get_media_setup(video, quality, path, segment_file):
+    """ Returns a dict with the storage of a media file and, for videos, its parsed segment
+        info and moof lookup arrays. Results are cached per process, keyed on media id,
+        quality and file path, so repeated graphics for the same media skip the resource
+        query and the segment info fetch. Entries are discarded when the storage objects of
+        their bucket are invalidated, see `invalidate_tator_store`.
+    """
+    key = (video.id, quality, path)
+    now = time.monotonic()
+    with _setup_cache_lock:
+        entry = _setup_cache.get(key)
+        if entry is not None:
+            expires, generation, setup = entry
+            if expires > now and generation == get_tator_store_generation(setup['bucket_id']):
+                _setup_cache.move_to_end(key)
+                return setup
+            del _setup_cache[key]
+
+    resource = Resource.objects.filter(media__in=[video], path=path)\
+                               .select_related('bucket').first()
+    if resource is None:
+        raise KeyError(f"Media {video.id} has no resource for {path}!")
+    generation = get_tator_store_generation(resource.bucket_id)
+    setup = {'storage': get_tator_store(resource.bucket), 'bucket_id': resource.bucket_id}
+    if segment_file is not None:
+        segment_info = MediaCache().get_segment_info(setup['storage'], segment_file)
+        moof_data = [(i,x) for i,x in enumerate(segment_info['segments']) if x['name'] == 'moof']
+        setup['segment_info'] = segment_info
+        setup['moof_data'] = moof_data
+        setup['moof_segments'] = [i for i, _ in moof_data]
+        setup['moof_starts'] = np.array([x['frame_start'] for _, x in moof_data],
+                                        dtype=np.int64)
+        setup['moof_samples'] = np.array([x['frame_samples'] for _, x in moof_data],
+                                         dtype=np.int64)
+
+    with _setup_cache_lock:
+        _setup_cache[key] = (now + MEDIA_SETUP_CACHE_TTL, generation, setup)
+        _setup_cache.move_to_end(key)
+        while len(_setup_cache) > MEDIA_SETUP_CACHE_SIZE:
+            _setup_cache.popitem(last=False)
+    return setup
+
 class MediaUtil:
     """ TODO: add documentation for this """
     def __init__(self, video, temp_dir, quality=None):
@@ -24,8 +90,7 @@ class MediaUtil:
         # If available we only attempt to fetch
         # the part of the file we need to
         self._segment_info = None
-        resources = Resource.objects.filter(media__in=[video])
-        store_lookup = get_storage_lookup(resources)
+        self._cache = MediaCache()
 
         if "streaming" in video.media_files:
             if quality is None:
@@ -41,18 +106,21 @@ class MediaUtil:
                 for idx, media_info in enumerate(video.media_files["streaming"]):
                     delta = abs(quality-media_info['resolution'][0])
                     if delta < max_delta:
+                        max_delta = delta
                         quality_idx = idx
             self._video_file = video.media_files["streaming"][quality_idx]["path"]
-            self._storage = store_lookup[self._video_file]
             self._height = video.media_files["streaming"][quality_idx]["resolution"][0]
             self._width = video.media_files["streaming"][quality_idx]["resolution"][1]
             segment_file = video.media_files["streaming"][quality_idx]["segment_info"]
-            f_p = io.BytesIO()
-            self._storage.download_fileobj(segment_file, f_p)
-            self._segment_info = json.loads(f_p.getvalue().decode('utf-8'))
-            self._moof_data = [(i,x) for i,x in enumerate(self._segment_info
-                                                          ['segments']) if x['name'] == 'moof']
+            setup = _get_media_setup(video, quality, self._video_file, segment_file)
+            self._storage = setup['storage']
+            self._segment_info = setup['segment_info']
+            self._moof_data = setup['moof_data']
+            self._moof_segments = setup['moof_segments']
+            self._moof_starts = setup['moof_starts']
+            self._moof_samples = setup['moof_samples']
         elif "image" in video.media_files:
+            quality_idx = 0
             if quality is None:
                 # Select highest quality if not specified
                 highest_res = -1
@@ -63,7 +131,7 @@ class MediaUtil:
                         quality_idx = idx
             # Image
             self._video_file = video.media_files["image"][quality_idx]["path"]
-            self._storage = store_lookup[self._video_file]
+            self._storage = _get_media_setup(video, quality, self._video_file, None)['storage']
             self._height = video.height
             self._width = video.width
         else:
@@ -71,50 +139,37 @@ class MediaUtil:
         self._fps = video.fps
 
     def _get_impacted_segments(self, frames):
-        """ TODO: add documentation for this """
+        """ Returns a list of (frame, segment indices) with the segments needed to decode
+            each frame: the header, the moof/mdat pair containing the frame and, near the
+            end of a fragment, the following pair. Frames outside of the video are
+            omitted. Fragments are looked up for all frames at once with a binary search.
+        """
         if self._segment_info is None:
             return None
 
-        segment_list = []
-        for frame_str in frames:
-            frame_seg = set()
-            frame_seg.add(0)
-            frame_seg.add(1)
-            # We already load the header so ignore those segments
-            frame = int(frame_str)
-            min_idx = 0
-            max_idx = len(self._moof_data)-1
-            # Handle frames and files with frame biases
-            if frame < self._moof_data[0][1]['frame_start']:
-                frame_seg.add(self._moof_data[0][0])
-                continue
+        if len(self._moof_starts) == 0:
+            return []
+        frames = np.asarray([int(frame) for frame in frames], dtype=np.int64)
+        moof_idx = np.searchsorted(self._moof_starts, frames, side='right') - 1
+        valid = moof_idx >= 0
+        moof_idx = np.clip(moof_idx, 0, None)
+        starts = self._moof_starts[moof_idx]
+        samples = self._moof_samples[moof_idx]
+        valid &= frames < starts + samples
+        # Handle boundary conditions
+        boundary = (frames - starts > samples - 5) & (moof_idx + 1 < len(self._moof_starts))
 
-            last_segment = self._moof_data[max_idx][1] #Frame start/stop is in the moof
-            if frame >= last_segment['frame_start'] + last_segment['frame_samples']:
+        segment_list = []
+        for frame, idx, is_valid, is_boundary in zip(frames.tolist(), moof_idx.tolist(),
+                                                     valid.tolist(), boundary.tolist()):
+            if not is_valid:
                 continue
-
-            # Do a binary search for the segment in question
-            while min_idx <= max_idx:
-                guess_idx = math.floor((max_idx + min_idx) / 2)
-                moof = self._moof_data[guess_idx][1]
-                if frame < moof['frame_start']:
-                    max_idx = max_idx - 1
-                elif frame >= moof['frame_start'] + moof['frame_samples']:
-                    min_idx = min_idx + 1
-                else:
-                    frame_seg.add(self._moof_data[guess_idx][0])
-                    frame_seg.add(self._moof_data[guess_idx][0]+1)
-                    if frame - moof['frame_start'] > moof['frame_samples'] - 5:
-                        # Handle boundary conditions
-                        if guess_idx + 1 in self._moof_data:
-                            frame_seg.add(self._moof_data[guess_idx+1][0])
-                            frame_seg.add(self._moof_data[guess_idx+1][0]+1)
-                    break
-
-            frame_seg = list(frame_seg)
-            frame_seg.sort()
-            segment_list.append((frame, frame_seg))
-        logger.info(f"Given {frames}, we need {segment_list}")
+            # We already load the header so ignore those segments
+            frame_seg = {0, 1, self._moof_segments[idx], self._moof_segments[idx] + 1}
+            if is_boundary:
+                frame_seg.update((self._moof_segments[idx + 1], self._moof_segments[idx + 1] + 1))
+            segment_list.append((frame, sorted(frame_seg)))
+        logger.debug(f"Given {frames}, we need {segment_list}")
         return segment_list
 
     def _get_impacted_segments_from_ranges(self, frame_ranges):
@@ -140,21 +195,32 @@ class MediaUtil:
         logger.info(f"Range-based segment list: {segment_list}")
         return segment_list
 
+    def _fetch_ranges(self, ranges):
+        """ Fetches distinct (offset, size) byte ranges of the video concurrently and returns
+            a dict mapping each range to its bytes.
+        """
+        ranges = list(set(ranges))
+        if len(ranges) == 0:
+            return {}
+        num_workers = min(MEDIA_FETCH_WORKERS, len(ranges))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            bodies = executor.map(
+                lambda r: self._cache.get_range(self._storage, self._video_file, *r), ranges)
+            return dict(zip(ranges, bodies))
+
     def make_temporary_videos(self, segment_list):
         """ Return a temporary mp4 for each impacted segment to limit IO to
-            cloud storage """
+            cloud storage. Segments shared between frames are fetched once, and
+            all ranges for the request are fetched concurrently. """
         lookup = {}
         segment_info = []
+        segments_by_frame = []
+        all_segments = set()
         for frame, segments in segment_list:
             temp_video = os.path.join(self._temp_dir, f"{frame}.mp4")
-            preferred_block_size = 16*1024
-            sc_graph = [(0, 0)]
             segment_frame_start = sys.maxsize
-            segment_num_frames = 0
-            # create a scatter/gather
             for segment_idx in segments:
                 segment = self._segment_info['segments'][segment_idx]
-                last_io = sc_graph[len(sc_graph)-1]
                 if segment.get('frame_start', sys.maxsize) < segment_frame_start:
                     segment_frame_start = segment['frame_start']
 
@@ -162,23 +228,36 @@ class MediaUtil:
                     segment_info.append({
                         'frame_start': segment['frame_start'],
                         'num_frames': segment['frame_samples']})
-
-                if last_io[0] + last_io[1] == segment['offset']:
-                    # merge contigous blocks
-                    sc_graph[len(sc_graph)-1] = (last_io[0], last_io[1] + segment['size'])
-                else:
-                    # A new block
-                    sc_graph.append((segment['offset'], segment['size']))
-
             lookup[frame] = (segment_frame_start, temp_video)
-
-            logger.info(f"Scatter gather graph = {sc_graph}")
-            with open(temp_video, "wb") as out_fp:
-                for scatter in sc_graph:
-                    start = scatter[0]
-                    stop = scatter[0] + scatter[1] - 1 # Byte range is inclusive
-                    body = self._storage.get_object(self._video_file, start=start, stop=stop)
-                    out_fp.write(body)
+            segments_by_frame.append((temp_video, segments))
+            all_segments.update(segments)
+
+        # create a scatter/gather over the union of segments, merging contiguous blocks
+        sc_graph = []
+        block_of = {}
+        for segment_idx in sorted(all_segments):
+            segment = self._segment_info['segments'][segment_idx]
+            if sc_graph and sum(sc_graph[-1]) == segment['offset']:
+                sc_graph[-1] = (sc_graph[-1][0], sc_graph[-1][1] + segment['size'])
+            else:
+                sc_graph.append((segment['offset'], segment['size']))
+            block_of[segment_idx] = len(sc_graph) - 1
+        logger.info(f"Scatter gather graph = {sc_graph}")
+        bodies = self._fetch_ranges(sc_graph)
+
+        for temp_video, segments in segments_by_frame:
+            fd = os.open(temp_video, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                position = 0
+                for segment_idx in segments:
+                    segment = self._segment_info['segments'][segment_idx]
+                    block = sc_graph[block_of[segment_idx]]
+                    start = segment['offset'] - block[0]
+                    body = memoryview(bodies[block])[start:start + segment['size']]
+                    os.pwrite(fd, body, position)
+                    position += segment['size']
+            finally:
+                os.close(fd)
 
         return lookup, segment_info
 
@@ -192,57 +271,160 @@ class MediaUtil:
         seconds = total_seconds % 60
         return f"{hours}:{minutes}:{seconds}"
 
-    def _generate_frame_images(self, frames, rois=None, render_format="jpg", force_scale=None):
+    def _crop_filter(self, roi, force_scale=None):
+        """ Returns a crop (and optional scale) filter for a relative (w, h, x, y) roi
+            along with the size of the resulting image """
+        w = max(0,min(round(roi[0]*self._width),self._width)) #pylint: disable=invalid-name
+        h = max(0,min(round(roi[1]*self._height),self._height)) #pylint: disable=invalid-name
+        x = max(0,min(round(roi[2]*self._width),self._width)) #pylint: disable=invalid-name
+        y = max(0,min(round(roi[3]*self._height),self._height)) #pylint: disable=invalid-name
+        if force_scale:
+            return f"crop={w}:{h}:{x}:{y},scale={force_scale[0]}:{force_scale[1]}", \
+                   tuple(force_scale)
+        return f"crop={w}:{h}:{x}:{y}", (w, h)
+
+    def _plan_frames(self, frames):
+        """ Groups requested frames by the segments they need, ordered by position in the
+            video.
+
+            :returns: List of (segment indices, [(request index, frame), ...])
+        """
+        frames = [int(frame) for frame in frames]
+        impacted_segments = self._get_impacted_segments(frames)
+        segments_of = {frame: tuple(segments) for frame, segments in impacted_segments or []}
+        plan = {}
+        for idx, frame in enumerate(frames):
+            if frame not in segments_of:
+                raise ValueError(f"Failed to find frame {frame} in segmented mp4!")
+            plan.setdefault(segments_of[frame], []).append((idx, frame))
+        return sorted(plan.items())
+
+    def _frame_inputs(self, frames=None, plan=None):
+        """ Makes temporary videos for the requested frames. Frames that need the same
+            segments share one temporary video so it is only decoded once.
+
+            :returns: List of (temporary video, [(request index, frame in video), ...])
+        """
+        if plan is None:
+            plan = self._plan_frames(frames)
+
+        # attempt to make a temporary file in a fast manner to speed up AWS access
+        lookup, _ = self.make_temporary_videos([(selected[0][1], list(segments))
+                                                for segments, selected in plan])
+        groups = []
+        for _, selected in plan:
+            segment_frame_start, temp_video = lookup[selected[0][1]]
+            groups.append((temp_video, [(idx, frame - segment_frame_start)
+                                        for idx, frame in selected]))
+        return groups
+
+    def _select_filters(self, groups, rois=None, force_scale=None):
+        """ Returns filter graph chains that decode each input once, select the requested
+            frames in one pass and crop them. The frame for request index i is labelled
+            [f<i>]. """
+        chains = []
+        for input_idx, (_, selected) in enumerate(groups):
+            distinct = sorted(set(rel for _, rel in selected))
+            expr = '+'.join(f"eq(n\\,{rel})" for rel in distinct)
+            labels = ''.join(f"[s{idx}]" for idx, _ in selected)
+            chains.append(f"[{input_idx}:v]select='{expr}',split={len(selected)}{labels}")
+            for idx, rel in selected:
+                chain = f"[s{idx}]select='eq(n\\,{distinct.index(rel)})'"
+                if rois:
+                    chain += "," + self._crop_filter(rois[idx], force_scale)[0]
+                chains.append(f"{chain}[f{idx}]")
+        return chains
+
+    def _filter_graph_args(self, groups, chains, outputs):
+        """ Returns ffmpeg arguments for one filter graph over the temporary videos of the
+            given groups """
+        args = ["ffmpeg"]
+        for temp_video, _ in groups:
+            args.extend(["-i", temp_video])
+        args.extend(["-filter_complex", ";".join(chains)])
+        args.extend(outputs)
+        logger.info(args)
+        return args
+
+    def _run_filter_graph(self, groups, chains, outputs):
+        """ Runs a single ffmpeg over the temporary videos of the given groups """
+        args = self._filter_graph_args(groups, chains, outputs)
+        return subprocess.run(args, check=True, capture_output=True)
+
+    def _stream_filter_graph(self, groups, chains, outputs):
+        """ Runs a single ffmpeg over the temporary videos of the given groups and returns
+            an iterator over chunks of its stdout as they are produced. The first chunk is
+            read before returning, so ffmpeg failing without output raises here, before a
+            response is started. A failure after that is logged and ends the iterator with
+            an error, which aborts the response. """
+        args = self._filter_graph_args(groups, chains, outputs)
+        log_path = os.path.join(self._temp_dir, "ffmpeg_stream.log")
+        with open(log_path, "wb") as log_file:
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=log_file)
+        try:
+            first = proc.stdout.read(STREAM_CHUNK_SIZE)
+            if not first:
+                self._check_stream(proc, args, log_path, 0)
+        except:
+            self._stop_stream(proc)
+            raise
+        return self._iter_stream(proc, args, log_path, first)
+
+    def _iter_stream(self, proc, args, log_path, chunk):
+        """ Yields chunks of ffmpeg output starting with the given chunk """
+        streamed = 0
+        try:
+            while chunk:
+                yield chunk
+                streamed += len(chunk)
+                chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+            self._check_stream(proc, args, log_path, streamed)
+        finally:
+            self._stop_stream(proc)
+
+    @staticmethod
+    def _check_stream(proc, args, log_path, streamed):
+        """ Waits for a streaming ffmpeg to exit and raises if it failed """
+        if proc.wait() != 0:
+            with open(log_path, "rb") as log_file:
+                stderr = log_file.read()[-4096:].decode(errors="replace")
+            logger.error(f"ffmpeg exited with code {proc.returncode} after streaming {streamed} "
+                         f"bytes: {stderr}")
+            raise subprocess.CalledProcessError(proc.returncode, args, stderr=stderr)
+
+    @staticmethod
+    def _stop_stream(proc):
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+    def _can_combine(self, groups, num_frames, rois=None, force_scale=None):
+        """ Returns true if frame extraction and tiling/animation of the given groups can be
+            done in one filter graph, which requires all frames to share a size """
+        if len(groups) > BATCH_SIZE:
+            return False
+        if rois:
+            sizes = set(self._crop_filter(rois[idx], force_scale)[1] for idx in range(num_frames))
+            return len(sizes) == 1
+        return True
+
+    def _generate_frame_images(self, frames, rois=None, render_format="jpg", force_scale=None,
+                               groups=None):
         """ Generate a jpg for each requested frame and store in the working directory """
-        BATCH_SIZE = 30
-        frame_idx = 0
+        if groups is None:
+            groups = self._frame_inputs(frames)
+        logger.info(f"Processing {self._video_file}")
         procs = []
-        for idx in range(0, len(frames), BATCH_SIZE):
-            batch = [int(frame) for frame in frames[idx:idx+BATCH_SIZE]]
-            crop_filter = None
-            if rois:
-                crop_filter=[]
-                for c in rois: #pylint: disable=invalid-name
-                    w = max(0,min(round(c[0]*self._width),self._width)) #pylint: disable=invalid-name
-                    h = max(0,min(round(c[1]*self._height),self._height)) #pylint: disable=invalid-name
-                    x = max(0,min(round(c[2]*self._width),self._width)) #pylint: disable=invalid-name
-                    y = max(0,min(round(c[3]*self._height),self._height)) #pylint: disable=invalid-name
-                    if force_scale:
-                        scale_w=force_scale[0]
-                        scale_h=force_scale[1]
-                        crop_filter.append(f"crop={w}:{h}:{x}:{y},scale={scale_w}:{scale_h}")
-                    else:
-                        crop_filter.append(f"crop={w}:{h}:{x}:{y}")
-
-            logger.info(f"Processing {self._video_file}")
-            args = ["ffmpeg"]
-            inputs = []
+        for idx in range(0, len(groups), BATCH_SIZE):
+            batch = groups[idx:idx+BATCH_SIZE]
+            chains = self._select_filters(batch, rois, force_scale)
             outputs = []
-
-            # attempt to make a temporary file in a fast manner to speed up AWS access
-            impacted_segments = self._get_impacted_segments(batch)
-            lookup = {}
-            if impacted_segments:
-                lookup, _ = self.make_temporary_videos(impacted_segments)
-
-            for batch_idx, frame in enumerate(batch):
-                outputs.extend(["-map", f"{batch_idx}:v","-frames:v", "1", "-q:v", "3"])
-                if crop_filter:
-                    outputs.extend(["-vf", crop_filter[frame_idx]])
-
-                outputs.append(os.path.join(self._temp_dir,f"{frame_idx}.{render_format}"))
-                if frame in lookup:
-                    inputs.extend(["-ss", self._frame_to_time_str(frame, lookup[frame][0]),
-                                                                  "-i", lookup[frame][1]])
-                else:
-                    raise ValueError("Failed to find frame {frame} in segmented mp4!")
-                frame_idx += 1
-
-            # Now add all the cmds in
-            args.extend(inputs)
-            args.extend(outputs)
-            logger.info(args)
-            procs.append(subprocess.run(args, check=True, capture_output=True))
+            for _, selected in batch:
+                for frame_idx, _ in selected:
+                    outputs.extend(["-map", f"[f{frame_idx}]", "-frames:v", "1", "-q:v", "3",
+                                    os.path.join(self._temp_dir, f"{frame_idx}.{render_format}")])
+            procs.append(self._run_filter_graph(batch, chains, outputs))
         return any([proc.returncode == 0 for proc in procs])
 
     def get_clip(self, frame_ranges):
@@ -299,6 +481,34 @@ class MediaUtil:
 
         return self._height
 
+    def iter_frame_images(self, frames, rois=None, render_format="jpg", force_scale=None):
+        """ Yields (request index, encoded image) for each requested frame, cropped to the
+            corresponding roi if given. Work is ordered by position in the video and done
+            BATCH_SIZE segment groups at a time, so temporary files stay bounded for
+            large requests.
+        """
+        if not self.isVideo():
+            images = self.get_cropped_images(rois or [None] * len(frames),
+                                             render_format, force_scale)
+            yield from enumerate(images)
+            return
+
+        plan = self._plan_frames(frames)
+        for start in range(0, len(plan), BATCH_SIZE):
+            groups = self._frame_inputs(plan=plan[start:start+BATCH_SIZE])
+            self._generate_frame_images(frames, rois,
+                                        render_format=render_format,
+                                        force_scale=force_scale,
+                                        groups=groups)
+            for temp_video, selected in groups:
+                for idx, _ in selected:
+                    path = os.path.join(self._temp_dir, f"{idx}.{render_format}")
+                    with open(path, 'rb') as data_file:
+                        data = data_file.read()
+                    os.remove(path)
+                    yield idx, data
+                os.remove(temp_video)
+
     def get_cropped_image(self, roi, render_format="jpg", force_scale=None) -> str:
         """ Generate an image of the given ROI
 
@@ -315,31 +525,121 @@ class MediaUtil:
         Returns:
             Image file path
         """
+        return self.get_cropped_images([roi], render_format, force_scale)[0]
 
-        left = roi[2] * self._width
-        upper = roi[3] * self._height
-        right = left + roi[0] * self._width
-        lower = upper + roi[1] * self._height
+    def _draft_size(self, rois=None, force_scale=None):
+        """ Returns the smallest image size that can be decoded while keeping each roi at
+            least as large as `force_scale`, or None if the image must be decoded at full
+            resolution.
+        """
+        if force_scale is None:
+            return None
+        rois = [roi or (1.0, 1.0, 0.0, 0.0) for roi in rois or [None]]
+        scale = max(max(force_scale[0] / max(roi[0] * self._width, 1),
+                        force_scale[1] / max(roi[1] * self._height, 1))
+                    for roi in rois)
+        if scale >= 1.0:
+            return None
+        return (math.ceil(self._width * scale), math.ceil(self._height * scale))
 
+    def _load_image(self, draft_size=None):
+        """ Downloads and decodes the image. JPEGs are decoded at the smallest DCT scale
+            that is at least `draft_size`, if given.
+        """
         out = io.BytesIO()
         self._storage.download_fileobj(self._video_file, out)
         out.seek(0)
         img = Image.open(out)
-        img = img.crop((left, upper, right, lower))
-
-        if force_scale is not None:
-            img = img.resize(force_scale)
-
+        if draft_size is not None:
+            img.draft('RGB', draft_size)
+        img.load()
+        return img
+
+    def _crop_images(self, rois, force_scale=None):
+        """ Returns a PIL image for each roi, downloading and decoding the image once.
+            A roi of None is the full image.
+        """
+        full = self._load_image(self._draft_size(rois, force_scale))
+        width, height = full.size
+        images = []
+        for roi in rois:
+            img = full
+            if roi is not None:
+                left = roi[2] * width
+                upper = roi[3] * height
+                right = left + roi[0] * width
+                lower = upper + roi[1] * height
+                img = full.crop((left, upper, right, lower))
+
+            if force_scale is not None:
+                img = img.resize(force_scale)
+            images.append(img)
+        return images
+
+    @staticmethod
+    def _encode_image(img, render_format):
         img_buf = io.BytesIO()
         if render_format == "jpg":
-            img.save(img_buf, "jpeg", quality=95)
+            img.convert("RGB").save(img_buf, "jpeg", quality=95)
         else:
             img.save(img_buf, "png", quality=95)
         return img_buf.getvalue()
 
-    def get_tile_image(self, frames, rois=None, tile_size=None,
-                       render_format="jpg", force_scale=None):
-        """ Generate a tile jpeg of the given frame/rois """
+    def get_cropped_images(self, rois, render_format="jpg", force_scale=None) -> list:
+        """ Generate an image of each of the given ROIs, downloading the image once
+
+        Args:
+            rois: list
+                List of (width, height, x, y) tuples, see `get_cropped_image`
+
+        Returns:
+            List of encoded images
+        """
+        return [self._encode_image(img, render_format)
+                for img in self._crop_images(rois, force_scale)]
+
+    def get_image_tile(self, frames, rois=None, tile_size=None,
+                       render_format="jpg", force_scale=None) -> bytes:
+        """ Equivalent of `get_tile_image` for image media. Decoding, cropping, scaling
+            and tiling are done in memory without temporary files or subprocesses.
+
+        Returns:
+            Encoded image
+        """
+        images = self._crop_images(rois or [None] * len(frames), force_scale)
+        if len(images) == 1:
+            return self._encode_image(images[0], render_format)
+
+        columns, _ = [int(comp) for comp in self._tile_size(len(images), tile_size).split('x')]
+        rows = math.ceil(len(images) / columns)
+        cell_width, cell_height = images[0].size
+        tile = Image.new(images[0].mode, (columns * cell_width, rows * cell_height))
+        for idx, img in enumerate(images):
+            if img.size != (cell_width, cell_height):
+                img = img.resize((cell_width, cell_height))
+            tile.paste(img, ((idx % columns) * cell_width, (idx // columns) * cell_height))
+        return self._encode_image(tile, render_format)
+
+    def get_frame_images(self, frames, rois=None, render_format="jpg", force_scale=None) -> list:
+        """ Generate an image of each requested frame, cropped to the corresponding roi if
+            given. Frames sharing segments are decoded once.
+
+        Returns:
+            List of encoded images in the order of `frames`
+        """
+        if self._generate_frame_images(frames, rois,
+                                       render_format=render_format,
+                                       force_scale=force_scale) == False:
+            return None
+        images = []
+        for idx in range(len(frames)):
+            with open(os.path.join(self._temp_dir, f"{idx}.{render_format}"), 'rb') as data_file:
+                images.append(data_file.read())
+        return images
+
+    @staticmethod
+    def _tile_size(num_frames, tile_size=None):
+        """ Returns the given tile size if it fits all frames, otherwise computes one """
         # Compute tile size if not supplied explicitly
         try:
             if tile_size is not None:
@@ -347,19 +647,37 @@ class MediaUtil:
                 comps = tile_size.split('x')
                 if len(comps) != 2:
                     raise Exception("Bad Tile Size")
-                if int(comps[0])*int(comps[1]) < len(frames):
+                if int(comps[0])*int(comps[1]) < num_frames:
                     raise Exception("Bad Tile Size")
         except:
             tile_size = None
             # compute the required tile size
         if tile_size is None:
-            width = math.ceil(math.sqrt(len(frames)))
-            height = math.ceil(len(frames) / width)
+            width = math.ceil(math.sqrt(num_frames))
+            height = math.ceil(num_frames / width)
             tile_size = f"{width}x{height}"
+        return tile_size
+
+    def get_tile_image(self, frames, rois=None, tile_size=None,
+                       render_format="jpg", force_scale=None):
+        """ Generate a tile jpeg of the given frame/rois """
+        tile_size = self._tile_size(len(frames), tile_size)
+
+        groups = self._frame_inputs(frames)
+        if len(frames) > 1 and self._can_combine(groups, len(frames), rois, force_scale):
+            # Select, crop and tile in one filter graph
+            output_file = os.path.join(self._temp_dir, f"tile.{render_format}")
+            chains = self._select_filters(groups, rois, force_scale)
+            inputs = ''.join(f"[f{idx}]" for idx in range(len(frames)))
+            chains.append(f"{inputs}concat=n={len(frames)}:v=1:a=0,tile={tile_size}[tile]")
+            self._run_filter_graph(groups, chains, ["-map", "[tile]", "-frames:v", "1",
+                                                    "-q:v", "3", output_file])
+            return output_file
 
         if self._generate_frame_images(frames, rois,
                                        render_format=render_format,
-                                       force_scale=force_scale) == False:
+                                       force_scale=force_scale,
+                                       groups=groups) == False:
             return None
 
         output_file = None
@@ -379,11 +697,37 @@ class MediaUtil:
 
         return output_file
 
-    def get_animation(self,frames, roi, fps, render_format, force_scale):
-        """ TODO: add documentation for this """
+    def get_animation(self, frames, roi, fps, render_format, force_scale=None, stream=False):
+        """ Returns the path of an animation (gif or mp4) of the given frames.
+
+            If `stream` is true and the animation can be encoded in one pass, returns an
+            iterator over chunks of ffmpeg output instead, so the animation is never
+            written to disk or held in memory in full.
+        """
+        groups = self._frame_inputs(frames)
+        if self._can_combine(groups, len(frames), roi, force_scale):
+            # Select, crop and encode the animation in one filter graph
+            chains = self._select_filters(groups, roi, force_scale)
+            inputs = ''.join(f"[f{idx}]" for idx in range(len(frames)))
+            chain = f"{inputs}concat=n={len(frames)}:v=1:a=0,setpts=N/({fps}*TB)"
+            if render_format == 'mp4':
+                output_file = os.path.join(self._temp_dir, "temp.mp4")
+                stream_args = ["-movflags", "frag_keyframe+empty_moov", "-f", "mp4", "pipe:1"]
+                chains.append(f"{chain}[anim]")
+            else:
+                output_file = os.path.join(self._temp_dir, "animation.gif")
+                stream_args = ["-f", "gif", "pipe:1"]
+                chains.append(f"{chain},split[a][b];[a]palettegen[p];[b][p]paletteuse[anim]")
+            outputs = ["-map", "[anim]", "-r", str(fps)]
+            if stream:
+                return self._stream_filter_graph(groups, chains, outputs + stream_args)
+            self._run_filter_graph(groups, chains, outputs + [output_file])
+            return output_file
+
         if self._generate_frame_images(frames, roi,
                                        render_format="jpg",
-                                       force_scale=force_scale) == False:
+                                       force_scale=force_scale,
+                                       groups=groups) == False:
             return None
 
         mp4_args = ["ffmpeg",
@@ -34,20 +34,32 @@ def _for_schema_view(request, view):
         and request.META['RAW_URI'].startswith('/schema/')
     )
 
+def _project_id(project):
+    """ Returns the ID of a project given a project object or ID.
+    """
+    if isinstance(project, Project):
+        return project.pk
+    return int(project)
+
 class ProjectPermissionBase(BasePermission):
     """Base class for requiring project permissions.
     """
     def has_permission(self, request, view):
         # Get the project from the URL parameters
         if 'project' in view.kwargs:
-            project_id = view.kwargs['project']
-            project = get_object_or_404(Project, pk=int(project_id))
+            project = int(view.kwargs['project'])
+            if self._get_cached_permission(request, project) is None:
+                project = get_object_or_404(Project, pk=project)
         elif 'id' in view.kwargs:
             pk = view.kwargs['id']
-            obj = get_object_or_404(view.get_queryset(), pk=pk)
-            project = self._project_from_object(obj)
+            model = view.get_queryset().model._meta.label_lower
+            project = TatorCache().get_project_cache(model, pk)
             if project is None:
-                raise Http404
+                obj = get_object_or_404(view.get_queryset(), pk=pk)
+                project = self._project_from_object(obj)
+                if project is None:
+                    raise Http404
+                TatorCache().set_project_cache(model, pk, _project_id(project))
         elif 'uid' in view.kwargs:
             uid = view.kwargs['uid']
             try:
@@ -63,7 +75,12 @@ class ProjectPermissionBase(BasePermission):
 
     def has_object_permission(self, request, view, obj):
         # Get the project from the object
-        project = self._project_from_object(obj)
+        if hasattr(obj, 'project_id'):
+            project = obj.project_id
+        else:
+            project = self._project_from_object(obj)
+        if project is None:
+            return False
         return self._validate_project(request, project)
 
     def _project_from_object(self, obj):
@@ -75,25 +92,34 @@ class ProjectPermissionBase(BasePermission):
             project = obj
         return project
 
+    def _get_cached_permission(self, request, project_id):
+        if isinstance(request.user, AnonymousUser):
+            return None
+        return TatorCache().get_permission_cache(request.user.id, project_id)
+
     def _validate_project(self, request, project):
         granted = True
 
         if isinstance(request.user, AnonymousUser):
             granted = False
         else:
-            # Find membership for this user and project
-            membership = Membership.objects.filter(
-                user=request.user,
-                project=project
-            )
+            # Find membership for this user and project, checking the cache first
+            project_id = _project_id(project)
+            permission = self._get_cached_permission(request, project_id)
+            if permission is None:
+                permission = Membership.objects.filter(
+                    user=request.user,
+                    project=project_id,
+                ).values_list('permission', flat=True).first()
+                permission = '' if permission is None else Permission(permission).value
+                TatorCache().set_permission_cache(request.user.id, project_id, permission)
 
             # If user is not part of project, deny access
-            if membership.count() == 0:
+            if permission == '':
                 granted = False
             else:
                 # If user has insufficient permission, deny access
-                permission = membership[0].permission
-                insufficient = permission in self.insufficient_permissions
+                insufficient = Permission(permission) in self.insufficient_permissions
                 is_edit = request.method not in SAFE_METHODS
                 if is_edit and insufficient:
                     granted = False
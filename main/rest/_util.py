@@ -1,18 +1,43 @@
+from collections import defaultdict
 import datetime
 from itertools import islice
+import zipfile
 import logging
+import shutil
+import json
+import time
+import io
 
+from django.http import FileResponse
+from django.http import StreamingHttpResponse
 from django.utils.http import urlencode
+from django.db import connection
 from django.db.models.expressions import Subquery
+from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields import ArrayField
 from rest_framework.reverse import reverse
 from rest_framework.exceptions import APIException
 
 from ..models import type_to_obj
+from ..models import Resource
+from ..models import ChangeLog
+from ..cache import TatorCache
+from ..cache import PRESIGN_CACHE_TTL
+from ..store import get_storage_lookup
 
 from ._attributes import convert_attribute
 
 logger = logging.getLogger(__name__)
 
+# Number of rows sent per COPY statement by bulk_copy_from_generator.
+COPY_BATCH_SIZE = 10000
+
+# Maximum number of objects recorded by a single bulk ChangeLog.
+BULK_CHANGE_LOG_SIZE = 10000
+
+# Number of rows read per round trip when streaming list responses.
+LIST_STREAM_CHUNK_SIZE = 2000
+
 class Array(Subquery):
     """ Class to expose ARRAY SQL function to ORM """
     template = 'ARRAY(%(subquery)s)'
@@ -109,3 +134,290 @@ def bulk_create_from_generator(obj_generator, model, batch_size=1000):
         saved_objects += model.objects.bulk_create(batch, batch_size)
 
     return saved_objects
+
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def _copy_scalar(value):
+    """ Converts a prepared scalar value to its PostgreSQL text representation.
+    """
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (int, float, str)):
+        return str(value)
+    raise TypeError(f"Cannot COPY value of type {type(value).__name__}!")
+
+def _copy_array(values):
+    """ Converts a prepared list to a PostgreSQL array literal, e.g. `{1,NULL,"a b"}`.
+    """
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append('NULL')
+        elif isinstance(value, (list, tuple)):
+            elements.append(_copy_array(value))
+        else:
+            text = _copy_scalar(value).replace('\\', '\\\\').replace('"', '\\"')
+            elements.append(f'"{text}"')
+    return '{' + ','.join(elements) + '}'
+
+def _copy_text(field, value):
+    """ Converts a field value to PostgreSQL COPY text format. None is written as NULL,
+        JSON fields as JSON text and array fields as array literals.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(field, JSONField):
+        text = json.dumps(value, cls=field.encoder)
+    else:
+        value = field.get_db_prep_save(value, connection=connection)
+        if value is None:
+            return '\\N'
+        if isinstance(field, ArrayField):
+            text = _copy_array(value)
+        else:
+            text = _copy_scalar(value)
+    return text.translate(_COPY_ESCAPES)
+
+def bulk_copy_from_generator(obj_generator, model, batch_size=COPY_BATCH_SIZE):
+    """ Saves objects with PostgreSQL COPY, which is much faster than bulk_create for large
+        inserts. Primary keys are reserved from the table's sequence before each batch is
+        copied, so objects are returned with ids set as with `bulk_create_from_generator`.
+        Like bulk_create, no signals are sent.
+    """
+    meta = model._meta
+    fields = meta.concrete_fields
+    columns = ', '.join(f'"{field.column}"' for field in fields)
+    copy_sql = f'COPY "{meta.db_table}" ({columns}) FROM STDIN'
+    saved_objects = []
+    start = time.time()
+    with connection.cursor() as cursor:
+        while True:
+            batch = list(islice(obj_generator, batch_size))
+            if not batch:
+                break
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) "
+                           "FROM generate_series(1, %s)",
+                           [meta.db_table, meta.pk.column, len(batch)])
+            buf = io.StringIO()
+            for obj, (pk,) in zip(batch, cursor.fetchall()):
+                obj.pk = pk
+                buf.write('\t'.join(_copy_text(field, field.pre_save(obj, True))
+                                     for field in fields))
+                buf.write('\n')
+                obj._state.adding = False
+                obj._state.db = connection.alias
+            buf.seek(0)
+            cursor.copy_expert(copy_sql, buf)
+            saved_objects += batch
+    elapsed = time.time() - start
+    if saved_objects:
+        logger.info(f"Copied {len(saved_objects)} rows into {meta.db_table} in {elapsed:.2f}s "
+                    f"({len(saved_objects) / max(elapsed, 1e-6):.0f} rows/s).")
+    return saved_objects
+
+
+def _change_pairs(change_dict):
+    return [(json.dumps([old, new], sort_keys=True), old, new)
+            for old, new in zip(change_dict['old'], change_dict['new'])]
+
+def bulk_log_changes(project, user, ref_table, ref_ids, change_dicts):
+    """ Records changes to many objects with one ChangeLog per `BULK_CHANGE_LOG_SIZE` objects
+        instead of a ChangeLog and ChangeToObject per object. Changes common to every object
+        are stored once in `description_of_change`, the rest are stored per object in
+        `ref_changes`. Use `expand_change_log` to get the change of each object back.
+
+        :param ref_table: ContentType of the changed objects.
+        :param ref_ids: List of ids of the changed objects.
+        :param change_dicts: List of `description_of_change` dicts aligned with `ref_ids`.
+        :returns: List of created ChangeLogs.
+    """
+    change_logs = []
+    for start in range(0, len(ref_ids), BULK_CHANGE_LOG_SIZE):
+        stop = start + BULK_CHANGE_LOG_SIZE
+        pairs = [_change_pairs(change_dict) for change_dict in change_dicts[start:stop]]
+        shared = set.intersection(*[set(key for key, _, _ in obj_pairs) for obj_pairs in pairs])
+        change_logs.append(ChangeLog(
+            project=project,
+            user=user,
+            description_of_change={
+                'old': [old for key, old, _ in pairs[0] if key in shared],
+                'new': [new for key, _, new in pairs[0] if key in shared],
+            },
+            ref_table=ref_table,
+            ref_ids=list(ref_ids[start:stop]),
+            ref_changes=[{
+                'old': [old for key, old, _ in obj_pairs if key not in shared],
+                'new': [new for key, _, new in obj_pairs if key not in shared],
+            } for obj_pairs in pairs],
+        ))
+    return ChangeLog.objects.bulk_create(change_logs)
+
+def expand_change_log(change_log, ref_id=None):
+    """ Returns a list of `description_of_change` dicts, one per object recorded by a bulk
+        ChangeLog, or just the one of `ref_id` if given. Accepts a ChangeLog or a dict from
+        `values()` containing `description_of_change`, `ref_ids` and `ref_changes`.
+    """
+    if not isinstance(change_log, dict):
+        change_log = {'description_of_change': change_log.description_of_change,
+                      'ref_ids': change_log.ref_ids,
+                      'ref_changes': change_log.ref_changes}
+    shared = change_log['description_of_change']
+    if change_log['ref_ids'] is None:
+        return [shared]
+    return [{'old': shared['old'] + changes['old'], 'new': shared['new'] + changes['new']}
+            for id_, changes in zip(change_log['ref_ids'], change_log['ref_changes'])
+            if ref_id is None or id_ == ref_id]
+
+
+def iter_chunks(qs, chunk_size=LIST_STREAM_CHUNK_SIZE):
+    """ Yields lists of at most `chunk_size` rows of a queryset, read through a server-side
+        cursor so the full result is never held in memory.
+    """
+    rows = qs.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+def get_attribute_names(entity_type_qs):
+    """ Returns names of the attribute types of the given entity types, in order of
+        definition.
+    """
+    names = {}
+    for attribute_types in entity_type_qs.values_list('attribute_types', flat=True):
+        for attribute_type in attribute_types or []:
+            names[attribute_type['name']] = None
+    return list(names)
+
+
+def get_download_urls(paths, expiration, store_lookup, store_default=None):
+    """ Returns a mapping from object path to presigned url. Paths are grouped by storage object
+        and signed in one pass each. Signed urls are cached for a fraction of their expiration
+        so that repeated requests for the same paths reuse them.
+
+        :param paths: List of object paths.
+        :param expiration: Expiration time of the urls in seconds.
+        :param store_lookup: Mapping from path to TatorStorage, see `get_storage_lookup`.
+        :param store_default: TatorStorage for paths missing from `store_lookup`.
+    """
+    by_store = defaultdict(list)
+    for path in set(paths):
+        tator_store = store_lookup[path] if store_default is None \
+                      else store_lookup.get(path, store_default)
+        by_store[tator_store].append(path)
+
+    ttl = min(expiration // 10, PRESIGN_CACHE_TTL)
+    urls = {}
+    for tator_store, store_paths in by_store.items():
+        cached = TatorCache().get_presigned_urls(tator_store.bucket_name, expiration, store_paths)
+        missing = [path for path, url in zip(store_paths, cached) if url is None]
+        urls.update({path: url for path, url in zip(store_paths, cached) if url is not None})
+        if missing:
+            signed = dict(zip(missing, tator_store.get_download_urls(missing, expiration)))
+            if ttl > 0:
+                TatorCache().set_presigned_urls(tator_store.bucket_name, expiration, signed, ttl)
+            urls.update(signed)
+    return urls
+
+def presign_media(expiration, medias, fields=None):
+    """ Replaces specified media fields with presigned urls.
+    """
+    # First get resources referenced by the given media.
+    fields = fields or ["archival", "streaming", "audio", "image", "thumbnail", "thumbnail_gif", "attachment"]
+    media_ids = [media['id'] for media in medias]
+    resources = Resource.objects.filter(media__in=media_ids)
+    store_lookup = get_storage_lookup(resources)
+
+    # Collect all paths so they can be signed in one pass.
+    paths = []
+    for media in medias:
+        if media.get("media_files") is None:
+            continue
+
+        for field in fields:
+            for media_def in media["media_files"].get(field, []):
+                paths.append(media_def["path"])
+                if field == "streaming":
+                    if "segment_info" in media_def:
+                        paths.append(media_def["segment_info"])
+                    else:
+                        logger.warning(
+                            f"No segment file in media {media['id']} for file {media_def['path']}!"
+                        )
+    urls = get_download_urls(paths, expiration, store_lookup)
+
+    # Replace all keys with presigned urls.
+    for media in medias:
+        if media.get("media_files") is None:
+            continue
+
+        for field in fields:
+            for media_def in media["media_files"].get(field, []):
+                media_def["path"] = urls[media_def["path"]]
+                if field == "streaming" and "segment_info" in media_def:
+                    media_def["segment_info"] = urls[media_def["segment_info"]]
+
+class _ZipStream:
+    """ Write-only file object that collects bytes written by `zipfile` so they can be
+        streamed. Having no tell or seek makes `zipfile` write data descriptors.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def zip_stream(entries):
+    """ Generator yielding a zip archive of (name, bytes) entries as it is built. Entries
+        are stored without compression.
+    """
+    buf = _ZipStream()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+            yield buf.take()
+    yield buf.take()
+
+def file_response(path, content_type, temp_dir=None):
+    """ Returns a response that streams the file at `path`, using sendfile when the server
+        supports it. If `temp_dir` is given it is removed right away; the open file stays
+        readable until the response is closed.
+    """
+    data_file = open(path, 'rb')
+    if temp_dir is not None:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return FileResponse(data_file, content_type=content_type)
+
+class _TempDirStreamingResponse(StreamingHttpResponse):
+    """ Streaming response that removes a temporary directory when it is closed, which the
+        server does whether or not the content was consumed.
+    """
+    def __init__(self, *args, temp_dir=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._temp_dir = temp_dir
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self._temp_dir is not None:
+                shutil.rmtree(self._temp_dir, ignore_errors=True)
+
+def streaming_response(chunks, content_type, temp_dir=None):
+    """ Returns a response that streams the given iterator of bytes. If `temp_dir` is
+        given it is removed when the response is closed.
+    """
+    return _TempDirStreamingResponse(chunks, content_type=content_type, temp_dir=temp_dir)
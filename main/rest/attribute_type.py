@@ -13,6 +13,7 @@ from ..models import (
     Leaf,
 )
 from ..search import TatorSearch
+from ..cache import TatorCache
 from ..schema import AttributeTypeListSchema, parse
 
 from ._base_views import BaseListView
@@ -115,6 +116,7 @@ class AttributeTypeListAPI(BaseListView):
             entity_type, obj_qs = self._get_objects(params)
             TatorSearch().delete_alias(entity_type, attribute_to_delete).save()
 
+        TatorCache().invalidate_attribute_schema(entity_type.project.pk)
         if obj_qs.exists():
             bulk_delete_attributes([attribute_to_delete], obj_qs)
 
@@ -236,6 +238,7 @@ class AttributeTypeListAPI(BaseListView):
                 f"Attribute '{new_name}' mutated from:\n{old_attribute_type}\nto:\n{new_attribute_type}"
             )
 
+        TatorCache().invalidate_attribute_schema(entity_type.project.pk)
         return {"message": "\n".join(messages)}
 
     def _post(self, params: Dict) -> Dict:
@@ -258,6 +261,7 @@ class AttributeTypeListAPI(BaseListView):
                 entity_type.attribute_types = []
                 entity_type.attribute_types.append(new_attribute_type)
             entity_type.save()
+        TatorCache().invalidate_attribute_schema(entity_type.project.pk)
 
         # Add new field to all existing attributes if there is a default value
         if obj_qs.exists() and "default" in new_attribute_type:
@@ -48,7 +48,7 @@ class AudioFileListAPI(BaseListView):
             qs.update(media_files=media_files)
         media = Media.objects.get(pk=params['id'])
         Resource.add_resource(body['path'], media)
-        TatorSearch().create_document(media)
+        TatorSearch().queue_document(media)
         return {'message': f"Media file in media object {media.id} created!"}
 
     def get_queryset(self):
@@ -96,7 +96,7 @@ class AudioFileDetailAPI(BaseDetailView):
             drop_media_from_resource(old_path, media)
             safe_delete(old_path)
             Resource.add_resource(new_path, media)
-        TatorSearch().create_document(media)
+        TatorSearch().queue_document(media)
         return {'message': f"Media file in media object {media.id} successfully updated!"}
 
     def _delete(self, params):
@@ -118,7 +118,7 @@ class AudioFileDetailAPI(BaseDetailView):
         media = Media.objects.get(pk=params['id'])
         drop_media_from_resource(deleted['path'], media)
         safe_delete(deleted['path'])
-        TatorSearch().create_document(media)
+        TatorSearch().queue_document(media)
         return {'message': f'Media file in media object {params["id"]} successfully deleted!'}
 
     def get_queryset(self):
@@ -1,17 +1,52 @@
 import logging
 
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import F
+from django.db.models import Q
 
 from ..models import ChangeLog
 from ..models import ChangeToObject
+from ..models import Leaf
+from ..models import Localization
+from ..models import Media
+from ..models import State
 from ..schema import ChangeLogListSchema
 
 from ._base_views import BaseListView
 from ._permissions import ProjectFullControlPermission
+from ._util import expand_change_log
 
 logger = logging.getLogger(__name__)
 
-CHANGE_LOG_PROPERTIES = ["id", "project", "user", "description_of_change"]
+REF_TABLE_LOOKUP = {
+    "media": Media,
+    "localization": Localization,
+    "state": State,
+    "leaf": Leaf,
+}
+
+def _ordering(prefix=""):
+    """ Returns order_by arguments for (modified_datetime, id) order. Change logs without a
+        modification time come last, matching the (modified_datetime, id) indexes.
+    """
+    return [F(f"{prefix}modified_datetime").asc(nulls_last=True), f"{prefix}id"]
+
+def _ordering_key(change_log):
+    """ Returns a sort key matching `_ordering` for a ChangeLog.
+    """
+    modified_datetime = change_log.modified_datetime
+    return (modified_datetime is None, modified_datetime or 0, change_log.id)
+
+def _keyset_filter(prefix, after):
+    """ Returns a filter selecting change logs that come after the given change log in
+        `_ordering` order.
+    """
+    modified_datetime = ChangeLog.objects.get(pk=after).modified_datetime
+    if modified_datetime is None:
+        return Q(**{f"{prefix}modified_datetime__isnull": True, f"{prefix}id__gt": after})
+    return (Q(**{f"{prefix}modified_datetime__gt": modified_datetime})
+            | Q(**{f"{prefix}modified_datetime": modified_datetime, f"{prefix}id__gt": after})
+            | Q(**{f"{prefix}modified_datetime__isnull": True}))
 
 class ChangeLogListAPI(BaseListView):
     """
@@ -31,20 +66,59 @@ class ChangeLogListAPI(BaseListView):
         project = params["project"]
         user_id = params.get("user_id")
         entity_id = params.get("entity_id")
+        ref_table = params.get("ref_table")
+        after = params.get("after")
+        start = params.get("start")
+        stop = params.get("stop")
 
         if all(value is None for value in [user_id, entity_id]):
             raise ValueError(
                 f"At least one of the following fields need to be set: user_id, entity_id"
             )
 
-        cl_qs = ChangeLog.objects.filter(project=project)
+        if ref_table is not None:
+            ref_table = ContentType.objects.get_for_model(REF_TABLE_LOOKUP[ref_table])
 
-        if user_id is not None:
-            cl_qs = cl_qs.filter(user=user_id)
+        # Filters are applied to change logs directly and through ChangeToObject.
+        def _filters(prefix):
+            filters = Q(**{f"{prefix}project": project})
+            if user_id is not None:
+                filters &= Q(**{f"{prefix}user": user_id})
+            if after is not None:
+                filters &= _keyset_filter(prefix, after)
+            return filters
 
-        if entity_id is not None:
-            cto_qs = ChangeToObject.objects.filter(ref_id=entity_id)
-            cl_qs = cl_qs.filter(pk__in=[cto.change_id.id for cto in cto_qs if cto.change_id])
+        if entity_id is None:
+            cl_qs = ChangeLog.objects.filter(_filters(""))
+            if ref_table is not None:
+                cto_qs = ChangeToObject.objects.filter(ref_table=ref_table,
+                                                       change_id__project=project)
+                cl_qs = cl_qs.filter(Q(ref_table=ref_table)
+                                     | Q(pk__in=cto_qs.values("change_id")))
+            change_logs = list(cl_qs.order_by(*_ordering())[:stop])
+        else:
+            # Individual changes are found through ChangeToObject and bulk changes through
+            # ref_ids, each with an index.
+            cto_qs = ChangeToObject.objects.filter(_filters("change_id__"), ref_id=entity_id)
+            cl_qs = ChangeLog.objects.filter(_filters(""), ref_ids__contains=[entity_id])
+            if ref_table is not None:
+                cto_qs = cto_qs.filter(ref_table=ref_table)
+                cl_qs = cl_qs.filter(ref_table=ref_table)
+            cto_qs = cto_qs.select_related("change_id").order_by(*_ordering("change_id__"))
+            change_logs = {cto.change_id.id: cto.change_id for cto in cto_qs[:stop]}
+            change_logs.update({cl.id: cl for cl in cl_qs.order_by(*_ordering())[:stop]})
+            change_logs = sorted(change_logs.values(), key=_ordering_key)[:stop]
+        change_logs = change_logs[start:]
 
-        response_data = list(cl_qs.values(*CHANGE_LOG_PROPERTIES))
+        # Bulk change logs are expanded to one entry per changed object after pagination, so
+        # start and stop count change logs rather than returned entries.
+        for change_log in change_logs:
+            for description_of_change in expand_change_log(change_log, entity_id):
+                response_data.append({
+                    "id": change_log.id,
+                    "project": change_log.project_id,
+                    "user": change_log.user_id,
+                    "modified_datetime": change_log.modified_datetime,
+                    "description_of_change": description_of_change,
+                })
         return response_data
@@ -11,6 +11,7 @@ from ..store import get_tator_store, get_storage_lookup
 
 from ._base_views import BaseListView
 from ._permissions import ProjectTransferPermission
+from ._util import get_download_urls
 
 logger = logging.getLogger(__name__)
 
@@ -35,16 +36,13 @@ class DownloadInfoAPI(BaseListView):
         # Uploads without resources saved will use the default project bucket.
         store_default = get_tator_store(Project.objects.get(pk=project).bucket)
 
-        # Set up S3 interfaces.
-        response_data = []
+        # Make sure the keys correspond to the correct project.
         for key in keys:
-            tator_store = store_lookup.get(key, store_default)
-            # Make sure the key corresponds to the correct project.
             project_from_key = int(key.split('/')[1])
             if project != project_from_key:
                 raise PermissionDenied
-            # Generate presigned url.
-            url = tator_store.get_download_url(key, expiration)
-            response_data.append({'key': key, 'url': url})
-        return response_data
 
+        # Generate presigned urls.
+        urls = get_download_urls(keys, expiration, store_lookup, store_default)
+        response_data = [{'key': key, 'url': urls[key]} for key in keys]
+        return response_data
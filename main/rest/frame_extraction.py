@@ -0,0 +1,65 @@
+import logging
+import shutil
+import tempfile
+
+from ..models import Media
+from ..schema import FrameExtractionSchema
+from ..schema import parse
+
+from ._base_views import BaseDetailView
+from ._media_util import MediaUtil
+from ._permissions import ProjectViewOnlyPermission
+from ._util import streaming_response
+from ._util import zip_stream
+from .localization_graphic import parse_force_scale
+
+logger = logging.getLogger(__name__)
+
+class FrameExtractionAPI(BaseDetailView):
+    """ Extract many frames or crops from one media in one request.
+
+        Returns a zip archive that is streamed as frames are extracted. Work is ordered
+        by segment so each segment is fetched and decoded once.
+    """
+    schema = FrameExtractionSchema()
+    permission_classes = [ProjectViewOnlyPermission]
+    http_method_names = ['post']
+
+    def get_queryset(self):
+        return Media.objects.all()
+
+    def post(self, request, format=None, **kwargs):
+        params = parse(request)
+        video = Media.objects.get(pk=params['id'])
+        render_format = params['image_format']
+        force_scale = parse_force_scale(params.get('force_scale', None))
+        frames = [spec['frame'] for spec in params['frames']]
+        rois = [spec.get('roi') for spec in params['frames']]
+        if not any(rois):
+            rois = None
+        elif video.fps is not None:
+            # Uncropped frames use the whole frame as their roi
+            rois = [(1.0, 1.0, 0.0, 0.0) if roi is None else roi for roi in rois]
+
+        num_frames = 1 if video.num_frames is None else video.num_frames
+        for frame in frames:
+            if frame >= num_frames:
+                raise Exception(f"Frame {frame} is invalid. Maximum frame is {num_frames-1}")
+
+        # Errors after this point can only truncate the stream, so set up everything that
+        # can fail on bad input first.
+        temp_dir = tempfile.mkdtemp()
+        try:
+            media_util = MediaUtil(video, temp_dir, params.get('quality', None))
+        except:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        def _entries():
+            images = media_util.iter_frame_images(frames, rois, render_format, force_scale)
+            for idx, data in images:
+                yield f"{idx}_{frames[idx]}.{render_format}", data
+
+        response = streaming_response(zip_stream(_entries()), 'application/zip', temp_dir)
+        response['Content-Disposition'] = f'attachment; filename="{video.id}_frames.zip"'
+        return response
@@ -1,8 +1,14 @@
+import os
 import logging
 import tempfile
 import traceback
 import hashlib
+import datetime
 
+import pytz
+from redis.exceptions import LockError
+
+from ..cache import TatorCache
 from ..models import TemporaryFile
 from ..models import Media
 from ..serializers import TemporaryFileSerializer
@@ -14,6 +20,13 @@ from ._permissions import ProjectViewOnlyPermission
 
 logger = logging.getLogger(__name__)
 
+# Maximum time in seconds to wait for an identical clip request to finish.
+CLIP_LOCK_TIMEOUT = int(os.getenv('CLIP_LOCK_TIMEOUT', '600'))
+
+# Time in seconds after which the lock of a clip being rendered expires. This must be longer
+# than rendering takes so that identical requests do not render the clip again.
+CLIP_LOCK_TTL = int(os.getenv('CLIP_LOCK_TTL', '3600'))
+
 class GetClipAPI(BaseDetailView):
     schema = GetClipSchema()
     permission_classes = [ProjectViewOnlyPermission]
@@ -42,27 +55,60 @@ class GetClipAPI(BaseDetailView):
         h = hashlib.new('md5', f"{params}".encode())
         lookup = h.hexdigest()
 
-        # Disabling this for now, so we can force segments to be calculated
-        # #TODO worth revisiting 
-        # Check to see if we already made this clip
-        #matches=TemporaryFile.objects.filter(project=project, lookup=lookup)
-        #if matches.exists():
-        #    temp_file = matches[0]
-        #else:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            media_util = MediaUtil(video, temp_dir, quality)
-            fp, segments = media_util.get_clip(frame_ranges)
-            temp_file = TemporaryFile.from_local(fp, "clip.mp4", project, self.request.user, lookup=lookup, hours=24)
-
-        start_frames = []
-        end_frames = []
-        logger.info(segments)
-        for segment in segments:
-            start_frames.append(segment['frame_start'])
-            end_frames.append(segment['frame_start'] + segment['num_frames'] - 1)
+        # Check to see if we already made this clip. Identical concurrent requests wait for
+        # the first one to finish rendering and then use its clip.
+        temp_file = self._get_cached_clip(project, lookup)
+        if temp_file is None:
+            lock = TatorCache().lock(f'clip_{lookup}', CLIP_LOCK_TTL, CLIP_LOCK_TIMEOUT)
+            acquired = lock.acquire()
+            if not acquired:
+                logger.warning(f"Timed out waiting for clip {lookup}, rendering it again.")
+            try:
+                temp_file = self._get_cached_clip(project, lookup)
+                if temp_file is None:
+                    temp_file = self._make_clip(video, frame_ranges, quality, lookup)
+            finally:
+                if acquired:
+                    try:
+                        lock.release()
+                    except LockError:
+                        logger.warning(f"Lock of clip {lookup} expired before it was rendered!")
 
         response_data = {}
-        response_data['segment_start_frames'] = start_frames
-        response_data['segment_end_frames'] = end_frames
+        response_data.update(temp_file.segment_info)
         response_data['file'] = TemporaryFileSerializer(temp_file, context={"view": self}).data
         return response_data
+
+    @staticmethod
+    def _get_cached_clip(project, lookup):
+        """ Returns an unexpired clip with the given lookup, or None.
+        """
+        now = pytz.timezone("UTC").localize(datetime.datetime.utcnow())
+        matches = TemporaryFile.objects.filter(project=project, lookup=lookup,
+                                               eol_datetime__gt=now,
+                                               segment_info__isnull=False)
+        for temp_file in matches.order_by('-eol_datetime'):
+            if os.path.exists(temp_file.path):
+                return temp_file
+        return None
+
+    def _make_clip(self, video, frame_ranges, quality, lookup):
+        """ Renders a clip and saves it as a temporary file that expires in 24 hours.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            media_util = MediaUtil(video, temp_dir, quality)
+            fp, segments = media_util.get_clip(frame_ranges)
+
+            start_frames = []
+            end_frames = []
+            logger.info(segments)
+            for segment in segments:
+                start_frames.append(segment['frame_start'])
+                end_frames.append(segment['frame_start'] + segment['num_frames'] - 1)
+            segment_info = {
+                'segment_start_frames': start_frames,
+                'segment_end_frames': end_frames,
+            }
+            return TemporaryFile.from_local(fp, "clip.mp4", video.project, self.request.user,
+                                            lookup=lookup, hours=24, segment_info=segment_info,
+                                            move=True)
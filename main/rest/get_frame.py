@@ -1,5 +1,6 @@
 import tempfile
 import logging
+import shutil
 import traceback
 
 from rest_framework.response import Response
@@ -16,6 +17,8 @@ from ..schema import parse
 from ._base_views import BaseDetailView
 from ._media_util import MediaUtil
 from ._permissions import ProjectViewOnlyPermission
+from ._util import file_response
+from ._util import streaming_response
 
 logger = logging.getLogger(__name__)
 
@@ -54,9 +57,10 @@ class GetFrameAPI(BaseDetailView):
         roi = params.get('roi', None)
         quality = params.get('quality', None)
 
+        num_frames = 1 if video.num_frames is None else video.num_frames
         for frame in frames:
-            if int(frame) >= video.num_frames:
-                raise Exception(f"Frame {frame} is invalid. Maximum frame is {video.num_frames-1}")
+            if int(frame) >= num_frames:
+                raise Exception(f"Frame {frame} is invalid. Maximum frame is {num_frames-1}")
         tile_size = tile
 
         if tile and animate:
@@ -93,7 +97,15 @@ class GetFrameAPI(BaseDetailView):
 
 
 
-        with tempfile.TemporaryDirectory() as temp_dir:
+        if video.fps is None and not animate:
+            # Images are decoded, cropped and tiled in memory
+            media_util = MediaUtil(video, None, quality)
+            return media_util.get_image_tile(frames, roi_arg, tile_size,
+                                             render_format=self.request.accepted_renderer.format)
+
+        # Outputs are streamed to the client, which removes the temporary directory.
+        temp_dir = tempfile.mkdtemp()
+        try:
             media_util = MediaUtil(video, temp_dir, quality)
             if len(frames) > 1 and animate:
                 # Default to gif for animate, but mp4 is also supported
@@ -101,14 +113,18 @@ class GetFrameAPI(BaseDetailView):
                     pass
                 else:
                     self.request.accepted_renderer = GifRenderer()
-                gif_fp = media_util.get_animation(frames, roi_arg, fps=animate,
-                                                  render_format=self.request.accepted_renderer.format)
-                with open(gif_fp, 'rb') as data_file:
-                    response_data = data_file.read()
+                content_type = self.request.accepted_renderer.media_type
+                animation = media_util.get_animation(frames, roi_arg, fps=animate,
+                                                     render_format=self.request.accepted_renderer.format,
+                                                     stream=True)
+                if isinstance(animation, str):
+                    return file_response(animation, content_type, temp_dir)
+                return streaming_response(animation, content_type, temp_dir)
             else:
                 logger.info(f"Accepted format = {self.request.accepted_renderer.format}")
                 tiled_fp = media_util.get_tile_image(frames, roi_arg, tile_size,
                                                      render_format=self.request.accepted_renderer.format)
-                with open(tiled_fp, 'rb') as data_file:
-                    response_data = data_file.read()
-        return response_data
+                return file_response(tiled_fp, self.request.accepted_renderer.media_type, temp_dir)
+        except:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
@@ -27,6 +27,7 @@ from ._attributes import patch_attributes
 from ._attributes import bulk_patch_attributes
 from ._attributes import validate_attributes
 from ._util import bulk_create_from_generator
+from ._util import bulk_log_changes
 from ._util import computeRequiredFields
 from ._util import check_required_fields
 from ._permissions import ProjectViewOnlyPermission
@@ -170,22 +171,10 @@ class LeafListAPI(BaseListView):
         ts.bulk_add_documents(documents)
 
         # Create ChangeLogs
-        objs = (
-            ChangeLog(
-                project=project, user=self.request.user, description_of_change=leaf.create_dict
-            )
-            for leaf in leaves
-        )
-        change_logs = bulk_create_from_generator(objs, ChangeLog)
-
-        # Associate ChangeLogs with created objects
         ref_table = ContentType.objects.get_for_model(leaves[0])
         ids = [leaf.id for leaf in leaves]
-        objs = (
-            ChangeToObject(ref_table=ref_table, ref_id=ref_id, change_id=cl)
-            for ref_id, cl in zip(ids, change_logs)
-        )
-        bulk_create_from_generator(objs, ChangeToObject)
+        bulk_log_changes(project, self.request.user, ref_table, ids,
+                         [leaf.create_dict for leaf in leaves])
 
         # Return created IDs.
         return {'message': f'Successfully created {len(ids)} leaves!', 'id': ids}
@@ -211,18 +200,7 @@ class LeafListAPI(BaseListView):
             TatorSearch().delete(self.kwargs['project'], query)
 
             # Create ChangeLogs
-            objs = (
-                ChangeLog(project=project, user=self.request.user, description_of_change=dd)
-                for dd in delete_dicts
-            )
-            change_logs = bulk_create_from_generator(objs, ChangeLog)
-
-            # Associate ChangeLogs with deleted objects
-            objs = (
-                ChangeToObject(ref_table=ref_table, ref_id=ref_id, change_id=cl)
-                for ref_id, cl in zip(ref_ids, change_logs)
-            )
-            bulk_create_from_generator(objs, ChangeToObject)
+            bulk_log_changes(project, self.request.user, ref_table, ref_ids, delete_dicts)
 
         return {'message': f'Successfully deleted {count} leaves!'}
 
@@ -233,7 +211,7 @@ class LeafListAPI(BaseListView):
             # Get the current representation of the object for comparison
             original_dict = qs.first().model_dict
             new_attrs = validate_attributes(params, qs[0])
-            bulk_patch_attributes(new_attrs, qs)
+            ids = bulk_patch_attributes(new_attrs, qs)
 
             # Get one object from the queryset to create the change log
             obj = qs.first()
@@ -248,7 +226,7 @@ class LeafListAPI(BaseListView):
                 project=obj.project, user=self.request.user, description_of_change=change_dict
             )
             cl.save()
-            objs = (ChangeToObject(ref_table=ref_table, ref_id=o.id, change_id=cl) for o in qs)
+            objs = (ChangeToObject(ref_table=ref_table, ref_id=id_, change_id=cl) for id_ in ids)
             bulk_create_from_generator(objs, ChangeToObject)
 
         return {'message': f'Successfully updated {count} leaves!'}
@@ -1,5 +1,6 @@
 import logging
 import datetime
+import itertools
 from django.db.models import Subquery
 from django.db import transaction
 from django.contrib.contenttypes.models import ContentType
@@ -19,6 +20,8 @@ from ..models import Version
 from ..models import database_qs
 from ..models import database_query_ids
 from ..search import TatorSearch
+from ..renderers import stream_csv
+from ..renderers import stream_json
 from ..schema import LocalizationListSchema
 from ..schema import LocalizationDetailSchema
 from ..schema import parse
@@ -32,14 +35,49 @@ from ._attributes import patch_attributes
 from ._attributes import bulk_patch_attributes
 from ._attributes import validate_attributes
 from ._util import bulk_create_from_generator
+from ._util import bulk_log_changes
+from ._util import bulk_copy_from_generator
 from ._util import computeRequiredFields
 from ._util import check_required_fields
+from ._util import get_attribute_names
+from ._util import iter_chunks
+from ._util import streaming_response
 from ._permissions import ProjectEditPermission
+from .localization_graphic import invalidate_crops
 
 logger = logging.getLogger(__name__)
 
 LOCALIZATION_PROPERTIES = list(localization_schema['properties'].keys())
 
+def _convert_for_csv(response_data):
+    """ Flattens attributes and replaces user and media ids with email and media name.
+    """
+    user_ids = set([d['user'] for d in response_data])
+    users = list(User.objects.filter(id__in=user_ids).values('id','email'))
+    email_dict = {}
+    for user in users:
+        email_dict[user['id']] = user['email']
+
+    media_ids = set([d['media'] for d in response_data])
+    medias = list(Media.objects.filter(id__in=media_ids).values('id','name'))
+    filename_dict = {}
+    for media in medias:
+        filename_dict[media['id']] = media['name']
+
+    for element in response_data:
+        del element['meta']
+
+        oldAttributes = element['attributes']
+        del element['attributes']
+        element.update(oldAttributes)
+
+        user_id = element['user']
+        media_id = element['media']
+
+        element['user'] = email_dict[user_id]
+        element['media'] = filename_dict[media_id]
+    return response_data
+
 class LocalizationListAPI(BaseListView):
     """ Interact with list of localizations.
 
@@ -57,37 +95,33 @@ class LocalizationListAPI(BaseListView):
 
     def _get(self, params):
         qs = get_annotation_queryset(self.kwargs['project'], params, 'localization')
+        if params.get('stream'):
+            return self._stream(params, qs)
         response_data = list(qs.values(*LOCALIZATION_PROPERTIES))
 
         # Adjust fields for csv output.
         if self.request.accepted_renderer.format == 'csv':
-            # CSV creation requires a bit more
-            user_ids = set([d['user'] for d in response_data])
-            users = list(User.objects.filter(id__in=user_ids).values('id','email'))
-            email_dict = {}
-            for user in users:
-                email_dict[user['id']] = user['email']
-
-            media_ids = set([d['media'] for d in response_data])
-            medias = list(Media.objects.filter(id__in=media_ids).values('id','name'))
-            filename_dict = {}
-            for media in medias:
-                filename_dict[media['id']] = media['name']
-
-            for element in response_data:
-                del element['meta']
-
-                oldAttributes = element['attributes']
-                del element['attributes']
-                element.update(oldAttributes)
-
-                user_id = element['user']
-                media_id = element['media']
-
-                element['user'] = email_dict[user_id]
-                element['media'] = filename_dict[media_id]
+            response_data = _convert_for_csv(response_data)
         return response_data
 
+    def _stream(self, params, qs):
+        """ Returns a response that streams localizations in chunks read from a server-side
+            cursor.
+        """
+        renderer = self.request.accepted_renderer
+        chunks = iter_chunks(qs.values(*LOCALIZATION_PROPERTIES))
+        if renderer.format == 'csv':
+            type_qs = LocalizationType.objects.filter(project=self.kwargs['project'])
+            if params.get('type') is not None:
+                type_qs = type_qs.filter(pk=params['type'])
+            field_names = [name for name in LOCALIZATION_PROPERTIES
+                           if name not in ['meta', 'attributes']]
+            field_names += get_attribute_names(type_qs)
+            rows = itertools.chain.from_iterable(_convert_for_csv(chunk) for chunk in chunks)
+            return streaming_response(stream_csv(rows, field_names), renderer.media_type)
+        rows = itertools.chain.from_iterable(chunks)
+        return streaming_response(stream_json(rows), 'application/json')
+
     def _post(self, params):
         # Check that we are getting a localization list.
         if 'body' in params:
@@ -161,6 +195,16 @@ class LocalizationListAPI(BaseListView):
                                             loc)
                       for loc in loc_specs]
 
+        # Make sure all parents exist.
+        parent_ids = set([loc['parent'] for loc in loc_specs if loc.get('parent')])
+        if parent_ids:
+            found = set(Localization.objects.filter(pk__in=parent_ids)\
+                        .values_list('id', flat=True))
+            missing = parent_ids - found
+            if missing:
+                raise Localization.DoesNotExist(f"Parent localizations {sorted(missing)} "
+                                                f"do not exist!")
+
         # Create the localization objects.
         objs = (
             Localization(
@@ -172,9 +216,7 @@ class LocalizationListAPI(BaseListView):
                 created_by=self.request.user,
                 modified_by=self.request.user,
                 version=versions[loc_spec.get("version", None)],
-                parent=Localization.objects.get(pk=loc_spec.get("parent"))
-                if loc_spec.get("parent")
-                else None,
+                parent_id=loc_spec.get("parent") or None,
                 x=loc_spec.get("x", None),
                 y=loc_spec.get("y", None),
                 u=loc_spec.get("u", None),
@@ -185,7 +227,7 @@ class LocalizationListAPI(BaseListView):
             )
             for loc_spec, attrs in zip(loc_specs, attr_specs)
         )
-        localizations = bulk_create_from_generator(objs, Localization)
+        localizations = bulk_copy_from_generator(objs, Localization)
 
         # Build ES documents.
         ts = TatorSearch()
@@ -198,22 +240,10 @@ class LocalizationListAPI(BaseListView):
         ts.bulk_add_documents(documents)
 
         # Create ChangeLogs
-        objs = (
-            ChangeLog(
-                project=project, user=self.request.user, description_of_change=loc.create_dict
-            )
-            for loc in localizations
-        )
-        change_logs = bulk_create_from_generator(objs, ChangeLog)
-
-        # Associate ChangeLogs with created objects
         ref_table = ContentType.objects.get_for_model(localizations[0])
         ids = [loc.id for loc in localizations]
-        objs = (
-            ChangeToObject(ref_table=ref_table, ref_id=ref_id, change_id=cl)
-            for ref_id, cl in zip(ids, change_logs)
-        )
-        bulk_create_from_generator(objs, ChangeToObject)
+        bulk_log_changes(project, self.request.user, ref_table, ids,
+                         [loc.create_dict for loc in localizations])
 
         # Return created IDs.
         return {'message': f'Successfully created {len(ids)} localizations!', 'id': ids}
@@ -240,18 +270,7 @@ class LocalizationListAPI(BaseListView):
             TatorSearch().delete(self.kwargs['project'], query)
 
             # Create ChangeLogs
-            objs = (
-                ChangeLog(project=project, user=self.request.user, description_of_change=dd)
-                for dd in delete_dicts
-            )
-            change_logs = bulk_create_from_generator(objs, ChangeLog)
-
-            # Associate ChangeLogs with deleted objects
-            objs = (
-                ChangeToObject(ref_table=ref_table, ref_id=ref_id, change_id=cl)
-                for ref_id, cl in zip(ref_ids, change_logs)
-            )
-            bulk_create_from_generator(objs, ChangeToObject)
+            bulk_log_changes(project, self.request.user, ref_table, ref_ids, delete_dicts)
 
         return {'message': f'Successfully deleted {count} localizations!'}
 
@@ -266,10 +285,10 @@ class LocalizationListAPI(BaseListView):
             first_id = obj.id
             entity_type = obj.meta
             new_attrs = validate_attributes(params, qs[0])
-            bulk_patch_attributes(new_attrs, qs)
+            fields = {'modified_by': self.request.user}
             if patched_version is not None:
-                qs.update(version=patched_version)
-            qs.update(modified_by=self.request.user)
+                fields['version'] = patched_version
+            ids = bulk_patch_attributes(new_attrs, qs, **fields)
 
             # Get one object from the queryset to create the change log
             obj = Localization.objects.get(pk=first_id)
@@ -284,7 +303,7 @@ class LocalizationListAPI(BaseListView):
                 project=obj.project, user=self.request.user, description_of_change=change_dict
             )
             cl.save()
-            objs = (ChangeToObject(ref_table=ref_table, ref_id=o.id, change_id=cl) for o in qs)
+            objs = (ChangeToObject(ref_table=ref_table, ref_id=id_, change_id=cl) for id_ in ids)
             bulk_create_from_generator(objs, ChangeToObject)
 
         return {'message': f'Successfully updated {count} localizations!'}
@@ -376,6 +395,12 @@ class LocalizationDetailAPI(BaseDetailView):
             obj.thumbnail_image.save()
 
         obj.save()
+
+        # If the localization moved; cached graphics are expired
+        if any(params.get(key) is not None for key in ['frame', 'x', 'y', 'width', 'height',
+                                                        'u', 'v']):
+            transaction.on_commit(lambda: invalidate_crops(obj))
+
         cl = ChangeLog(
             project=obj.project,
             user=self.request.user,
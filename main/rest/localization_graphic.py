@@ -1,6 +1,9 @@
 from typing import Tuple
 from types import SimpleNamespace
+from collections import defaultdict
 import logging
+import hashlib
+import json
 import tempfile
 import traceback
 
@@ -14,15 +17,279 @@ from ..renderers import JpegRenderer
 from ..renderers import GifRenderer
 from ..renderers import Mp4Renderer
 from ..schema import LocalizationGraphicSchema
+from ..schema import LocalizationGraphicListSchema
 from ..schema import parse
+from ..store import get_tator_store
+from ._base_views import BaseListView
 from ._base_views import BaseDetailView
 from ._media_util import MediaUtil
 from ._permissions import ProjectViewOnlyPermission
+from ._util import get_download_urls
 from .temporary_file import TemporaryFileDetailAPI
 
 logger = logging.getLogger(__name__)
 
 
+def get_margins(localization_type: str, params: dict):
+    """ Returns x/y margins to use based on the provided parameters and localization object
+
+    Used by the localization graphic endpoints and crop cache
+
+    Return(s):
+        margins: SimpleNamespace
+            x: int
+                Pixel margin for x/horizontal direction
+            y: int
+                Pixel margin for y/vertical direction
+    """
+
+    margins = None
+
+    if params.get(LocalizationGraphicSchema.PARAMS_USE_DEFAULT_MARGINS, None):
+
+        if localization_type == 'dot':
+            margins = LocalizationGraphicSchema.DEFAULT_MARGIN_DOT
+
+        elif localization_type == 'line':
+            margins = LocalizationGraphicSchema.DEFAULT_MARGIN_LINE
+
+        elif localization_type == 'box':
+            margins = LocalizationGraphicSchema.DEFAULT_MARGIN_BOX
+
+        else:
+            raise Exception(f'Error: Invalid meta.dtype detected {localization_type}')
+
+    else:
+
+        margin_x = params.get(LocalizationGraphicSchema.PARAMS_MARGIN_X, None)
+        margin_y = params.get(LocalizationGraphicSchema.PARAMS_MARGIN_Y, None)
+        margins = SimpleNamespace(x=margin_x, y=margin_y)
+
+    assert margins.x >= 0 and margins.y >= 0
+
+    return margins
+
+def get_roi(
+        obj: str,
+        params: dict,
+        media_width: int,
+        media_height: int) -> Tuple[float, float, float, float]:
+    """ Returns the ROI to extract from the media for the given parameters
+
+    Args:
+        obj: Localization object
+            Localization object that is the region of interest
+
+        params: dict
+            Parameters defined by the schema
+
+        media_width: int
+            Pixels of media the localization object is associated with
+
+        media_height: int
+            Pixels of media the localization object is associated with
+
+    Returns:
+        roi: tuple
+            float: width (relative)
+            float: height (relative)
+            float: x (relative)
+            float: y (relative)
+
+    """
+
+    # Get the initial image based on the localization type and requested margins
+    localization_type = obj.meta.dtype
+    margins_pixels = get_margins(localization_type=localization_type, params=params)
+
+    # The roi input is done with normalized arguments. But the margins provided
+    # are in pixels. So we've got to convert.
+    margins_rel = SimpleNamespace(x=margins_pixels.x / media_width, y=margins_pixels.y / media_height)
+
+    # Take the position information available and apply the margin.
+    # The stored position information is normalized, so we will set it to the
+    # provided media pixel width/height, apply the appropriate region of interest (ROI)
+    # information, then normalize back since the media_utils requires the ROI data
+    # in that format.
+    #
+    # Position information available per localization type:
+    #   Point/dot: x, y
+    #   Line: x, y, u, v
+    #   Box: x, y, width, height
+    #
+    # Region of interest format: width, height, x, y
+    if localization_type == 'dot':
+
+        roi_x = obj.x * media_width
+        roi_y = obj.y * media_height
+
+        roi = [2*margins_pixels.x + 1,
+               2*margins_pixels.y + 1,
+               roi_x - margins_pixels.x,
+               roi_y - margins_pixels.y]
+
+    elif localization_type == 'line':
+
+        x = obj.x * media_width
+        y = obj.y * media_height
+        u = obj.u * media_width
+        v = obj.v * media_height
+
+        point_a = SimpleNamespace(x=x, y=y)
+        point_b = SimpleNamespace(x=x+u, y=y+v)
+
+        width = abs(point_b.x - point_a.x)
+        height = abs(point_b.y - point_a.y)
+
+        roi_x = min(point_a.x, point_b.x)
+        roi_y = min(point_a.y, point_b.y)
+
+        roi = [width + 2*margins_pixels.x,
+               height + 2*margins_pixels.y,
+               roi_x - margins_pixels.x,
+               roi_y - margins_pixels.y]
+
+    elif localization_type == 'box':
+
+        roi_x = obj.x * media_width
+        roi_y = obj.y * media_height
+        roi_width = obj.width * media_width
+        roi_height = obj.height * media_height
+
+        roi = [roi_width + 2*margins_pixels.x,
+               roi_height + 2*margins_pixels.y,
+               roi_x - margins_pixels.x,
+               roi_y - margins_pixels.y]
+
+    else:
+        raise Exception(f"Invalid meta.dtype detected {localization_type}")
+
+    # Don't allow any single pixel width/heights
+    # Adding the 0.1 to deal with floating point precision
+    roi[0] = max(roi[0], 2.1)
+    roi[1] = max(roi[1], 2.1)
+
+    # Now, normalize the ROI
+    roi[0] = roi[0] / media_width
+    roi[2] = roi[2] / media_width
+
+    roi[1] = roi[1] / media_height
+    roi[3] = roi[3] / media_height
+
+    # Force the ROI to be within the image
+    for idx, roi_entry in enumerate(roi):
+        if roi_entry > 1.0:
+            roi[idx] = 1.0
+        elif roi_entry < 0.0:
+            roi[idx] = 0.0
+
+    return tuple(roi)
+
+def parse_force_scale(force_scale):
+    """ Converts a force_scale parameter such as '100x100' into a (width, height) tuple
+    """
+    if force_scale is not None:
+        img_width_height = force_scale.split('x')
+        assert len(img_width_height) == 2
+        requested_width = int(img_width_height[0])
+        requested_height = int(img_width_height[1])
+        assert requested_width > 0
+        assert requested_height > 0
+        force_scale = (requested_width, requested_height)
+    return force_scale
+
+def _crop_prefix(project, media_id):
+    return f"{project.organization_id}/{project.pk}/{media_id}/crops/"
+
+def crop_path(obj, params: dict, force_scale, render_format: str) -> str:
+    """ Returns the object key of a cached crop. The key is made from the localization id
+        and a hash of its geometry, the margins and the scale, so a moved localization never
+        hits a stale crop.
+    """
+    margins = get_margins(localization_type=obj.meta.dtype, params=params)
+    geometry = [obj.frame, obj.x, obj.y, obj.width, obj.height, obj.u, obj.v]
+    spec = json.dumps([geometry, [margins.x, margins.y], force_scale])
+    digest = hashlib.sha256(spec.encode()).hexdigest()[:32]
+    return f"{_crop_prefix(obj.project, obj.media_id)}{obj.pk}/{digest}.{render_format}"
+
+def _list_crops(tator_store, prefix):
+    """ Yields paths of all cached crops under a prefix, paging through the listing.
+    """
+    key_prefix = tator_store._path_to_key(prefix)
+    last_key = None
+    while True:
+        kwargs = {}
+        if last_key:
+            kwargs["StartAfter"] = last_key
+        obj_list = tator_store.list_objects_v2(key_prefix, **kwargs)
+        if not obj_list:
+            break
+        last_key = obj_list[-1]['Key']
+        for cached in obj_list:
+            yield prefix + cached['Key'][len(key_prefix):]
+
+def invalidate_crops(obj):
+    """ Deletes cached crops of a localization.
+    """
+    tator_store = get_tator_store(obj.project.bucket)
+    prefix = f"{_crop_prefix(obj.project, obj.media_id)}{obj.pk}/"
+    for path in list(_list_crops(tator_store, prefix)):
+        tator_store.delete_object(path)
+
+def _render_crops(media, localizations, params: dict, force_scale, render_format: str) -> list:
+    """ Renders crops of localizations belonging to one media, decoding each segment or
+        downloading the image only once.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        media_util = MediaUtil(video=media, temp_dir=temp_dir)
+        rois = [get_roi(obj=obj,
+                        params=params,
+                        media_width=media_util.getWidth(),
+                        media_height=media_util.getHeight())
+                for obj in localizations]
+        if media_util.isVideo():
+            images = media_util.get_frame_images(
+                frames=[obj.frame for obj in localizations],
+                rois=rois,
+                render_format=render_format,
+                force_scale=force_scale)
+        else:
+            images = media_util.get_cropped_images(
+                rois=rois,
+                render_format=render_format,
+                force_scale=force_scale)
+    if images is None:
+        raise RuntimeError(f"Failed to render crops for media {media.id}!")
+    return images
+
+def render_crops(localizations, params: dict, force_scale, render_format: str) -> dict:
+    """ Renders and caches crops of the given localizations that are not already cached,
+        in one pass per media. Localizations must belong to the same project.
+
+        :returns: Dict mapping localization id to the object key of its crop.
+    """
+    by_media = defaultdict(list)
+    for obj in localizations:
+        by_media[obj.media_id].append(obj)
+
+    keys = {}
+    tator_store = None
+    for media_id, objs in by_media.items():
+        if tator_store is None:
+            tator_store = get_tator_store(objs[0].project.bucket)
+        paths = {obj.pk: crop_path(obj, params, force_scale, render_format) for obj in objs}
+        keys.update(paths)
+        # Crops of a media share a prefix, so they are checked with one listing instead of a
+        # request per localization.
+        cached = set(_list_crops(tator_store, _crop_prefix(objs[0].project, media_id)))
+        missing = [obj for obj in objs if paths[obj.pk] not in cached]
+        if missing:
+            logger.info(f"Rendering {len(missing)} crops for media {media_id}...")
+            images = _render_crops(objs[0].media, missing, params, force_scale, render_format)
+            for obj, image in zip(missing, images):
+                tator_store.put_string(paths[obj.pk], image)
+    return keys
+
 class LocalizationGraphicAPI(BaseDetailView):
     """ Endpoint that retrieves an image of the requested localization
     """
@@ -53,210 +320,48 @@ class LocalizationGraphicAPI(BaseDetailView):
                 self.request.accepted_renderer.format),
             status=status_obj)
 
-    def _getMargins(self, localization_type: str, params: dict):
-        """ Returns x/y margins to use based on the provided parameters and localization object
-
-        Private helper method used by _get()
-
-        Return(s):
-            margins: SimpleNamespace
-                x: int
-                    Pixel margin for x/horizontal direction
-                y: int
-                    Pixel margin for y/vertical direction
-        """
-
-        margins = None
-
-        if params.get(self.schema.PARAMS_USE_DEFAULT_MARGINS, None):
-
-            if localization_type == 'dot':
-                margins = self.schema.DEFAULT_MARGIN_DOT
-
-            elif localization_type == 'line':
-                margins = self.schema.DEFAULT_MARGIN_LINE
-
-            elif localization_type == 'box':
-                margins = self.schema.DEFAULT_MARGIN_BOX
-
-            else:
-                raise Exception(f'Error: Invalid meta.dtype detected {localization_type}')
-
-        else:
-
-            margin_x = params.get(self.schema.PARAMS_MARGIN_X, None)
-            margin_y = params.get(self.schema.PARAMS_MARGIN_Y, None)
-            margins = SimpleNamespace(x=margin_x, y=margin_y)
-
-        assert margins.x >= 0 and margins.y >= 0
-
-        return margins
-
-    def _getRoi(
-            self,
-            obj: str,
-            params: dict,
-            media_width: int,
-            media_height: int) -> Tuple[float, float, float, float]:
-        """ Returns the ROI to extract from the media for the given parameters
-
-        Args:
-            obj: Localization object
-                Localization object that is the region of interest
-
-            params: dict
-                Parameters defined by the schema
-
-            media_width: int
-                Pixels of media the localization object is associated with
-
-            media_height: int
-                Pixels of media the localization object is associated with
-
-        Returns:
-            roi: tuple
-                float: width (relative)
-                float: height (relative)
-                float: x (relative)
-                float: y (relative)
-
-        """
-
-        # Get the initial image based on the localization type and requested margins
-        localization_type = obj.meta.dtype
-        margins_pixels = self._getMargins(localization_type=localization_type, params=params)
-
-        # The roi input is done with normalized arguments. But the margins provided
-        # are in pixels. So we've got to convert.
-        margins_rel = SimpleNamespace(x=margins_pixels.x / media_width, y=margins_pixels.y / media_height)
-
-        # Take the position information available and apply the margin.
-        # The stored position information is normalized, so we will set it to the
-        # provided media pixel width/height, apply the appropriate region of interest (ROI)
-        # information, then normalize back since the media_utils requires the ROI data
-        # in that format.
-        #
-        # Position information available per localization type:
-        #   Point/dot: x, y
-        #   Line: x, y, u, v
-        #   Box: x, y, width, height
-        #
-        # Region of interest format: width, height, x, y
-        if localization_type == 'dot':
-
-            roi_x = obj.x * media_width
-            roi_y = obj.y * media_height
-
-            roi = [2*margins_pixels.x + 1,
-                   2*margins_pixels.y + 1,
-                   roi_x - margins_pixels.x,
-                   roi_y - margins_pixels.y]
-
-        elif localization_type == 'line':
-
-            x = obj.x * media_width
-            y = obj.y * media_height
-            u = obj.u * media_width
-            v = obj.v * media_height
-
-            point_a = SimpleNamespace(x=x, y=y)
-            point_b = SimpleNamespace(x=x+u, y=y+v)
-
-            width = abs(point_b.x - point_a.x)
-            height = abs(point_b.y - point_a.y)
-
-            roi_x = min(point_a.x, point_b.x)
-            roi_y = min(point_a.y, point_b.y)
-
-            roi = [width + 2*margins_pixels.x,
-                   height + 2*margins_pixels.y,
-                   roi_x - margins_pixels.x,
-                   roi_y - margins_pixels.y]
-
-        elif localization_type == 'box':
-
-            roi_x = obj.x * media_width
-            roi_y = obj.y * media_height
-            roi_width = obj.width * media_width
-            roi_height = obj.height * media_height
-
-            roi = [roi_width + 2*margins_pixels.x,
-                   roi_height + 2*margins_pixels.y,
-                   roi_x - margins_pixels.x,
-                   roi_y - margins_pixels.y]
-
-        else:
-            raise Exception(f"Invalid meta.dtype detected {localization_type}")
-
-        # Don't allow any single pixel width/heights
-        # Adding the 0.1 to deal with floating point precision
-        roi[0] = max(roi[0], 2.1)
-        roi[1] = max(roi[1], 2.1)
-
-        # Now, normalize the ROI
-        roi[0] = roi[0] / media_width
-        roi[2] = roi[2] / media_width
-
-        roi[1] = roi[1] / media_height
-        roi[3] = roi[3] / media_height
-
-        # Force the ROI to be within the image
-        for idx, roi_entry in enumerate(roi):
-            if roi_entry > 1.0:
-                roi[idx] = 1.0
-            elif roi_entry < 0.0:
-                roi[idx] = 0.0
-
-        return tuple(roi)
-
     def _get(self, params: dict):
         """ Overridden method. Please refer to parent's documentation.
         """
 
         # Get the localization associated with the given ID
-        obj = Localization.objects.get(pk=params['id'])
+        obj = Localization.objects.select_related('meta', 'media', 'project').get(pk=params['id'])
+        render_format = self.request.accepted_renderer.format
 
         # Extract the force image size argument and assert if there's a problem with the provided inputs
-        force_image_size = params.get(self.schema.PARAMS_IMAGE_SIZE, None)
-        if force_image_size is not None:
-            img_width_height = force_image_size.split('x')
-            assert len(img_width_height) == 2
-            requested_width = int(img_width_height[0])
-            requested_height = int(img_width_height[1])
-            assert requested_width > 0
-            assert requested_height > 0
-            force_image_size = (requested_width, requested_height)
+        force_image_size = parse_force_scale(params.get(self.schema.PARAMS_IMAGE_SIZE, None))
 
-        # By reaching here, it's expected that the graphics mode is to create a new
-        # thumbnail using the provided parameters. That new thumbnail is returned
-        with tempfile.TemporaryDirectory() as temp_dir:
-
-            media_util = MediaUtil(video=obj.media, temp_dir=temp_dir)
-
-            roi = self._getRoi(
-                obj=obj,
-                params=params,
-                media_width=media_util.getWidth(),
-                media_height=media_util.getHeight())
-
-            if media_util.isVideo():
-                # We will only pass a single frame and corresponding roi into this
-                # so the expected output is only one tile instead of many
-                image_path = media_util.get_tile_image(
-                    frames=[obj.frame],
-                    rois=[roi],
-                    tile_size=None,
-                    render_format=self.request.accepted_renderer.format,
-                    force_scale=force_image_size)
-
-                with open(image_path, 'rb') as data_file:
-                    response_data = data_file.read()
-
-            else:
-                # Grab the ROI from the image
-                response_data = media_util.get_cropped_image(
-                    roi=roi,
-                    render_format=self.request.accepted_renderer.format,
-                    force_scale=force_image_size)
+        # Serve the crop from object storage if it was rendered before
+        tator_store = get_tator_store(obj.project.bucket)
+        path = crop_path(obj, params, force_image_size, render_format)
+        if tator_store.check_key(path):
+            return tator_store.get_object(path)
 
+        # By reaching here, it's expected that the graphics mode is to create a new
+        # thumbnail using the provided parameters. That new thumbnail is cached and returned
+        response_data = _render_crops(obj.media, [obj], params, force_image_size, render_format)[0]
+        tator_store.put_string(path, response_data)
         return response_data
+
+class LocalizationGraphicListAPI(BaseListView):
+    """ Renders thumbnail images of many localizations in one pass per media.
+
+        Crops are cached in object storage and reused by this endpoint and
+        LocalizationGraphic. Returns a download url for the crop of each localization.
+    """
+    schema = LocalizationGraphicListSchema()
+    permission_classes = [ProjectViewOnlyPermission]
+    http_method_names = ['post']
+
+    def _post(self, params: dict):
+        render_format = params['image_format']
+        force_scale = parse_force_scale(params.get(self.schema.PARAMS_IMAGE_SIZE, None))
+        ids = params['ids']
+        localizations = Localization.objects.filter(project=params['project'], pk__in=ids,
+                                                    deleted=False)
+        localizations = list(localizations.select_related('meta', 'media', 'project'))
+        keys = render_crops(localizations, params, force_scale, render_format)
+        tator_store = get_tator_store(localizations[0].project.bucket) if localizations else None
+        urls = get_download_urls(list(keys.values()), params['expiration'], {}, tator_store)
+        return [{'id': id_, 'key': keys[id_], 'url': urls[keys[id_]]}
+                for id_ in ids if id_ in keys]
@@ -33,9 +33,10 @@ from ..schema import MediaListSchema, MediaDetailSchema, parse
 from ..schema.components import media as media_schema
 from ..notify import Notify
 from ..download import download_file
-from ..store import get_tator_store, get_storage_lookup
+from ..store import get_tator_store
 
-from ._util import bulk_create_from_generator, computeRequiredFields, check_required_fields
+from ._util import bulk_create_from_generator, bulk_log_changes, computeRequiredFields, \
+                   check_required_fields, presign_media
 from ._base_views import BaseListView, BaseDetailView
 from ._media_query import get_media_queryset, get_media_es_query
 from ._attributes import bulk_patch_attributes, patch_attributes, validate_attributes
@@ -64,37 +65,6 @@ def _get_next_archive_state(desired_archive_state, last_archive_state):
     raise ValueError(f"Received invalid value '{desired_archive_state}' for archive_state")
 
 
-def _presign(expiration, medias, fields=None):
-    """ Replaces specified media fields with presigned urls.
-    """
-    # First get resources referenced by the given media.
-    fields = fields or ["archival", "streaming", "audio", "image", "thumbnail", "thumbnail_gif", "attachment"]
-    media_ids = [media['id'] for media in medias]
-    resources = Resource.objects.filter(media__in=media_ids)
-    store_lookup = get_storage_lookup(resources)
-
-    # Get replace all keys with presigned urls.
-    for media_idx, media in enumerate(medias):
-        if media.get("media_files") is None:
-            continue
-
-        for field in fields:
-            if field not in media["media_files"]:
-                continue
-
-            for idx, media_def in enumerate(media["media_files"][field]):
-                tator_store = store_lookup[media_def["path"]]
-                media_def["path"] = tator_store.get_download_url(media_def["path"], expiration)
-                if field == "streaming":
-                    if "segment_info" in media_def:
-                        media_def["segment_info"] = tator_store.get_download_url(
-                            media_def["segment_info"], expiration
-                        )
-                    else:
-                        logger.warning(
-                            f"No segment file in media {media['id']} for file {media_def['path']}!"
-                        )
-
 def _save_image(url, media_obj, project_obj, role):
     """
     Downloads an image, uploads it to the appropriate S3 location and returns an updated media
@@ -160,7 +130,7 @@ class MediaListAPI(BaseListView):
         response_data = list(qs.values(*MEDIA_PROPERTIES))
         presigned = params.get('presigned')
         if presigned is not None:
-            _presign(presigned, response_data)
+            presign_media(presigned, response_data)
         return response_data
 
     def _post(self, params):
@@ -418,18 +388,7 @@ class MediaListAPI(BaseListView):
             TatorSearch().delete(self.kwargs['project'], {'query': {'ids': {'values': state_ids}}})
 
             # Create ChangeLogs
-            objs = (
-                ChangeLog(project=project, user=self.request.user, description_of_change=dd)
-                for dd in delete_dicts
-            )
-            change_logs = bulk_create_from_generator(objs, ChangeLog)
-
-            # Associate ChangeLogs with deleted objects
-            objs = (
-                ChangeToObject(ref_table=ref_table, ref_id=ref_id, change_id=cl)
-                for ref_id, cl in zip(ref_ids, change_logs)
-            )
-            bulk_create_from_generator(objs, ChangeToObject)
+            bulk_log_changes(project, self.request.user, ref_table, ref_ids, delete_dicts)
         return {'message': f'Successfully deleted {count} medias!'}
 
     def _patch(self, params):
@@ -458,10 +417,9 @@ class MediaListAPI(BaseListView):
                 obj = qs.first()
                 ref_table = ContentType.objects.get_for_model(obj)
                 original_dict = obj.model_dict
-                bulk_patch_attributes(new_attrs, qs)
+                ids_to_update = bulk_patch_attributes(new_attrs, qs)
                 query = get_media_es_query(params["project"], params)
                 ts.update(self.kwargs["project"], obj.meta, query, new_attrs)
-                qs = Media.objects.filter(pk__in=ids_to_update)
                 obj = Media.objects.get(id=original_dict["id"])
                 change_dict = obj.change_dict(original_dict)
                 # Create the ChangeLog entry and associate it with all objects in the queryset
@@ -469,7 +427,10 @@ class MediaListAPI(BaseListView):
                     project=obj.project, user=self.request.user, description_of_change=change_dict
                 )
                 cl.save()
-                objs = (ChangeToObject(ref_table=ref_table, ref_id=o.id, change_id=cl) for o in qs)
+                objs = (
+                    ChangeToObject(ref_table=ref_table, ref_id=id_, change_id=cl)
+                    for id_ in ids_to_update
+                )
                 bulk_create_from_generator(objs, ChangeToObject)
                 count = max(count, attr_count)
 
@@ -562,7 +523,7 @@ class MediaDetailAPI(BaseDetailView):
         response_data = list(qs.values(*MEDIA_PROPERTIES))
         presigned = params.get('presigned')
         if presigned is not None:
-            _presign(presigned, response_data)
+            presign_media(presigned, response_data)
         return response_data[0]
 
     def _patch(self, params):
@@ -650,7 +611,7 @@ class MediaDetailAPI(BaseDetailView):
                     )
 
         obj = Media.objects.get(pk=params['id'], deleted=False)
-        TatorSearch().create_document(obj)
+        TatorSearch().queue_document(obj)
         if 'attributes' in params:
             if obj.meta.dtype == 'image':
                 for localization in obj.localization_thumbnail_image.all():
@@ -26,9 +26,10 @@ from ..models import (
 from ..schema import PermalinkSchema, parse
 from ..schema.components import media as media_schema
 from ..download import download_file
-from ..store import get_tator_store, get_storage_lookup
+from ..store import get_tator_store
 
 from ._base_views import process_exception
+from ._util import presign_media
 from ._permissions import ProjectTransferPermission
 
 import sys
@@ -37,37 +38,6 @@ logger = logging.getLogger(__name__)
 
 MEDIA_PROPERTIES = list(media_schema['properties'].keys())
 
-def _presign(expiration, medias, fields=None):
-    """ Replaces specified media fields with presigned urls.
-    """
-    # First get resources referenced by the given media.
-    fields = fields or ["archival", "streaming", "audio", "image", "thumbnail", "thumbnail_gif", "attachment"]
-    media_ids = [media['id'] for media in medias]
-    resources = Resource.objects.filter(media__in=media_ids)
-    storage_lookup = get_storage_lookup(resources)
-
-    # Get replace all keys with presigned urls.
-    for _, media in enumerate(medias):
-        if media.get("media_files") is None:
-            continue
-
-        for field in fields:
-            if field not in media["media_files"]:
-                continue
-
-            for _, media_def in enumerate(media["media_files"][field]):
-                tator_store = storage_lookup[media_def["path"]]
-                media_def["path"] = tator_store.get_download_url(media_def["path"], expiration)
-                if field == "streaming":
-                    if "segment_info" in media_def:
-                        media_def["segment_info"] = tator_store.get_download_url(
-                            media_def["segment_info"], expiration
-                        )
-                    else:
-                        logger.warning(
-                            f"No segment file in media {media['id']} for file {media_def['path']}!"
-                        )
-
 class PermalinkAPI(APIView):
     """ Provide a permalink to an object-store resource
 
@@ -100,7 +70,7 @@ class PermalinkAPI(APIView):
             raise Http404
         response_data = list(qs.values(*MEDIA_PROPERTIES))
         # Use 24-hour URLS
-        _presign(24*3600, response_data)
+        presign_media(24*3600, response_data)
 
         element = params['element']
         if element == 'auto':
@@ -22,6 +22,8 @@ from ..models import InterpolationMethods
 from ..models import database_qs
 from ..models import database_query_ids
 from ..search import TatorSearch
+from ..renderers import stream_csv
+from ..renderers import stream_json
 from ..schema import StateListSchema
 from ..schema import StateDetailSchema
 from ..schema import MergeStatesSchema
@@ -36,8 +38,13 @@ from ._attributes import patch_attributes
 from ._attributes import bulk_patch_attributes
 from ._attributes import validate_attributes
 from ._util import bulk_create_from_generator
+from ._util import bulk_log_changes
+from ._util import bulk_copy_from_generator
 from ._util import computeRequiredFields
 from ._util import check_required_fields
+from ._util import get_attribute_names
+from ._util import iter_chunks
+from ._util import streaming_response
 from ._permissions import ProjectEditPermission
 
 logger = logging.getLogger(__name__)
@@ -65,6 +72,34 @@ def _fill_m2m(response_data):
         state['media'] = media.get(state['id'], [])
     return response_data
 
+def _convert_for_csv(response_data):
+    """ Flattens attributes and replaces media ids with media names. The email of the last
+        user to modify each state is added as `user`.
+    """
+    user_ids = set([d['modified_by'] for d in response_data])
+    users = list(User.objects.filter(id__in=user_ids).values('id','email'))
+    email_dict = {}
+    for user in users:
+        email_dict[user['id']] = user['email']
+
+    media_ids = set(media for d in response_data for media in d['media'])
+    medias = list(Media.objects.filter(id__in=media_ids).values('id','name'))
+    filename_dict = {media['id']:media['name'] for media in medias}
+
+    for element in response_data:
+        del element['meta']
+
+        oldAttributes = element['attributes']
+        del element['attributes']
+        element.update(oldAttributes)
+
+        user_id = element['modified_by']
+        media_ids = element['media']
+
+        element['user'] = email_dict[user_id]
+        element['media'] = [filename_dict[media_id] for media_id in media_ids]
+    return response_data
+
 class StateListAPI(BaseListView):
     """ Interact with list of states.
 
@@ -89,58 +124,58 @@ class StateListAPI(BaseListView):
     def _get(self, params):
         t0 = datetime.datetime.now()
         qs = get_annotation_queryset(self.kwargs['project'], params, 'state')
+        is_csv = self.request.accepted_renderer.format == 'csv'
+        latest_frame = False
+        if is_csv and 'type' in params:
+            type_object = StateType.objects.get(pk=params['type'])
+            latest_frame = (type_object.association == 'Frame'
+                            and type_object.interpolation == InterpolationMethods.LATEST)
+        # CSV of frame states with latest interpolation needs the next row, so it is not streamed.
+        if params.get('stream') and not latest_frame:
+            return self._stream(params, qs)
         response_data = list(qs.values(*STATE_PROPERTIES))
 
         t1 = datetime.datetime.now()
         response_data = _fill_m2m(response_data)
-        if self.request.accepted_renderer.format == 'csv':
-
-            # CSV creation requires a bit more
-            user_ids = set([d['modified_by'] for d in response_data])
-            users = list(User.objects.filter(id__in=user_ids).values('id','email'))
-            email_dict = {}
-            for user in users:
-                email_dict[user['id']] = user['email']
-
-            media_ids = set(media for d in response_data for media in d['media'])
-            medias = list(Media.objects.filter(id__in=media_ids).values('id','name'))
-            filename_dict = {media['id']:media['name'] for media in medias}
-
-            for element in response_data:
-                del element['meta']
-
-                oldAttributes = element['attributes']
-                del element['attributes']
-                element.update(oldAttributes)
-
-                user_id = element['modified_by']
-                media_ids = element['media']
-
-                element['user'] = email_dict[user_id]
-                element['media'] = [filename_dict[media_id] for media_id in media_ids]
-
-            if 'type' in params:
-                type_object=StateType.objects.get(pk=params['type'])
-                if type_object.association == 'Frame' and type_object.interpolation == InterpolationMethods.LATEST:
-                    for idx,el in enumerate(response_data):
-                        mediaEl=Media.objects.get(pk=el['media'])
-                        endFrame=0
-                        if idx + 1 < len(response_data):
-                            next_element=response_data[idx+1]
-                            endFrame=next_element['frame']
-                        else:
-                            endFrame=mediaEl.num_frames
-                        el['media']=mediaEl.name
-
-                        el['endFrame'] = endFrame
-                        el['startSeconds'] = int(el['frame']) * mediaEl.fps
-                        el['endSeconds'] = int(el['endFrame']) * mediaEl.fps
+        if is_csv:
+            response_data = _convert_for_csv(response_data)
+
+            if latest_frame:
+                for idx,el in enumerate(response_data):
+                    mediaEl=Media.objects.get(pk=el['media'])
+                    endFrame=0
+                    if idx + 1 < len(response_data):
+                        next_element=response_data[idx+1]
+                        endFrame=next_element['frame']
+                    else:
+                        endFrame=mediaEl.num_frames
+                    el['media']=mediaEl.name
+
+                    el['endFrame'] = endFrame
+                    el['startSeconds'] = int(el['frame']) * mediaEl.fps
+                    el['endSeconds'] = int(el['endFrame']) * mediaEl.fps
         t2 = datetime.datetime.now()
         logger.info(f"Number of states: {len(response_data)}")
         logger.info(f"Time to get states: {t1-t0}")
         logger.info(f"Time to get states many to many fields: {t2-t1}")
         return response_data
 
+    def _stream(self, params, qs):
+        """ Returns a response that streams states in chunks read from a server-side cursor.
+        """
+        renderer = self.request.accepted_renderer
+        chunks = (_fill_m2m(chunk) for chunk in iter_chunks(qs.values(*STATE_PROPERTIES)))
+        if renderer.format == 'csv':
+            type_qs = StateType.objects.filter(project=self.kwargs['project'])
+            if params.get('type') is not None:
+                type_qs = type_qs.filter(pk=params['type'])
+            field_names = [name for name in STATE_PROPERTIES if name not in ['meta', 'attributes']]
+            field_names += ['user'] + get_attribute_names(type_qs)
+            rows = itertools.chain.from_iterable(_convert_for_csv(chunk) for chunk in chunks)
+            return streaming_response(stream_csv(rows, field_names), renderer.media_type)
+        rows = itertools.chain.from_iterable(chunks)
+        return streaming_response(stream_json(rows), 'application/json')
+
     def _post(self, params):
         # Check that we are getting a state list.
         if 'body' in params:
@@ -226,6 +261,19 @@ class StateListAPI(BaseListView):
                                             state)
                       for state in state_specs]
 
+        # Calculate segments up front, as the localization relations are copied directly.
+        loc_id_to_frame = {loc['id']:loc['frame'] for loc in
+                           localization_qs.values('id', 'frame').iterator()}
+        segments = []
+        for state_spec in state_specs:
+            frames = [loc_id_to_frame[loc_id] for loc_id in state_spec.get('localization_ids', [])]
+            if len(frames) > 0:
+                frames = np.sort(frames)
+                splits = np.split(frames, np.where(np.diff(frames) != 1)[0] + 1)
+                segments.append([[int(split[0]), int(split[-1])] for split in splits])
+            else:
+                segments.append(None)
+
         # Create the state objects.
         objs = (
             State(
@@ -236,53 +284,27 @@ class StateListAPI(BaseListView):
                 modified_by=self.request.user,
                 version=versions[state_spec.get("version", None)],
                 frame=state_spec.get("frame", None),
+                segments=state_segments,
             )
-            for state_spec, attrs in zip(state_specs, attr_specs)
+            for state_spec, attrs, state_segments in zip(state_specs, attr_specs, segments)
         )
-        states = bulk_create_from_generator(objs, State)
+        states = bulk_copy_from_generator(objs, State)
 
         # Create media relations.
-        media_relations = []
-        for state, state_spec in zip(states, state_specs):
-            for media_id in state_spec['media_ids']:
-                media_states = State.media.through(
-                    state_id=state.id,
-                    media_id=media_id,
-                )
-                media_relations.append(media_states)
-                if len(media_relations) > 1000:
-                    State.media.through.objects.bulk_create(media_relations)
-                    media_relations = []
-        State.media.through.objects.bulk_create(media_relations)
+        objs = (
+            State.media.through(state_id=state.id, media_id=media_id)
+            for state, state_spec in zip(states, state_specs)
+            for media_id in state_spec['media_ids']
+        )
+        bulk_copy_from_generator(objs, State.media.through)
 
         # Create localization relations.
-        loc_relations = []
-        for state, state_spec in zip(states, state_specs):
-            if 'localization_ids' in state_spec:
-                for localization_id in state_spec['localization_ids']:
-                    loc_states = State.localizations.through(
-                        state_id=state.id,
-                        localization_id=localization_id,
-                    )
-                    loc_relations.append(loc_states)
-                    if len(loc_relations) > 1000:
-                        State.localizations.through.objects.bulk_create(loc_relations)
-                        loc_relations = []
-        State.localizations.through.objects.bulk_create(loc_relations)
-
-        # Calculate segments (this is not triggered for bulk created m2m).
-        localization_ids = itertools.chain(*[state_spec.get('localization_ids', [])
-                                             for state_spec in state_specs])
-        loc_id_to_frame = {loc['id']:loc['frame'] for loc in
-                           Localization.objects.filter(pk__in=localization_ids)\
-                           .values('id', 'frame').iterator()}
-        for state, state_spec in zip(states, state_specs):
-            frames = [loc_id_to_frame[loc_id] for loc_id in state_spec.get('localization_ids', [])]
-            if len(frames) > 0:
-                frames = np.sort(frames)
-                segments = np.split(frames, np.where(np.diff(frames) != 1)[0] + 1)
-                state.segments = [[int(segment[0]), int(segment[-1])] for segment in segments]
-        State.objects.bulk_update(states, ['segments'])
+        objs = (
+            State.localizations.through(state_id=state.id, localization_id=localization_id)
+            for state, state_spec in zip(states, state_specs)
+            for localization_id in state_spec.get('localization_ids', [])
+        )
+        bulk_copy_from_generator(objs, State.localizations.through)
 
         # Build ES documents.
         ts = TatorSearch()
@@ -295,22 +317,10 @@ class StateListAPI(BaseListView):
         ts.bulk_add_documents(documents)
 
         # Create ChangeLogs
-        objs = (
-            ChangeLog(
-                project=project, user=self.request.user, description_of_change=state.create_dict
-            )
-            for state in states
-        )
-        change_logs = bulk_create_from_generator(objs, ChangeLog)
-
-        # Associate ChangeLogs with created objects
         ref_table = ContentType.objects.get_for_model(states[0])
         ids = [state.id for state in states]
-        objs = (
-            ChangeToObject(ref_table=ref_table, ref_id=ref_id, change_id=cl)
-            for ref_id, cl in zip(ids, change_logs)
-        )
-        bulk_create_from_generator(objs, ChangeToObject)
+        bulk_log_changes(project, self.request.user, ref_table, ids,
+                         [state.create_dict for state in states])
 
         # Return created IDs.
         ids = [state.id for state in states]
@@ -335,18 +345,7 @@ class StateListAPI(BaseListView):
             TatorSearch().delete(self.kwargs['project'], query)
 
             # Create ChangeLogs
-            objs = (
-                ChangeLog(project=project, user=self.request.user, description_of_change=dd)
-                for dd in delete_dicts
-            )
-            change_logs = bulk_create_from_generator(objs, ChangeLog)
-
-            # Associate ChangeLogs with deleted objects
-            objs = (
-                ChangeToObject(ref_table=ref_table, ref_id=ref_id, change_id=cl)
-                for ref_id, cl in zip(ref_ids, change_logs)
-            )
-            bulk_create_from_generator(objs, ChangeToObject)
+            bulk_log_changes(project, self.request.user, ref_table, ref_ids, delete_dicts)
 
         return {'message': f'Successfully deleted {count} states!'}
 
@@ -355,25 +354,27 @@ class StateListAPI(BaseListView):
         count = qs.count()
         if count > 0:
             # Get the current representation of the object for comparison
-            original_dict = qs.first().model_dict
-            new_attrs = validate_attributes(params, qs[0])
-            bulk_patch_attributes(new_attrs, qs)
-            qs.update(modified_by=self.request.user)
+            obj = qs.first()
+            original_dict = obj.model_dict
+            first_id = obj.id
+            entity_type = obj.meta
+            new_attrs = validate_attributes(params, obj)
+            ids = bulk_patch_attributes(new_attrs, qs, modified_by=self.request.user)
 
             # Get one object from the queryset to create the change log
-            obj = qs.first()
+            obj = State.objects.get(pk=first_id)
             change_dict = obj.change_dict(original_dict)
             ref_table = ContentType.objects.get_for_model(obj)
 
             query = get_annotation_es_query(params['project'], params, 'state')
-            TatorSearch().update(self.kwargs['project'], qs[0].meta, query, new_attrs)
+            TatorSearch().update(self.kwargs['project'], entity_type, query, new_attrs)
 
             # Create the ChangeLog entry and associate it with all objects in the queryset
             cl = ChangeLog(
                 project=obj.project, user=self.request.user, description_of_change=change_dict
             )
             cl.save()
-            objs = (ChangeToObject(ref_table=ref_table, ref_id=o.id, change_id=cl) for o in qs)
+            objs = (ChangeToObject(ref_table=ref_table, ref_id=id_, change_id=cl) for id_ in ids)
             bulk_create_from_generator(objs, ChangeToObject)
 
         return {'message': f'Successfully updated {count} states!'}
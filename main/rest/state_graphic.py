@@ -1,5 +1,6 @@
 import tempfile
 import logging
+import shutil
 import traceback
 
 from rest_framework.response import Response
@@ -16,6 +17,8 @@ from ..schema import StateGraphicSchema
 from ._base_views import BaseDetailView
 from ._media_util import MediaUtil
 from ._permissions import ProjectViewOnlyPermission
+from ._util import file_response
+from ._util import streaming_response
 
 logger = logging.getLogger(__name__)
 
@@ -47,7 +50,7 @@ class StateGraphicAPI(BaseDetailView):
         """
         # TODO: Add logic for all state types
         # upon success we can return an image
-        state = State.objects.get(pk=params['id'])
+        state = State.objects.select_related('meta').get(pk=params['id'])
 
         mode = params['mode']
         fps = params['fps']
@@ -63,22 +66,27 @@ class StateGraphicAPI(BaseDetailView):
             raise Exception('Not a localization association state')
 
         video = state.media.all()[0]
-        localizations = state.localizations.order_by('frame')[offset:offset+length]
+        localizations = state.localizations.only('frame', 'x', 'y', 'width', 'height')
+        localizations = localizations.order_by('frame')[offset:offset+length]
         frames = [l.frame for l in localizations]
         roi = [(l.width, l.height, l.x, l.y) for l in localizations]
-        with tempfile.TemporaryDirectory() as temp_dir:
+        # Outputs are streamed to the client, which removes the temporary directory.
+        temp_dir = tempfile.mkdtemp()
+        try:
             media_util = MediaUtil(video, temp_dir)
             if mode == "animate":
                 if any(x is self.request.accepted_renderer.format for x in ['mp4','gif']):
                     pass
                 else:
                     self.request.accepted_renderer = GifRenderer()
-                gif_fp = media_util.get_animation(frames, roi, fps,
-                                                  self.request.accepted_renderer.format,
-                                                  force_scale=force_scale)
-                with open(gif_fp, 'rb') as data_file:
-                    self.request.accepted_renderer = GifRenderer()
-                    response_data = data_file.read()
+                content_type = self.request.accepted_renderer.media_type
+                animation = media_util.get_animation(frames, roi, fps,
+                                                     self.request.accepted_renderer.format,
+                                                     force_scale=force_scale,
+                                                     stream=True)
+                if isinstance(animation, str):
+                    return file_response(animation, content_type, temp_dir)
+                return streaming_response(animation, content_type, temp_dir)
             else:
                 max_w = 0
                 max_h = 0
@@ -106,6 +114,8 @@ class StateGraphicAPI(BaseDetailView):
                                                      tile_size,
                                                      render_format=self.request.accepted_renderer.format,
                                                      force_scale=force_scale)
-                with open(tiled_fp, 'rb') as data_file:
-                    response_data = data_file.read()
-        return response_data
+                return file_response(tiled_fp, self.request.accepted_renderer.media_type,
+                                     temp_dir)
+        except:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
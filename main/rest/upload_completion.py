@@ -3,6 +3,7 @@ import os
 import boto3
 
 from ..models import Project
+from ..models import Resource
 from ..schema import UploadCompletionSchema
 from ..store import get_tator_store
 
@@ -28,5 +29,11 @@ class UploadCompletionAPI(BaseListView):
         # Complete the upload.
         tator_store = get_tator_store(project_obj.bucket)
         tator_store.complete_multipart_upload(key, parts, upload_id)
+
+        # If this upload replaced an existing resource, refresh its object info.
+        resources = list(Resource.objects.filter(path=key))
+        for resource in resources:
+            resource.update_object_info(tator_store)
+        Resource.objects.bulk_update(resources, ['size', 'etag', 'storage_class'])
         return {'message': f"Upload completion for {key} successful!"}
 
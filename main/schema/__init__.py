@@ -25,6 +25,7 @@ from .favorite import FavoriteDetailSchema
 from .file import FileListSchema
 from .file import FileDetailSchema
 from .get_frame import GetFrameSchema
+from .frame_extraction import FrameExtractionSchema
 from .get_clip import GetClipSchema
 from .image_file import ImageFileListSchema
 from .image_file import ImageFileDetailSchema
@@ -45,6 +46,7 @@ from .localization import LocalizationListSchema
 from .localization import LocalizationDetailSchema
 from .localization_count import LocalizationCountSchema
 from .localization_graphic import LocalizationGraphicSchema
+from .localization_graphic import LocalizationGraphicListSchema
 from .localization_type import LocalizationTypeListSchema
 from .localization_type import LocalizationTypeDetailSchema
 from .media import MediaListSchema
@@ -48,3 +48,17 @@ annotation_filter_parameter_schema = [
         'schema': {'type': 'string'},
     },
 ]
+
+annotation_stream_parameter_schema = [
+    {
+        'name': 'stream',
+        'in': 'query',
+        'required': False,
+        'description': 'Set to 1 to stream results as they are read from the database instead '
+                       'of building the whole list in memory. Recommended for large json or '
+                       'csv exports. For csv, columns are taken from the attribute types of '
+                       'the requested type, or of all types in the project.',
+        'schema': {'type': 'integer',
+                   'enum': [0, 1]},
+    },
+]
@@ -66,6 +66,8 @@ class CustomGenerator(SchemaGenerator):
                 'FavoriteUpdate': favorite_update,
                 'Favorite': favorite,
                 'FeedDefinition': feed_definition,
+                'FrameSpec': frame_spec,
+                'FrameExtractionSpec': frame_extraction_spec,
                 'FileDefinition': file_definition,
                 'LiveDefinition': live_definition,
                 'LiveUpdateDefinition': live_update_definition,
@@ -94,6 +96,8 @@ class CustomGenerator(SchemaGenerator):
                 'LocalizationUpdate': localization_update,
                 'Localization': localization,
                 'LocalizationIdQuery': localization_id_query,
+                'LocalizationGraphicSpec': localization_graphic_spec,
+                'LocalizationGraphic': localization_graphic,
                 'MediaNext': media_next,
                 'MediaPrev': media_prev,
                 'MediaUpdate': media_update,
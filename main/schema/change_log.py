@@ -22,6 +22,42 @@ change_log_filter_schema = [
         "description": "Filters ChangeLogs for the given entity.",
         "schema": {"type": "integer"},
     },
+    {
+        "name": "ref_table",
+        "in": "query",
+        "required": False,
+        "description": "Filters ChangeLogs for the given type of entity.",
+        "schema": {"type": "string", "enum": ["media", "localization", "state", "leaf"]},
+    },
+    {
+        "name": "after",
+        "in": "query",
+        "required": False,
+        "description": "If given, all results returned will be after the ChangeLog with this "
+                       "ID in order of modification time, then ID. ChangeLogs without a "
+                       "modification time come last. Pass the `id` of the last returned entry "
+                       "to get the next page. The `start` and `stop` parameters are relative "
+                       "to this modified range.",
+        "schema": {"type": "integer"},
+    },
+    {
+        "name": "start",
+        "in": "query",
+        "required": False,
+        "description": "Pagination start index. Index of the first ChangeLog in a larger list "
+                       "to return. Like `stop`, this counts ChangeLogs, not returned entries.",
+        "schema": {"type": "integer", "minimum": 0},
+    },
+    {
+        "name": "stop",
+        "in": "query",
+        "required": False,
+        "description": "Pagination stop index. Non-inclusive index of the last ChangeLog in a "
+                       "larger list to return. A bulk ChangeLog counts once, but is returned "
+                       "as one entry per changed entity (one entry if `entity_id` is given), "
+                       "so a page may contain more entries than `stop - start`.",
+        "schema": {"type": "integer", "minimum": 0},
+    },
 ]
 
 boilerplate = dedent(
@@ -62,6 +62,10 @@ from .localization import localization_bulk_update
 from .localization import localization_update
 from .localization import localization
 from .localization import localization_id_query
+from .frame_extraction import frame_spec
+from .frame_extraction import frame_extraction_spec
+from .localization_graphic import localization_graphic_spec
+from .localization_graphic import localization_graphic
 from .media_next import media_next
 from .media_prev import media_prev
 from .media import media_spec
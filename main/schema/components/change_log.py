@@ -36,5 +36,10 @@ change_log = {
             "type": "integer",
             "description": "Unique integer identifying the user whose changes created this change log.",
         },
+        "modified_datetime": {
+            "type": "string",
+            "format": "date-time",
+            "description": "Datetime when this change occurred.",
+        },
     },
 }
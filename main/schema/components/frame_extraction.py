@@ -0,0 +1,50 @@
+frame_spec = {
+    'type': 'object',
+    'required': ['frame'],
+    'properties': {
+        'frame': {
+            'type': 'integer',
+            'description': 'Frame to extract, 0 for images.',
+            'minimum': 0,
+        },
+        'roi': {
+            'type': 'array',
+            'description': 'Optional region of interest (width, height, x, y) in relative '
+                           'coordinates to crop the frame to.',
+            'items': {'type': 'number', 'minimum': 0.0, 'maximum': 1.0},
+            'minItems': 4,
+            'maxItems': 4,
+        },
+    },
+}
+
+frame_extraction_spec = {
+    'type': 'object',
+    'required': ['frames'],
+    'properties': {
+        'frames': {
+            'type': 'array',
+            'description': 'Frames to extract. Images in the returned zip archive are named '
+                           '<index in this array>_<frame>.<image_format>.',
+            'items': {'$ref': '#/components/schemas/FrameSpec'},
+            'minItems': 1,
+            'maxItems': 10000,
+        },
+        'force_scale': {
+            'type': 'string',
+            'description': 'Size of each extracted image, for example 100x100. Default is '
+                           'the size of the frame or roi.',
+        },
+        'image_format': {
+            'type': 'string',
+            'description': 'Format of the extracted images.',
+            'enum': ['jpg', 'png'],
+            'default': 'jpg',
+        },
+        'quality': {
+            'type': 'integer',
+            'description': 'Source resolution to use (default to highest quality).',
+            'minimum': 0,
+        },
+    },
+}
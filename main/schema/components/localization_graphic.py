@@ -0,0 +1,31 @@
+localization_graphic_spec = {
+    'type': 'object',
+    'required': ['ids'],
+    'properties': {
+        'ids': {
+            'type': 'array',
+            'description': 'Array of localization IDs to render.',
+            'items': {'type': 'integer'},
+            'minItems': 1,
+            'maxItems': 1000,
+        },
+    },
+}
+
+localization_graphic = {
+    'type': 'object',
+    'properties': {
+        'id': {
+            'type': 'integer',
+            'description': 'Localization ID.',
+        },
+        'key': {
+            'type': 'string',
+            'description': 'Object key of the cached localization graphic.',
+        },
+        'url': {
+            'type': 'string',
+            'description': 'URL for downloading the localization graphic.',
+        },
+    },
+}
@@ -0,0 +1,57 @@
+from textwrap import dedent
+
+from rest_framework.schemas.openapi import AutoSchema
+
+from ._errors import error_responses
+
+class FrameExtractionSchema(AutoSchema):
+    def get_operation(self, path, method):
+        operation = super().get_operation(path, method)
+        if method == 'POST':
+            operation['operationId'] = 'ExtractFrames'
+        operation['tags'] = ['Tator']
+        return operation
+
+    def get_description(self, path, method):
+        return dedent("""\
+        Extract many frames or crops from one media.
+
+        Returns a zip archive with one image per requested frame, streamed as frames are
+        extracted. Frames are extracted in order of their position in the video and
+        frames needing the same segments are decoded together, so this is much faster
+        than calling `GetFrame` once per frame.
+        """)
+
+    def _get_path_parameters(self, path, method):
+        return [{
+            'name': 'id',
+            'in': 'path',
+            'required': True,
+            'description': 'A unique integer identifying a media object.',
+            'schema': {'type': 'integer'},
+        }]
+
+    def _get_filter_parameters(self, path, method):
+        return []
+
+    def _get_request_body(self, path, method):
+        body = {}
+        if method == 'POST':
+            body = {
+                'required': True,
+                'content': {'application/json': {
+                'schema': {'$ref': '#/components/schemas/FrameExtractionSpec'},
+            }}}
+        return body
+
+    def _get_responses(self, path, method):
+        responses = error_responses()
+        if method == 'POST':
+            responses['200'] = {
+                'description': 'Zip archive of extracted images.',
+                'content': {'application/zip': {'schema': {
+                    'type': 'string',
+                    'format': 'binary',
+                }}}
+            }
+        return responses
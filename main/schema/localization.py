@@ -7,6 +7,7 @@ from ._message import message_with_id_list_schema
 from ._errors import error_responses
 from ._attributes import attribute_filter_parameter_schema
 from ._annotation_query import annotation_filter_parameter_schema
+from ._annotation_query import annotation_stream_parameter_schema
 
 localization_filter_schema = [
     {
@@ -99,6 +100,8 @@ class LocalizationListSchema(AutoSchema):
         params = []
         if method in ['GET', 'PUT', 'PATCH', 'DELETE']:
             params = annotation_filter_parameter_schema + attribute_filter_parameter_schema + localization_filter_schema
+        if method == 'GET':
+            params = params + annotation_stream_parameter_schema
         return params
 
     def _get_request_body(self, path, method):
@@ -3,6 +3,8 @@ from types import SimpleNamespace
 
 from rest_framework.schemas.openapi import AutoSchema
 
+from ._errors import error_responses
+
 class LocalizationGraphicSchema(AutoSchema):
     """ Gets a thumbnail image of the localization
 
@@ -130,3 +132,81 @@ class LocalizationGraphicSchema(AutoSchema):
                 }}}
             }
         return responses
+
+class LocalizationGraphicListSchema(LocalizationGraphicSchema):
+    """ Renders and caches thumbnail images of many localizations.
+    """
+
+    def get_operation(self, path, method):
+        operation = super().get_operation(path, method)
+        if method == 'POST':
+            operation['operationId'] = 'GetLocalizationGraphicList'
+        operation['tags'] = ['Tator']
+        return operation
+
+    def get_description(self, path, method):
+        return dedent("""\
+        Render localization graphics for a list of localizations.
+
+        Graphics are rendered in one pass per media and cached in object storage, so
+        later requests for the same localizations, margins and scale are served from the
+        cache by this endpoint and `LocalizationGraphic`. Returns a download URL for the
+        graphic of each localization.
+        """)
+
+    def _get_path_parameters(self, path, method):
+        return [{
+            'name': 'project',
+            'in': 'path',
+            'required': True,
+            'description': 'A unique integer identifying a project.',
+            'schema': {'type': 'integer'},
+        }]
+
+    def _get_filter_parameters(self, path, method):
+        params = []
+        if method == 'POST':
+            params = super()._get_filter_parameters(path, 'GET') + [
+                {
+                    'name': 'image_format',
+                    'in': 'query',
+                    'required': False,
+                    'description': 'Format of the rendered graphics.',
+                    'schema': {'type': 'string',
+                               'enum': ['png', 'jpg'],
+                               'default': 'png'},
+                },
+                {
+                    'name': 'expiration',
+                    'in': 'query',
+                    'required': False,
+                    'description': 'Number of seconds until URL expires and becomes invalid.',
+                    'schema': {'type': 'integer',
+                               'minimum': 1,
+                               'maximum': 86400,
+                               'default': 86400},
+                },
+            ]
+        return params
+
+    def _get_request_body(self, path, method):
+        body = {}
+        if method == 'POST':
+            body = {
+                'required': True,
+                'content': {'application/json': {
+                'schema': {'$ref': '#/components/schemas/LocalizationGraphicSpec'},
+            }}}
+        return body
+
+    def _get_responses(self, path, method):
+        responses = error_responses()
+        if method == 'POST':
+            responses['201'] = {
+                'description': 'Download information of the localization graphics.',
+                'content': {'application/json': {'schema': {
+                    'type': 'array',
+                    'items': {'$ref': '#/components/schemas/LocalizationGraphic'},
+                }}}
+            }
+        return responses
@@ -1,12 +1,18 @@
 import logging
 import os
 import datetime
+from collections import defaultdict
 from copy import deepcopy
+from itertools import islice
 from uuid import uuid1
 
+from django.apps import apps
+from django.db import transaction
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 
+from .cache import TatorCache
+
 logger = logging.getLogger(__name__)
 
 # Indicates what types can mutate into. Maps from type -> to type.
@@ -24,12 +30,11 @@ ALLOWED_MUTATIONS = {
 id_bits=448
 id_mask=(1 << id_bits) - 1
 
-def drop_dupes(ids):
-    """ Drops duplicates in a list without changing the order.
-    """
-    seen = set()
-    seen_add = seen.add
-    return [x for x in ids if not (x in seen or seen_add(x))]
+# Number of outbox entries indexed per bulk request
+outbox_batch_size=500
+
+# Cardinality aggregations are accurate below this threshold (ES maximum is 40000)
+cardinality_threshold=40000
 
 def _get_alias_type(attribute_type):
     """
@@ -500,17 +505,96 @@ class TatorSearch:
         docs = self.build_document(entity, 'single')
         for doc in docs:
             logger.info(f"Making Doc={doc}")
-            res = self.es.index(index=self.index_name(entity.project.pk),
+            res = self.es.index(index=self.index_name(entity.project_id),
                                 id=doc['_id'],
                                 refresh=wait,
                                 routing=1,
                                 body={**doc['_source']})
 
-    def build_document(self, entity, mode='index'):
+    def queue_document(self, entity, wait=False):
+        """ Queues an entity to be indexed by the next flush of the outbox, which is done by
+            the `flushindexoutbox` management command. Repeated saves of an entity before the
+            outbox is flushed are coalesced into one index operation. The flush reads the entity
+            from the database, so it always indexes its latest state. Set wait to True to index
+            synchronously instead.
+        """
+        if wait:
+            self.create_document(entity, wait=True)
+            return
+        member = f'{entity._meta.label_lower}:{entity.pk}'
+        TatorCache().push_index_outbox(self.prefix, [member])
+        if transaction.get_connection().in_atomic_block:
+            # Queue again on commit in case the outbox is flushed before the transaction
+            # commits, which would index uncommitted data.
+            transaction.on_commit(lambda: TatorCache().push_index_outbox(self.prefix, [member]))
+
+    def flush_outbox(self):
+        """ Indexes all queued documents with bulk requests. Returns the number of documents
+            indexed.
+        """
+        # Avoid a circular import, util depends on models which depend on this module.
+        from .util import CLASS_MAPPING, get_document_queryset, build_documents
+        sections = {model: section for section, model in CLASS_MAPPING.items()}
+        total = 0
+        while True:
+            members = TatorCache().pop_index_outbox(self.prefix, outbox_batch_size)
+            if not members:
+                break
+            try:
+                pks_by_model = defaultdict(list)
+                for member in members:
+                    label, pk = member.rsplit(':', 1)
+                    pks_by_model[apps.get_model(label)].append(int(pk))
+                docs = []
+                member_of = {}
+                for model, pks in pks_by_model.items():
+                    section = sections[model]
+                    qs = model.objects.filter(pk__in=pks, meta__isnull=False)
+                    entities = list(get_document_queryset(section, qs))
+                    section_docs = build_documents(section, entities)
+                    for doc in section_docs:
+                        pk = int(doc['_id'].split('_')[1]) & id_mask
+                        member_of[doc['_id']] = f'{model._meta.label_lower}:{pk}'
+                    docs += section_docs
+                success, errors = bulk(self.es, docs, raise_on_error=False)
+            except Exception:
+                # Put the batch back so it is retried by the next flush.
+                TatorCache().push_index_outbox(self.prefix, members)
+                raise
+            if errors:
+                self._handle_outbox_errors(errors, member_of)
+            total += success
+        return total
+
+    def _handle_outbox_errors(self, errors, member_of):
+        """ Puts documents that failed to index because of throttling or server errors back
+            in the outbox, and records the others in the failed outbox, which is only retried
+            by `flushindexoutbox --retry_failed`.
+        """
+        retry = set()
+        failed = set()
+        for error in errors:
+            _, info = next(iter(error.items()))
+            member = member_of.get(info.get('_id'))
+            if member is None:
+                continue
+            status = info.get('status', 500)
+            if status == 429 or status >= 500:
+                retry.add(member)
+            else:
+                failed.add(member)
+            logger.error(f"Failed to index {member} (status {status}): {info.get('error')}")
+        cache = TatorCache()
+        cache.push_index_outbox(self.prefix, list(retry))
+        cache.push_index_failed(self.prefix, list(failed))
+
+    def build_document(self, entity, mode='index', resource_sizes=None):
         """ Returns a list of documents representing the entity to be
             used with the es.helpers.bulk functions
             if mode is 'single', then one can use the 'doc' member
             as the parameters to the es.index function.
+            resource_sizes is an optional mapping from path to size used for
+            media, see `Resource.get_sizes`.
         """
         aux = {}
         aux['_meta'] = entity.meta.pk
@@ -534,7 +618,7 @@ class TatorSearch:
             aux['_archive_state'] = entity.archive_state
 
             # Get total size and download size of this file.
-            total_size, download_size = entity.get_file_sizes()
+            total_size, download_size = entity.get_file_sizes(resource_sizes)
             aux['_total_size'] = total_size
             aux['_download_size'] = download_size
 
@@ -553,17 +637,17 @@ class TatorSearch:
                 'name': 'annotation',
                 'parent': f"{entity.media.meta.dtype}_{entity.media.pk}",
             }
-            if entity.version:
-                aux['_annotation_version'] = entity.version.pk
+            if entity.version_id:
+                aux['_annotation_version'] = entity.version_id
             aux['_modified'] = entity.modified
-            aux['_user'] = entity.user.pk
+            aux['_user'] = entity.user_id
             aux['_email'] = entity.user.email
             aux['_meta'] = entity.meta.pk
             aux['_frame'] = entity.frame
             aux['_x'] = entity.x
             aux['_y'] = entity.y
-            if entity.thumbnail_image:
-                aux['_thumbnail_image'] = entity.thumbnail_image.pk
+            if entity.thumbnail_image_id:
+                aux['_thumbnail_image'] = entity.thumbnail_image_id
             else:
                 aux['_thumbnail_image'] = None
             if entity.meta.dtype == 'box':
@@ -601,8 +685,8 @@ class TatorSearch:
                     duplicates.append(duplicate)
             except:
                 pass
-            if entity.version:
-                aux['_annotation_version'] = entity.version.pk
+            if entity.version_id:
+                aux['_annotation_version'] = entity.version_id
             aux['_modified'] = entity.modified
         elif entity.meta.dtype in ['leaf']:
             aux['_exact_treeleaf_name'] = entity.name
@@ -618,7 +702,7 @@ class TatorSearch:
 
         results=[]
         results.append({
-            '_index':self.index_name(entity.project.pk),
+            '_index':self.index_name(entity.project_id),
             '_op_type': mode,
             '_source': {
                 **mapping_values,
@@ -637,7 +721,7 @@ class TatorSearch:
             # 256 duplicates for a given type
             duplicate_id = entity.pk + ((idx + 1) << id_bits)
             results.append({
-            '_index':self.index_name(entity.project.pk),
+            '_index':self.index_name(entity.project_id),
             '_op_type': mode,
             '_source': {
                 **mapping_values,
@@ -664,65 +748,142 @@ class TatorSearch:
             stored_fields=[],
         )
 
-    def search(self, project, query):
-        if 'sort' not in query:
-            query['sort'] = {'_doc': 'asc'}
-        size = query.get('size', None)
-        if (size is None) or (size >= 10000):
-            query['size'] = 10000
+    def iter_ids(self, project, query, page_size=10000):
+        """ Yields unique IDs matching a query in sort order using `search_after` pagination.
+            A `_postgres_id` tiebreaker is added to the sort so that pages are stable and
+            duplicate documents (see `id_mask`) are adjacent, which lets them be dropped
+            without keeping a set of seen IDs. Pagination parameters in the query are ignored.
+        """
+        body = dict(query)
+        body.pop('from', None)
+        sort = query.get('sort', {})
+        if isinstance(sort, dict):
+            sort = [{key: val} for key, val in sort.items()]
+        sort = [field for field in sort if '_doc' not in field]
+        if not any('_postgres_id' in field for field in sort):
+            sort.append({'_postgres_id': 'asc'})
+        body['sort'] = sort
+        body['size'] = page_size
+        last_id = None
+        while True:
             result = self.es.search(
                 index=self.index_name(project),
-                body=query,
-                scroll='1m',
+                body=body,
                 stored_fields=[],
             )
-            scroll_id = result['_scroll_id']
-            result = result['hits']
-            data = result['hits']
-            count = result['total']['value']
-
-            if size:
-                count = size
-            ids = drop_dupes([int(obj['_id'].split('_')[1]) & id_mask for obj in data])
-            while len(ids) < count:
-                result = self.es.scroll(
-                    scroll_id=scroll_id,
-                    scroll='1m',
-                )
-                if len(result['hits']['hits']) == 0:
-                    break
-                ids += drop_dupes([int(obj['_id'].split('_')[1]) & id_mask for obj in result['hits']['hits']])
-            ids = ids[:count]
-            self.es.clear_scroll(scroll_id=scroll_id)
+            hits = result['hits']['hits']
+            for hit in hits:
+                id_ = int(hit['_id'].split('_')[1]) & id_mask
+                if id_ != last_id:
+                    last_id = id_
+                    yield id_
+            if len(hits) < page_size:
+                break
+            body['search_after'] = hits[-1]['sort']
+
+    def search(self, project, query, count=False):
+        """ Returns IDs matching a query and a count of matches. Duplicate documents (see
+            `id_mask`) are returned once.
+
+            :param count: If the query is paginated with a size below 10000, the returned count
+                          is the number of matching documents, which may include duplicates
+                          and is capped by `track_total_hits`. Set to True to count distinct
+                          IDs exactly, which needs extra aggregations.
+        """
+        if 'sort' not in query:
+            query['sort'] = {'_doc': 'asc'}
+        size = query.get('size', None)
+        if (size is None) or (size >= 10000):
+            offset = query.get('from', 0)
+            stop = None if size is None else offset + size
+            ids = list(islice(self.iter_ids(project, query), offset, stop))
+            num_ids = len(ids)
         else:
-            result = self.search_raw(project, query)
-            result = result['hits']
-            data = result['hits']
-            count = result['total']['value']
-            ids = drop_dupes([int(obj['_id'].split('_')[1]) & id_mask for obj in data])
-            if len(ids) != count:
-                # We must have dupes + pagination. Do the search again without pagination, 
-                # and return a slice.
-                offset = query.get('from', 0)
-                limit = query.get('size', 10000)
-                query['size'] = 10000
-                query['from'] = 0
-                ids, count = self.search(project, query)
-                ids = ids[offset:(offset+limit)]
-                count = len(ids)
-        return ids, count
+            # Collapse duplicate documents so that from/size paginate over unique IDs.
+            body = dict(query)
+            body['collapse'] = {'field': '_postgres_id'}
+            if count:
+                # Hit totals count documents rather than collapsed groups, so the number of
+                # unique IDs is counted with a cardinality aggregation instead.
+                body['aggs'] = {**query.get('aggs', {}), '_distinct_ids': {'cardinality': {
+                    'field': '_postgres_id',
+                    'precision_threshold': cardinality_threshold,
+                }}}
+            result = self.search_raw(project, body)
+            if count:
+                num_ids = result['aggregations']['_distinct_ids']['value']
+                if num_ids > cardinality_threshold:
+                    num_ids = self.count_distinct(project, query)
+            else:
+                num_ids = result['hits']['total']['value']
+            ids = [int(obj['_id'].split('_')[1]) & id_mask for obj in result['hits']['hits']]
+        return ids, num_ids
 
     def count(self, project, query):
         index = self.index_name(project)
+        # Pagination and aggregations are removed from a copy, callers such as media_stats
+        # reuse the query afterwards.
         count_query = dict(query)
         count_query.pop('sort', None)
         count_query.pop('aggs', None)
         count_query.pop('size', None)
+        count_query.pop('from', None)
         return self.es.count(index=index, body=count_query)['count']
 
+    def count_distinct(self, project, query):
+        """ Returns the number of distinct `_postgres_id` values matching a query. Use this
+            instead of `count` when the query may match duplicate documents (see `id_mask`).
+        """
+        index = self.index_name(project)
+        body = {'size': 0, 'track_total_hits': True}
+        if 'query' in query:
+            body['query'] = query['query']
+        body['aggs'] = {'distinct_ids': {'cardinality': {
+            'field': '_postgres_id',
+            'precision_threshold': cardinality_threshold,
+        }}}
+        result = self.es.search(index=index, body=body)
+        if result['hits']['total']['value'] <= cardinality_threshold:
+            return result['aggregations']['distinct_ids']['value']
+
+        # Cardinality is approximate above the threshold, so count composite buckets instead.
+        # Only the number of buckets in each page is kept, never the IDs themselves.
+        body['track_total_hits'] = False
+        body['aggs'] = {'distinct_ids': {'composite': {
+            'size': 10000,
+            'sources': [{'id': {'terms': {'field': '_postgres_id'}}}],
+        }}}
+        count = 0
+        while True:
+            result = self.es.search(index=index, body=body)
+            agg = result['aggregations']['distinct_ids']
+            count += len(agg['buckets'])
+            if (len(agg['buckets']) < 10000) or ('after_key' not in agg):
+                break
+            body['aggs']['distinct_ids']['composite']['after'] = agg['after_key']
+        return count
+
+    def count_ids(self, project, query, duplicates=False):
+        """ Returns the number of IDs that `search` would return for a query without
+            retrieving them. Pagination parameters `from` and `size` are applied to the count.
+
+            :param duplicates: Set to True if the query may match duplicate documents (states
+                               belonging to multiple media).
+        """
+        if duplicates:
+            count = self.count_distinct(project, query)
+        else:
+            count = self.count(project, query)
+        count = max(count - query.get('from', 0), 0)
+        size = query.get('size')
+        if size is not None:
+            count = min(count, size)
+        return count
+
     def refresh(self, project):
-        """Force refresh on an index.
+        """Force refresh on an index. Queued documents are indexed first.
         """
+        self.flush_outbox()
         self.es.indices.refresh(index=self.index_name(project))
 
     def delete(self, project, query):
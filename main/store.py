@@ -1,9 +1,12 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
 from datetime import timedelta
 from enum import Enum
+import hashlib
 import json
 import os
 import logging
+import threading
 from typing import IO, List, Optional, Tuple, Union
 from urllib.parse import urlsplit, urlunsplit
 
@@ -15,6 +18,17 @@ from google.oauth2.service_account import Credentials
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of storage objects kept by the process-wide store registry.
+STORE_CACHE_SIZE = int(os.getenv("OBJECT_STORAGE_CACHE_SIZE", "64"))
+
+# Maximum number of pooled HTTP connections per boto3 client.
+MAX_POOL_CONNECTIONS = int(os.getenv("OBJECT_STORAGE_MAX_POOL_CONNECTIONS", "50"))
+
+_store_cache = OrderedDict()
+_store_cache_lock = threading.Lock()
+# Number of times the storage objects of each bucket ID were invalidated in this process.
+_store_generations = defaultdict(int)
+
 
 class ObjectStore(Enum):
     AWS = "AmazonS3"
@@ -73,6 +87,13 @@ class TatorStorage(ABC):
     def get_download_url(self, path: str, expiration: int) -> str:
         """ Gets the presigned url for accessing an object """
 
+    def get_download_urls(self, paths: List[str], expiration: int) -> List[str]:
+        """
+        Gets presigned urls for accessing multiple objects, in the same order as `paths`. Urls are
+        signed locally without contacting the object store.
+        """
+        return [self.get_download_url(path, expiration) for path in paths]
+
     @abstractmethod
     def _get_multiple_upload_urls(
         self, key: str, expiration: int, num_parts: int, domain: str
@@ -400,7 +421,7 @@ class GCPStorage(TatorStorage):
         Create a dictionary that matches the response from boto3.
         """
         blob = self._get_blob(path)
-        return {"ContentLength": blob.size, "StorageClass": blob.storage_class}
+        return {"ContentLength": blob.size, "StorageClass": blob.storage_class, "ETag": blob.etag}
 
     def copy(self, source_path, dest_path, extra_args=None):
         self.gcs_bucket.copy_blob(
@@ -475,10 +496,97 @@ class GCPStorage(TatorStorage):
         self._update_storage_class(path, desired_storage_class)
 
 
+def _store_cache_key(bucket):
+    """
+    Returns the registry key for a bucket, which includes a hash of the credentials so that stale
+    entries are never returned after a bucket is modified by another process.
+    """
+    if bucket is None:
+        bucket_id = None
+        fields = [
+            os.getenv("OBJECT_STORAGE_HOST"),
+            os.getenv("OBJECT_STORAGE_REGION_NAME"),
+            os.getenv("OBJECT_STORAGE_ACCESS_KEY"),
+            os.getenv("OBJECT_STORAGE_SECRET_KEY"),
+            os.getenv("BUCKET_NAME"),
+            os.getenv("OBJECT_STORAGE_EXTERNAL_HOST"),
+        ]
+    else:
+        bucket_id = bucket.pk
+        fields = [
+            bucket.endpoint_url,
+            bucket.region,
+            bucket.access_key,
+            bucket.secret_key,
+            bucket.name,
+            bucket.gcs_key_info,
+        ]
+    digest = hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+    return (bucket_id, digest)
+
+
+def invalidate_tator_store(bucket_id=None):
+    """
+    Removes cached storage objects for the given bucket ID from the registry of this process.
+    """
+    with _store_cache_lock:
+        _store_generations[bucket_id] += 1
+        for key in [key for key in _store_cache if key[0] == bucket_id]:
+            del _store_cache[key]
+
+
+def get_tator_store_generation(bucket_id=None):
+    """
+    Returns a number that changes whenever storage objects of the given bucket ID are
+    invalidated in this process. Callers that hold on to a storage object can compare it to
+    detect that the bucket was modified.
+    """
+    return _store_generations[bucket_id]
+
+
+def clear_tator_stores():
+    """
+    Removes all cached storage objects from the registry of this process. Call this in forked
+    worker processes so that clients and their connection pools are not shared with the parent.
+    """
+    global _store_cache_lock
+    # The lock may have been held by another thread of the parent process when it forked.
+    _store_cache_lock = threading.Lock()
+    _store_cache.clear()
+
+
 def get_tator_store(bucket=None) -> TatorStorage:
     """
     Determines the type of object store required by the given bucket and returns it. All returned
     objects are subclasses of the base class TatorStorage.
+
+    Storage objects are kept in a process-wide LRU registry so that clients, their connection
+    pools and the detected server type are reused between calls. Buckets that have not been saved
+    yet are never cached.
+    """
+    if bucket is not None and bucket.pk is None:
+        return _make_tator_store(bucket)
+
+    key = _store_cache_key(bucket)
+    with _store_cache_lock:
+        store = _store_cache.get(key)
+        if store is not None:
+            _store_cache.move_to_end(key)
+            return store
+
+    store = _make_tator_store(bucket)
+    with _store_cache_lock:
+        _store_cache[key] = store
+        _store_cache.move_to_end(key)
+        while len(_store_cache) > STORE_CACHE_SIZE:
+            _store_cache.popitem(last=False)
+    return store
+
+
+def _make_tator_store(bucket=None) -> TatorStorage:
+    """
+    Creates a new storage object for the given bucket, querying the remote bucket for its server
+    type.
     """
     if bucket is None:
         endpoint = os.getenv("OBJECT_STORAGE_HOST")
@@ -506,7 +614,12 @@ def get_tator_store(bucket=None) -> TatorStorage:
     endpoint = endpoint.replace(f"{bucket_name}.", "")
 
     if endpoint:
-        config = Config(connect_timeout=5, read_timeout=5, retries={"max_attempts": 5})
+        config = Config(
+            connect_timeout=5,
+            read_timeout=5,
+            retries={"max_attempts": 5},
+            max_pool_connections=MAX_POOL_CONNECTIONS,
+        )
         client = boto3.client(
             "s3",
             endpoint_url=f"{endpoint}",
@@ -543,11 +656,12 @@ def get_storage_lookup(resources):
     buckets = resources.values_list("bucket", flat=True).distinct()
     # This is to avoid a circular import
     Bucket = resources.model._meta.get_field("bucket").related_model
+    bucket_objs = Bucket.objects.in_bulk([bucket for bucket in buckets if bucket])
     bucket_lookup = {
-        bucket: get_tator_store(Bucket.objects.get(pk=bucket)) if bucket else get_tator_store()
+        bucket: get_tator_store(bucket_objs[bucket]) if bucket else get_tator_store()
         for bucket in buckets
     }
     return {
-        resource.path: bucket_lookup[resource.bucket.pk] if resource.bucket else bucket_lookup[None]
-        for resource in list(resources)
+        path: bucket_lookup[bucket]
+        for path, bucket in resources.values_list("path", "bucket")
     }
@@ -1,4 +1,5 @@
 import os
+import io
 import json
 import random
 import datetime
@@ -9,18 +10,39 @@ import time
 from uuid import uuid1
 from math import sin, cos, sqrt, atan2, radians
 import re
+import csv
+import fcntl
+import tempfile
+import zipfile
+import subprocess
+from unittest.mock import patch
 
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.files.base import ContentFile
 from django.contrib.gis.geos import Point
+from django.contrib.contenttypes.models import ContentType
 from rest_framework import status
 from rest_framework.test import APITestCase
 from dateutil.parser import parse as dateutil_parse
 from botocore.errorfactory import ClientError
+from PIL import Image
 
 from .models import *
-from .store import get_tator_store
+from .store import get_tator_store, invalidate_tator_store, get_storage_lookup
 from .search import TatorSearch, ALLOWED_MUTATIONS
+from .cache import TatorCache
+from .rest._util import get_download_urls
+from .rest._util import bulk_copy_from_generator
+from .rest._util import expand_change_log
+from .rest._util import bulk_log_changes
+from .rest._util import iter_chunks
+from .rest._attribute_query import get_attribute_schema
+from .rest._media_cache import MediaCache, EVICT_FILENAME
+from .rest._media_util import MediaUtil
+from .rest.localization_graphic import invalidate_crops
+from .rest.get_clip import GetClipAPI
+from .util import build_documents, get_document_queryset, get_index_ranges
+from .util import _init_index_worker
 
 logger = logging.getLogger(__name__)
 
@@ -143,6 +165,52 @@ def create_test_image(user, name, entity_type, project):
         height='480',
     )
 
+def create_test_image_file(user, entity_type, project, width=64, height=48):
+    """ Creates an image media backed by a JPEG of the given size in object storage.
+    """
+    image = Image.new('RGB', (width, height), (255, 0, 0))
+    image_bytes = io.BytesIO()
+    image.save(image_bytes, format='JPEG')
+    key = f"test/{str(uuid1())}.jpg"
+    get_tator_store(project.bucket).put_string(key, image_bytes.getvalue())
+    media = create_test_image(user, 'test.jpg', entity_type, project)
+    media.width = width
+    media.height = height
+    media.media_files = {'image': [{'path': key, 'resolution': [height, width]}]}
+    media.save()
+    Resource.add_resource(key, media)
+    return media
+
+def create_test_segmented_video(user, entity_type, project, num_fragments=3,
+                                fragment_frames=10):
+    """ Creates a video with random streaming data and segment info describing a header
+        followed by moof/mdat pairs of `fragment_frames` frames each. Returns the media,
+        the streaming data and the segment info.
+    """
+    segments = [{'name': 'ftyp', 'offset': 0, 'size': 8},
+                {'name': 'moov', 'offset': 8, 'size': 16}]
+    offset = 24
+    for idx in range(num_fragments):
+        segments.append({'name': 'moof', 'offset': offset, 'size': 8,
+                         'frame_start': idx * fragment_frames, 'frame_samples': fragment_frames})
+        segments.append({'name': 'mdat', 'offset': offset + 8, 'size': 32})
+        offset += 40
+    data = os.urandom(offset)
+    segment_info = {'file': {'start': 0}, 'segments': segments}
+    store = get_tator_store(project.bucket)
+    video_key = f"test/{str(uuid1())}.mp4"
+    segment_key = f"test/{str(uuid1())}.json"
+    store.put_string(video_key, data)
+    store.put_string(segment_key, json.dumps(segment_info))
+    media = create_test_video(user, 'segmented.mp4', entity_type, project)
+    media.num_frames = num_fragments * fragment_frames
+    media.media_files = {'streaming': [{'path': video_key, 'segment_info': segment_key,
+                                        'resolution': [480, 640], 'codec': 'h264'}]}
+    media.save()
+    Resource.add_resource(video_key, media)
+    Resource.add_resource(segment_key, media)
+    return media, data, segment_info
+
 def create_test_box(user, entity_type, project, media, frame):
     x = random.uniform(0.0, float(media.width))
     y = random.uniform(0.0, float(media.height))
@@ -1273,6 +1341,160 @@ class VideoTestCase(
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data, 0)
 
+    def test_media_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            def _fill():
+                for idx in range(5):
+                    path = os.path.join(cache_dir, str(idx))
+                    with open(path, 'wb') as fp:
+                        fp.write(os.urandom(40))
+                    os.utime(path, (idx, idx))
+
+            # Least recently used files are removed until the cache is below its target.
+            cache = MediaCache(cache_dir, 100)
+            _fill()
+            cache.evict()
+            self.assertEqual(sorted(name for name in os.listdir(cache_dir)
+                                    if not name.startswith('.')), ['3', '4'])
+
+            # Only one process evicts at a time.
+            _fill()
+            with open(os.path.join(cache_dir, EVICT_FILENAME), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                cache.evict()
+            self.assertEqual(len([name for name in os.listdir(cache_dir)
+                                  if not name.startswith('.')]), 5)
+
+    def test_make_temporary_videos(self):
+        media, data, segment_info = create_test_segmented_video(
+            self.user, self.entity_type, self.project)
+        segments = segment_info['segments']
+        with tempfile.TemporaryDirectory() as temp_dir:
+            media_util = MediaUtil(media, temp_dir)
+            fetched = []
+            fetch_ranges = media_util._fetch_ranges
+            def _fetch_ranges(ranges):
+                fetched.append(list(ranges))
+                return fetch_ranges(ranges)
+            with patch.object(media_util, '_fetch_ranges', _fetch_ranges):
+                lookup, _ = media_util.make_temporary_videos(
+                    media_util._get_impacted_segments([3, 12, 14]))
+
+            # Segments shared between frames are fetched once, contiguous ones in one range.
+            self.assertEqual(fetched, [[(0, sum(segment['size'] for segment in segments[:6]))]])
+            for frame, segment_idxs in [(3, [0, 1, 2, 3]), (12, [0, 1, 4, 5]),
+                                        (14, [0, 1, 4, 5])]:
+                with open(lookup[frame][1], 'rb') as temp_video:
+                    self.assertEqual(temp_video.read(), b''.join(
+                        data[segments[idx]['offset']:segments[idx]['offset'] + segments[idx]['size']]
+                        for idx in segment_idxs))
+
+    def test_impacted_segments(self):
+        media, _, _ = create_test_segmented_video(self.user, self.entity_type, self.project)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            media_util = MediaUtil(media, temp_dir)
+            # Frames near the end of a fragment also need the next fragment, frames outside
+            # of the video are omitted.
+            self.assertEqual(media_util._get_impacted_segments([3, 7, 12, 29, 30]),
+                             [(3, [0, 1, 2, 3]), (7, [0, 1, 2, 3, 4, 5]), (12, [0, 1, 4, 5]),
+                              (29, [0, 1, 6, 7])])
+            self.assertEqual(media_util._get_impacted_segments([]), [])
+
+    def test_media_setup_cache(self):
+        media, _, segment_info = create_test_segmented_video(
+            self.user, self.entity_type, self.project)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            MediaUtil(media, temp_dir)
+            # Setup of the same media is reused without queries or object store requests.
+            with self.assertNumQueries(0), patch.object(MediaCache, 'get_segment_info') as get:
+                media_util = MediaUtil(media, temp_dir)
+                get.assert_not_called()
+            self.assertEqual(media_util._segment_info, segment_info)
+            self.assertEqual((media_util.getWidth(), media_util.getHeight()), (640, 480))
+
+            # Setups are discarded when the storage of their bucket is invalidated, which is
+            # done when a bucket is saved or deleted.
+            bucket_id = Resource.objects.get(path=media_util._video_file).bucket_id
+            invalidate_tator_store(bucket_id)
+            with patch.object(MediaCache, 'get_segment_info',
+                              return_value=segment_info) as get:
+                media_util = MediaUtil(media, temp_dir)
+                get.assert_called_once()
+            self.assertIs(media_util._storage, get_tator_store(media.project.bucket))
+
+    def test_stream_failure(self):
+        media, _, _ = create_test_segmented_video(self.user, self.entity_type, self.project)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            media_util = MediaUtil(media, temp_dir)
+            # ffmpeg failing before any output raises before a response is started.
+            groups = [(os.path.join(temp_dir, 'missing.mp4'), [(0, 0)])]
+            with self.assertRaises(subprocess.CalledProcessError):
+                media_util._stream_filter_graph(groups, ["[0:v]null[out]"],
+                                                ["-map", "[out]", "-f", "gif", "pipe:1"])
+
+    def test_clip_lock(self):
+        media = create_test_video(self.user, 'clip.mp4', self.entity_type, self.project)
+        def _make_clip(view, video, frame_ranges, quality, lookup):
+            time.sleep(0.5) # Outlives the lock
+            path = os.path.join(tempfile.mkdtemp(), 'clip.mp4')
+            with open(path, 'wb') as clip:
+                clip.write(os.urandom(16))
+            segment_info = {'segment_start_frames': [0], 'segment_end_frames': [9]}
+            return TemporaryFile.from_local(path, 'clip.mp4', video.project, self.user,
+                                            lookup=lookup, hours=24, segment_info=segment_info,
+                                            move=True)
+        with patch('main.rest.get_clip.CLIP_LOCK_TTL', 0.1), \
+             patch.object(GetClipAPI, '_make_clip', autospec=True,
+                          side_effect=_make_clip) as make_clip:
+            # A lock that expires during rendering does not fail the request.
+            response = self.client.get(f'/rest/GetClip/{media.pk}?frameRanges=0:9')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['segment_start_frames'], [0])
+            # Identical requests reuse the clip.
+            response = self.client.get(f'/rest/GetClip/{media.pk}?frameRanges=0:9')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            make_clip.assert_called_once()
+
+        # Waiting for a lock is bounded separately from its expiration.
+        lock = TatorCache().lock(f'test_{media.pk}', 60, 0.1)
+        self.assertTrue(lock.acquire())
+        self.assertFalse(TatorCache().lock(f'test_{media.pk}', 60, 0.1).acquire())
+        lock.release()
+
+    def test_frame_inputs(self):
+        media, _, _ = create_test_segmented_video(self.user, self.entity_type, self.project)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            media_util = MediaUtil(media, temp_dir)
+            # Frames that need the same segments are decoded from one input.
+            groups = media_util._frame_inputs([12, 3, 14])
+            self.assertEqual(sorted(selected for _, selected in groups),
+                             [[(0, 2), (2, 4)], [(1, 3)]])
+            for temp_video, _ in groups:
+                self.assertTrue(os.path.exists(temp_video))
+            with self.assertRaises(ValueError):
+                media_util._frame_inputs([100])
+            chains = media_util._select_filters([('0.mp4', [(1, 3)]),
+                                                 ('12.mp4', [(0, 2), (2, 4)])])
+            self.assertEqual(chains[2], "[1:v]select='eq(n\\,2)+eq(n\\,4)',split=2[s0][s2]")
+            self.assertEqual(chains[4], "[s2]select='eq(n\\,1)'[f2]")
+
+            # Tiles and animations are built in one graph only if all crops share a size.
+            rois = [(0.5, 0.5, 0.0, 0.0), (0.5, 0.5, 0.5, 0.5), (0.25, 0.5, 0.0, 0.0)]
+            self.assertTrue(media_util._can_combine(groups, 3))
+            self.assertTrue(media_util._can_combine(groups, 2, rois[:2]))
+            self.assertFalse(media_util._can_combine(groups, 3, rois))
+            self.assertTrue(media_util._can_combine(groups, 3, rois, (16, 16)))
+
+    def test_plan_frames(self):
+        media, _, _ = create_test_segmented_video(self.user, self.entity_type, self.project)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            media_util = MediaUtil(media, temp_dir)
+            # Frames are grouped by the segments they need, in order of position in the video.
+            self.assertEqual(media_util._plan_frames([12, 3, 14]),
+                             [((0, 1, 2, 3), [(1, 3)]), ((0, 1, 4, 5), [(0, 12), (2, 14)])])
+            with self.assertRaises(ValueError):
+                media_util._plan_frames([100])
+
 class ImageTestCase(
         APITestCase,
         AttributeTestMixin,
@@ -1307,6 +1529,48 @@ class ImageTestCase(
     def tearDown(self):
         self.project.delete()
 
+    def test_get_frame(self):
+        media = create_test_image_file(self.user, self.entity_type, self.project)
+        # Image frames are cropped and tiled in memory.
+        with patch('subprocess.run') as run, patch('subprocess.Popen') as popen:
+            response = self.client.get(f'/rest/GetFrame/{media.pk}?format=png&frames=0,0'
+                                       f'&tile=2x1&roi=0.5:0.25:0.5:0')
+            run.assert_not_called()
+            popen.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        image = Image.open(io.BytesIO(response.content))
+        self.assertEqual(image.format, 'PNG')
+        self.assertEqual(image.size, (64, 12))
+
+    def test_frame_extraction(self):
+        media = create_test_image_file(self.user, self.entity_type, self.project)
+        response = self.client.post(f'/rest/FrameExtraction/{media.pk}', {
+            'frames': [{'frame': 0}, {'frame': 0, 'roi': [0.5, 0.5, 0.0, 0.0]}],
+            'image_format': 'png',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(archive.namelist(), ['0_0.png', '1_0.png'])
+        sizes = [Image.open(io.BytesIO(archive.read(name))).size for name in archive.namelist()]
+        self.assertEqual(sizes, [(64, 48), (32, 24)])
+
+    def test_streaming_cleanup(self):
+        media = create_test_image_file(self.user, self.entity_type, self.project)
+        temp_dirs = []
+        def _mkdtemp():
+            temp_dirs.append(tempfile.mkdtemp())
+            return temp_dirs[-1]
+        with patch('main.rest.frame_extraction.tempfile.mkdtemp', side_effect=_mkdtemp):
+            response = self.client.post(f'/rest/FrameExtraction/{media.pk}',
+                                        {'frames': [{'frame': 0}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The temporary directory is removed when the response is closed, even if the
+        # content was never read.
+        self.assertTrue(os.path.exists(temp_dirs[0]))
+        response.close()
+        self.assertFalse(os.path.exists(temp_dirs[0]))
+
 class LocalizationBoxTestCase(
         APITestCase,
         AttributeTestMixin,
@@ -1370,6 +1634,208 @@ class LocalizationBoxTestCase(
     def tearDown(self):
         self.project.delete()
 
+    def test_bulk_patch(self):
+        ids = [entity.pk for entity in self.entities]
+        response = self.client.patch(f'/rest/Localizations/{self.project.pk}'
+                                     f'?type={self.entity_type.pk}',
+                                     {'attributes': {'Int Test': 5}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for localization in Localization.objects.filter(pk__in=ids):
+            self.assertEqual(localization.attributes['Int Test'], 5)
+            self.assertEqual(localization.modified_by, self.user)
+        # One change log is associated with every patched localization.
+        ref_table = ContentType.objects.get_for_model(Localization)
+        changes = ChangeToObject.objects.filter(ref_table=ref_table, ref_id__in=ids)
+        self.assertEqual(sorted(changes.values_list('ref_id', flat=True)), sorted(ids))
+        self.assertEqual(changes.values('change_id').distinct().count(), 1)
+
+    def test_bulk_patch_slice(self):
+        ids = sorted(entity.pk for entity in self.entities)
+        response = self.client.patch(f'/rest/Localizations/{self.project.pk}'
+                                     f'?type={self.entity_type.pk}&start=1&stop=3',
+                                     {'attributes': {'Int Test': 5}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Only the localizations in the requested page are patched.
+        patched = Localization.objects.filter(pk__in=ids, attributes__contains={'Int Test': 5})
+        self.assertEqual(sorted(patched.values_list('pk', flat=True)), ids[1:3])
+
+    def test_bulk_change_log(self):
+        def _pairs(change_dict):
+            return sorted(json.dumps([old, new], sort_keys=True)
+                          for old, new in zip(change_dict['old'], change_dict['new']))
+
+        ids = sorted(entity.pk for entity in self.entities)
+        delete_dicts = {localization.pk: localization.delete_dict
+                        for localization in Localization.objects.filter(pk__in=ids)}
+        with patch('main.rest._util.BULK_CHANGE_LOG_SIZE', 4):
+            response = self.client.delete(f'/rest/Localizations/{self.project.pk}'
+                                          f'?type={self.entity_type.pk}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Deletes are recorded in one change log per chunk, without ChangeToObject rows.
+        ref_table = ContentType.objects.get_for_model(Localization)
+        change_logs = list(ChangeLog.objects.filter(project=self.project, ref_table=ref_table)
+                                            .order_by('id'))
+        self.assertEqual(len(change_logs), (len(ids) + 3) // 4)
+        self.assertEqual(sorted(sum([change_log.ref_ids for change_log in change_logs], [])), ids)
+        self.assertFalse(ChangeToObject.objects.filter(ref_table=ref_table, ref_id__in=ids).exists())
+
+        # Each change log expands to the change of every localization it records.
+        for change_log in change_logs:
+            self.assertLessEqual(len(change_log.ref_ids), 4)
+            self.assertEqual(len(change_log.ref_changes), len(change_log.ref_ids))
+            changes = expand_change_log(change_log)
+            self.assertEqual([_pairs(change) for change in changes],
+                             [_pairs(delete_dicts[id_]) for id_ in change_log.ref_ids])
+            self.assertEqual(expand_change_log(change_log, change_log.ref_ids[-1]),
+                             changes[-1:])
+        response = self.client.get(f'/rest/ChangeLog/{self.project.pk}?entity_id={ids[0]}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(_pairs(response.data[0]['description_of_change']),
+                         _pairs(delete_dicts[ids[0]]))
+
+        # Bulk change logs can be copied, with ref_ids written as an array literal.
+        change_log, = bulk_copy_from_generator(iter([ChangeLog(
+            project=self.project, user=None, description_of_change={'old': [], 'new': []},
+            ref_table=ref_table, ref_ids=ids,
+            ref_changes=[{'old': [], 'new': [{'name': 'x', 'value': None}]} for _ in ids],
+        )]), ChangeLog)
+        change_log = ChangeLog.objects.get(pk=change_log.pk)
+        self.assertEqual(change_log.ref_ids, ids)
+        self.assertIsNone(change_log.user)
+        self.assertEqual(expand_change_log(change_log, ids[0]),
+                         [{'old': [], 'new': [{'name': 'x', 'value': None}]}])
+
+    def test_change_log_paging(self):
+        ChangeLog.objects.filter(project=self.project).delete()
+        ref_table = ContentType.objects.get_for_model(Localization)
+        localizations = list(Localization.objects.filter(pk__in=[entity.pk for entity
+                                                                 in self.entities[:3]]))
+        entity_id = localizations[0].pk
+        bulk, = bulk_log_changes(self.project, self.user, ref_table,
+                                 [localization.pk for localization in localizations],
+                                 [localization.delete_dict for localization in localizations])
+        singles = []
+        for _ in range(4):
+            change_log = ChangeLog.objects.create(project=self.project, user=self.user,
+                                                  description_of_change={'old': [], 'new': []})
+            ChangeToObject.objects.create(ref_table=ref_table, ref_id=entity_id,
+                                          change_id=change_log)
+            singles.append(change_log)
+        early = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        late = datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)
+        for change_log, modified_datetime in zip(singles, [early, early, None, None]):
+            ChangeLog.objects.filter(pk=change_log.pk).update(modified_datetime=modified_datetime)
+        ChangeLog.objects.filter(pk=bulk.pk).update(modified_datetime=late)
+        expected = [singles[0].pk, singles[1].pk, bulk.pk, singles[2].pk, singles[3].pk]
+
+        def _page(query):
+            ids = []
+            after = ''
+            for _ in range(len(expected) + 1):
+                response = self.client.get(f'/rest/ChangeLog/{self.project.pk}?{query}'
+                                           f'&stop=1{after}')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                if not response.data:
+                    return ids
+                ids.append([entry['id'] for entry in response.data])
+                after = f'&after={response.data[-1]["id"]}'
+            self.fail('Paging did not terminate.')
+
+        # Change logs are paged in (modified_datetime, id) order with missing times last,
+        # through ChangeToObject and ref_ids alike.
+        self.assertEqual(_page(f'entity_id={entity_id}'), [[id_] for id_ in expected])
+
+        # Bulk change logs count once towards stop, but are expanded per localization.
+        pages = _page(f'user_id={self.user.pk}')
+        self.assertEqual(pages, [[id_] * (3 if id_ == bulk.pk else 1) for id_ in expected])
+        response = self.client.get(f'/rest/ChangeLog/{self.project.pk}?user_id={self.user.pk}'
+                                   f'&start=1&stop=3')
+        self.assertEqual([entry['id'] for entry in response.data], [singles[1].pk] + [bulk.pk] * 3)
+
+    def test_stream_list(self):
+        endpoint = f'/rest/Localizations/{self.project.pk}?type={self.entity_type.pk}'
+        chunks = functools.partial(iter_chunks, chunk_size=2)
+
+        # Streamed JSON matches the buffered response.
+        response = self.client.get(f'{endpoint}&format=json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        expected = sorted(json.loads(response.content), key=lambda entry: entry['id'])
+        with patch('main.rest.localization.iter_chunks', chunks):
+            response = self.client.get(f'{endpoint}&format=json&stream=1')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.streaming)
+            content = b''.join(response.streaming_content)
+        self.assertEqual(sorted(json.loads(content), key=lambda entry: entry['id']), expected)
+        self.assertEqual(len(expected), len(self.entities))
+
+        # Streamed CSV has a column per attribute type and the same values as the buffered
+        # response.
+        response = self.client.get(f'{endpoint}&format=csv')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        expected = {row['id']: row for row in csv.DictReader(io.StringIO(response.content.decode()))}
+        with patch('main.rest.localization.iter_chunks', chunks):
+            response = self.client.get(f'{endpoint}&format=csv&stream=1')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.streaming)
+            content = b''.join(response.streaming_content).decode()
+        reader = csv.DictReader(io.StringIO(content))
+        rows = list(reader)
+        for attribute_type in self.entity_type.attribute_types:
+            self.assertIn(attribute_type['name'], reader.fieldnames)
+        self.assertNotIn('attributes', reader.fieldnames)
+        self.assertEqual(sorted(row['id'] for row in rows), sorted(expected))
+        for row in rows:
+            self.assertEqual({key: row[key] for key in expected[row['id']]}, expected[row['id']])
+
+        # Empty results are still valid documents.
+        endpoint = f'{endpoint}&frame=1000'
+        response = self.client.get(f'{endpoint}&format=json&stream=1')
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), [])
+        response = self.client.get(f'{endpoint}&format=csv&stream=1')
+        self.assertEqual(len(b''.join(response.streaming_content).decode().splitlines()), 1)
+
+    def test_localization_graphics(self):
+        image_type = MediaType.objects.create(name='images', dtype='image', project=self.project)
+        self.entity_type.media.add(image_type)
+        media = create_test_image_file(self.user, image_type, self.project)
+        ids = [Localization.objects.create(user=self.user, meta=self.entity_type,
+                                           project=self.project,
+                                           version=self.project.version_set.all()[0],
+                                           media=media, frame=0, x=0.25, y=0.25,
+                                           width=0.5, height=0.5).pk
+               for _ in range(2)]
+        endpoint = f'/rest/LocalizationGraphics/{self.project.pk}?image_format=png&force_scale=16x16'
+        response = self.client.post(endpoint, {'ids': ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([graphic['id'] for graphic in response.data], ids)
+        graphics = response.data
+        store = get_tator_store(self.project.bucket)
+        for graphic in graphics:
+            image = Image.open(io.BytesIO(store.get_object(graphic['key'])))
+            self.assertEqual(image.size, (16, 16))
+
+        # Cached crops are not rendered again, and are found without a request per crop.
+        with patch('main.rest.localization_graphic._render_crops') as render_crops, \
+             patch.object(type(store), 'check_key') as check_key:
+            response = self.client.post(endpoint, {'ids': ids}, format='json')
+            render_crops.assert_not_called()
+            check_key.assert_not_called()
+        self.assertEqual([graphic['key'] for graphic in response.data],
+                         [graphic['key'] for graphic in graphics])
+
+        # Moving a localization expires its crops.
+        response = self.client.patch(f'/rest/Localization/{ids[0]}', {'x': 0.1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        invalidate_crops(Localization.objects.get(pk=ids[0])) # Done on commit by the API
+        self.assertFalse(store.check_key(graphics[0]['key']))
+        self.assertTrue(store.check_key(graphics[1]['key']))
+        response = self.client.post(endpoint, {'ids': ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotEqual(response.data[0]['key'], graphics[0]['key'])
+        self.assertTrue(store.check_key(response.data[0]['key']))
+
 class LocalizationLineTestCase(
         APITestCase,
         AttributeTestMixin,
@@ -1562,6 +2028,170 @@ class StateTestCase(
     def tearDown(self):
         self.project.delete()
 
+    def _add_second_media(self):
+        # States are indexed once per media, so this duplicates their documents.
+        for state in self.entities:
+            for media in self.media_entities[:2]:
+                state.media.add(media)
+            state.save()
+        TatorSearch().refresh(self.project.pk)
+
+    def test_es_count_duplicates(self):
+        self._add_second_media()
+        response = self.client.get(
+            f'/rest/StateCount/{self.project.pk}?search=*&type={self.entity_type.pk}'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, len(self.entities))
+
+    def test_es_pagination_duplicates(self):
+        self._add_second_media()
+        endpoint = f'/rest/States/{self.project.pk}?format=json&search=*&type={self.entity_type.pk}'
+        response = self.client.get(f'{endpoint}&start=0&stop=3')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        first = [state['id'] for state in response.data]
+        response = self.client.get(f'{endpoint}&start=3&stop=100')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rest = [state['id'] for state in response.data]
+        self.assertEqual(len(first), 3)
+        self.assertEqual(sorted(first + rest), sorted(state.id for state in self.entities))
+        query = {
+            'query': {'bool': {'filter': [{'term': {'_meta': self.entity_type.pk}}]}},
+            'from': 0,
+            'size': 3,
+        }
+        ids, count = TatorSearch().search(self.project.pk, dict(query), count=True)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(count, len(self.entities))
+
+        # Distinct IDs are only counted on request.
+        with patch.object(TatorSearch, 'count_distinct') as count_distinct:
+            page, count = TatorSearch().search(self.project.pk, dict(query))
+        count_distinct.assert_not_called()
+        self.assertEqual(page, ids)
+        self.assertGreaterEqual(count, len(self.entities))
+
+    def test_build_documents(self):
+        self._add_second_media()
+        state_qs = State.objects.filter(pk__in=[state.pk for state in self.entities])\
+                                .order_by('id')
+
+        def _strip(docs):
+            for doc in docs:
+                doc['_source'].pop('_indexed_datetime')
+            return docs
+
+        expected = []
+        for state in state_qs:
+            expected += TatorSearch().build_document(state)
+        states = list(get_document_queryset('states', state_qs))
+        with self.assertNumQueries(0):
+            docs = build_documents('states', states)
+        self.assertEqual(_strip(docs), _strip(expected))
+
+    def test_index_worker(self):
+        # Index workers get their own storage objects.
+        store = get_tator_store()
+        _init_index_worker()
+        self.assertIsNot(get_tator_store(), store)
+
+    def test_index_ranges(self):
+        ids = sorted(state.pk for state in self.entities)
+        with patch('main.util.INDEX_CHUNK_SIZE', 2):
+            ranges = get_index_ranges(self.project.pk, 'states')
+        self.assertEqual(ranges, [(ids[idx], ids[min(idx + 1, len(ids) - 1)])
+                                  for idx in range(0, len(ids), 2)])
+
+        # Completed ranges are checkpointed so an interrupted reindex can resume.
+        cache = TatorCache()
+        cache.set_reindex_ranges(self.project.pk, 'states', ranges)
+        cache.add_reindex_done(self.project.pk, 'states', ranges[0])
+        self.assertEqual(cache.get_reindex_ranges(self.project.pk, 'states'),
+                         (ranges, {ranges[0]}))
+        cache.clear_reindex_ranges(self.project.pk, 'states')
+        self.assertEqual(cache.get_reindex_ranges(self.project.pk, 'states'), (None, set()))
+
+    def test_index_outbox(self):
+        search = TatorSearch()
+        search.flush_outbox()
+        state = self.entities[0]
+        doc_id = f'state_{state.pk}'
+        index = search.index_name(self.project.pk)
+        search.es.delete(index=index, id=doc_id, routing=1, refresh=True)
+
+        # A failed bulk request puts the batch back in the outbox.
+        state.save()
+        with patch('main.search.bulk', side_effect=Exception):
+            with self.assertRaises(Exception):
+                search.flush_outbox()
+        self.assertFalse(search.es.exists(index=index, id=doc_id, routing=1))
+
+        # Queued documents are indexed by the next flush.
+        self.assertGreaterEqual(search.flush_outbox(), 1)
+        search.refresh(self.project.pk)
+        self.assertTrue(search.es.exists(index=index, id=doc_id, routing=1))
+        self.assertEqual(search.flush_outbox(), 0)
+
+        # Documents rejected by the index are retried on server errors and kept aside otherwise.
+        cache = TatorCache()
+        member = f'main.state:{state.pk}'
+        for status_code, key in [(503, 'index_outbox'), (400, 'index_outbox_failed')]:
+            state.save()
+            error = {'index': {'_id': doc_id, 'status': status_code, 'error': 'test'}}
+            with patch('main.search.bulk', return_value=(0, [error])):
+                self.assertEqual(search.flush_outbox(), 0)
+            self.assertTrue(cache.rds.sismember(f'{search.prefix}{key}', member))
+            search.flush_outbox()
+        self.assertEqual(cache.retry_index_failed(search.prefix), 1)
+        self.assertGreaterEqual(search.flush_outbox(), 1)
+        self.assertFalse(cache.rds.sismember(f'{search.prefix}index_outbox_failed', member))
+
+    def test_copy_create(self):
+        box_type = LocalizationType.objects.create(name='boxes', dtype='box',
+                                                   project=self.project)
+        box_type.media.add(self.media_entities[0].meta)
+        boxes = [create_test_box(self.user, box_type, self.project, self.media_entities[0], frame)
+                 for frame in [3, 4, 6]]
+        string = 'tab\tnewline\nback\\slash "quote"'
+        body = [{
+            'type': self.entity_type.pk,
+            'media_ids': [media.pk for media in self.media_entities[:2]],
+            'localization_ids': [box.pk for box in boxes],
+            'frame': 3,
+            'String Test': string,
+        }, {
+            'type': self.entity_type.pk,
+            'media_ids': [self.media_entities[0].pk],
+        }]
+        response = self.client.post(f'/rest/States/{self.project.pk}', body, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        first, second = [State.objects.get(pk=pk) for pk in response.data['id']]
+        self.assertEqual(first.attributes['String Test'], string)
+        self.assertEqual(first.attributes['Int Test'], 42)
+        self.assertEqual(first.frame, 3)
+        self.assertEqual(first.segments, [[3, 4], [6, 6]])
+        self.assertEqual(first.created_by, self.user)
+        self.assertIsNotNone(first.created_datetime)
+        self.assertEqual(sorted(first.media.values_list('pk', flat=True)),
+                         sorted(media.pk for media in self.media_entities[:2]))
+        self.assertEqual(sorted(first.localizations.values_list('pk', flat=True)),
+                         sorted(box.pk for box in boxes))
+        self.assertEqual(second.attributes['String Test'], 'asdf_default')
+        self.assertIsNone(second.frame)
+        self.assertIsNone(second.segments)
+        self.assertEqual(list(second.media.values_list('pk', flat=True)),
+                         [self.media_entities[0].pk])
+        self.assertEqual(second.localizations.count(), 0)
+
+        # Array fields are copied as array literals.
+        categories = ['tab\tcomma,', 'quote "brace" {}', 'back\\slash', None, 'NULL']
+        algorithm, = bulk_copy_from_generator(iter([Algorithm(
+            name='copy', project=self.project, user=self.user, categories=categories,
+        )]), Algorithm)
+        algorithm = Algorithm.objects.get(pk=algorithm.pk)
+        self.assertEqual(algorithm.categories, categories)
+        self.assertIsNone(algorithm.cluster)
+
 class LeafTestCase(
         APITestCase,
         AttributeTestMixin,
@@ -1787,6 +2417,27 @@ class MembershipTestCase(
     def tearDown(self):
         self.project.delete()
 
+    def test_permission_cache_invalidation(self):
+        endpoint = f'/rest/{self.list_uri}/{self.project.pk}'
+        response = self.client.get(endpoint)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Permission is now cached, removing the membership must revoke it immediately.
+        self.membership.delete()
+        response = self.client.get(endpoint)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.membership = create_test_membership(self.user, self.project)
+        response = self.client.get(endpoint)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Caching another user does not extend the expiration of cached permissions.
+        cache = TatorCache()
+        cache.rds.expire(f'perm_{self.project.pk}', 5)
+        cache.set_permission_cache(self.user.pk + 1, self.project.pk, '')
+        self.assertLessEqual(cache.rds.ttl(f'perm_{self.project.pk}'), 5)
+        cache.rds.delete(f'perm_{self.project.pk}')
+        cache.set_permission_cache(self.user.pk, self.project.pk, '')
+        self.assertGreater(cache.rds.ttl(f'perm_{self.project.pk}'), 5)
+
 class ProjectTestCase(APITestCase):
     def setUp(self):
         self.user = create_test_user()
@@ -1867,6 +2518,15 @@ class ProjectTestCase(APITestCase):
             if expected_status == status.HTTP_200_OK:
                 del self.entities[0]
 
+    def test_permission_cache_project_delete(self):
+        project = self.entities.pop()
+        endpoint = f'/rest/{self.detail_uri}/{project.pk}'
+        response = self.client.get(endpoint)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        project.delete()
+        response = self.client.get(endpoint)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_delete_non_creator(self):
         other_user = User.objects.create(
             username="other",
@@ -2612,6 +3272,53 @@ class ResourceTestCase(APITestCase):
         self.assertFalse(self._store_obj_exists(thumb_key))
         self.assertFalse(self._store_obj_exists(gif_key))
 
+    def test_store_registry(self):
+        # Storage objects are reused until their bucket is invalidated.
+        self.assertIs(get_tator_store(), self.store)
+        invalidate_tator_store()
+        store = get_tator_store()
+        self.assertIsNot(store, self.store)
+        self.assertIs(get_tator_store(), store)
+
+    def test_presigned_url_cache(self):
+        keys = [self._random_store_obj() for _ in range(3)]
+        urls = get_download_urls(keys + keys[:1], 3600, {}, self.store)
+        self.assertEqual(set(urls), set(keys))
+        # Signed urls are cached and returned in the order they were requested.
+        cached = TatorCache().get_presigned_urls(self.store.bucket_name, 3600, keys)
+        self.assertEqual(cached, [urls[key] for key in keys])
+        self.assertEqual(get_download_urls(keys, 3600, {}, self.store), urls)
+
+    def test_object_info(self):
+        media = create_test_video(self.user, f'asdf', self.entity_type, self.project)
+        key = self._random_store_obj()
+        missing_key = f"test/{str(uuid1())}"
+        media.media_files = {'archival': [{'path': key}], 'attachment': [{'path': missing_key}]}
+        media.save()
+        Resource.add_resource(key, media)
+        Resource.add_resource(missing_key, media)
+
+        # Missing objects are recorded with a negative size and only retried on request.
+        self.assertEqual(Resource.objects.get(path=key).size, 18)
+        self.assertEqual(Resource.objects.get(path=missing_key).size, -1)
+        resources = Resource.objects.filter(media=media)
+        self.assertEqual(Resource.backfill_object_info(resources), 0)
+        self.assertEqual(Resource.backfill_object_info(resources, retry_missing=True), 0)
+        Resource.objects.filter(path=key).update(size=None)
+        self.assertEqual(Resource.backfill_object_info(resources), 1)
+        self.assertEqual(Resource.objects.get(path=key).size, 18)
+
+        # Missing objects do not count towards the total size.
+        self.assertEqual(media.get_file_sizes(), (18, 18))
+
+        # Sizes that could not be retrieved are retried in the bucket of the resource.
+        Resource.objects.filter(path=key).update(size=None)
+        with patch.object(Resource, 'update_object_info'), \
+             patch('main.models.get_storage_lookup', wraps=get_storage_lookup) as lookup:
+            self.assertEqual(media.get_file_sizes(), (18, 18))
+        lookup.assert_called_once()
+        self.assertEqual(Resource.objects.get(path=key).size, 18)
+
 class AttributeTestCase(APITestCase):
     def setUp(self):
         self.user = create_test_user()
@@ -2726,6 +3433,34 @@ class AttributeTestCase(APITestCase):
         self.membership.permission = Permission.FULL_CONTROL
         self.membership.save()
 
+    def test_attribute_schema_cache(self):
+        schema = get_attribute_schema(self.project.pk)
+        self.assertEqual(schema['Int Test'][0], 'annotation')
+        self.assertNotIn('added integer', schema)
+
+        # Cached schemas make no queries.
+        with self.assertNumQueries(0):
+            self.assertEqual(get_attribute_schema(self.project.pk), schema)
+
+        # Adding an attribute type invalidates the cached schema.
+        response = self.client.post(
+            f'/rest/{self.list_uri}/{self.entity_type.pk}',
+            self.post_json,
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIsNone(TatorCache().get_attribute_schema(self.project.pk))
+        self.assertEqual(get_attribute_schema(self.project.pk)['added integer'][0], 'annotation')
+
+        # So does saving an entity type.
+        self.entity_type.save()
+        self.assertIsNone(TatorCache().get_attribute_schema(self.project.pk))
+
+        # Deleted entity types are removed from the schema.
+        get_attribute_schema(self.project.pk)
+        self.entity_type.delete()
+        self.assertIsNone(TatorCache().get_attribute_schema(self.project.pk))
+        self.assertNotIn('Int Test', get_attribute_schema(self.project.pk))
+
     def tearDown(self):
         self.project.delete()
 
@@ -183,6 +183,9 @@ urlpatterns += [
     path('rest/GetFrame/<int:id>',
          GetFrameAPI.as_view(),
          ),
+    path('rest/FrameExtraction/<int:id>',
+         FrameExtractionAPI.as_view(),
+         ),
     path('rest/GetClip/<int:id>',
          GetClipAPI.as_view(),
          ),
@@ -264,6 +267,10 @@ urlpatterns += [
          LocalizationGraphicAPI.as_view(),
          name='LocalizationGraphic',
          ),
+    path('rest/LocalizationGraphics/<int:project>',
+         LocalizationGraphicListAPI.as_view(),
+         name='LocalizationGraphics',
+         ),
     path(
         'rest/Medias/<int:project>',
         MediaListAPI.as_view(),
@@ -6,6 +6,8 @@ import json
 import datetime
 import shutil
 import math
+import multiprocessing
+from itertools import islice
 
 from progressbar import progressbar,ProgressBar
 from dateutil.parser import parse
@@ -15,10 +17,12 @@ from PIL import Image
 from main.models import *
 from main.models import Resource
 from main.search import TatorSearch
-from main.store import get_tator_store
+from main.cache import TatorCache
+from main.store import get_tator_store, clear_tator_stores
 
 from django.conf import settings
 from django.db.models import F
+from django.db.models import Prefetch
 
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import streaming_bulk
@@ -104,8 +108,60 @@ def get_num_index_chunks(project_number, section, max_age_days=None):
         count = math.ceil(qs.count() / INDEX_CHUNK_SIZE)
     return count
 
-def buildSearchIndices(project_number, section, mode='index', chunk=None, max_age_days=None):
-    """ Builds search index for a project.
+def get_document_queryset(section, qs):
+    """ Adds the related rows used by `TatorSearch.build_document` to a queryset of the
+        given section.
+    """
+    related = ['meta', 'created_by', 'modified_by']
+    if section == 'media':
+        qs = qs.select_related(*related, 'project__bucket')
+    elif section == 'localizations':
+        qs = qs.select_related(*related, 'user', 'media__meta')
+    elif section == 'states':
+        qs = qs.select_related(*related, 'extracted__meta')\
+               .prefetch_related(Prefetch('media', queryset=Media.objects.select_related('meta')))
+    elif section == 'treeleaves':
+        qs = qs.select_related(*related, 'project').annotate(path_depth=Depth('path'))
+    return qs
+
+def _prefetch_leaf_ancestors(leaves):
+    """ Loads the ancestors of a list of leaves with one query per tree level and caches
+        them on the parent relation, so that `Leaf.computePath` makes no queries.
+    """
+    loaded = {leaf.pk: leaf for leaf in leaves}
+    pending = leaves
+    while pending:
+        parent_ids = {leaf.parent_id for leaf in pending if leaf.parent_id is not None}
+        parent_ids -= loaded.keys()
+        parents = []
+        if parent_ids:
+            parents = list(Leaf.objects.filter(pk__in=parent_ids).select_related('project'))
+            loaded.update({parent.pk: parent for parent in parents})
+        for leaf in pending:
+            if leaf.parent_id in loaded:
+                leaf.parent = loaded[leaf.parent_id]
+        pending = parents
+
+def build_documents(section, entities, mode='index'):
+    """ Returns documents for a chunk of entities loaded with `get_document_queryset`.
+        Related rows that cannot be joined are loaded with set-based queries for the whole
+        chunk, so no queries are made per entity.
+    """
+    resource_sizes = None
+    if section == 'media':
+        resource_sizes = Resource.get_sizes([entity.pk for entity in entities])
+    elif section == 'treeleaves':
+        _prefetch_leaf_ancestors(entities)
+    docs = []
+    for entity in entities:
+        docs += TatorSearch().build_document(entity, mode, resource_sizes)
+    return docs
+
+def buildSearchIndices(project_number, section, mode='index', chunk=None, max_age_days=None,
+                       id_range=None, progress=True):
+    """ Builds search index for a project. Returns the number of documents indexed.
+        id_range is an optional (first, last) tuple of inclusive IDs to index, see
+        `get_index_ranges`. Set progress to False to disable the progress bar.
         section must be one of:
         'index' - create the index for the project if it does not exist
         'mappings' - create mappings for the project if they do not exist
@@ -145,8 +201,14 @@ def buildSearchIndices(project_number, section, mode='index', chunk=None, max_ag
         def __init__(self, qs):
             self._qs = qs
         def __call__(self):
-            for entity in self._qs.iterator():
-                for doc in TatorSearch().build_document(entity, mode):
+            ids = self._qs.values_list('id', flat=True).iterator()
+            while True:
+                batch = list(islice(ids, 500))
+                if not batch:
+                    break
+                entities = get_document_queryset(section,
+                                                  self._qs.model.objects.filter(pk__in=batch))
+                for doc in build_documents(section, list(entities), mode):
                     yield doc
 
     # Get queryset based on selected section.
@@ -158,6 +220,10 @@ def buildSearchIndices(project_number, section, mode='index', chunk=None, max_ag
         min_modified = datetime.datetime.now() - datetime.timedelta(days=max_age_days)
         qs = qs.filter(modified_datetime__gte=min_modified)
 
+    # Apply ID range if given.
+    if id_range is not None:
+        qs = qs.filter(id__gte=id_range[0], id__lte=id_range[1])
+
     # Apply limit/offset if chunk parameter given.
     if chunk is not None:
         offset = INDEX_CHUNK_SIZE * chunk
@@ -165,19 +231,98 @@ def buildSearchIndices(project_number, section, mode='index', chunk=None, max_ag
 
     batch_size = 500
     count = 0
-    bar = ProgressBar(redirect_stderr=True, redirect_stdout=True)
     dc = DeferredCall(qs)
-    total = qs.count()
-    bar.start(max_value=total)
+    if progress:
+        bar = ProgressBar(redirect_stderr=True, redirect_stdout=True)
+        total = qs.count()
+        bar.start(max_value=total)
     for ok, result in streaming_bulk(TatorSearch().es, dc(),chunk_size=batch_size, raise_on_error=False):
         action, result = result.popitem()
         if not ok:
             print(f"Failed to {action} document! {result}")
-        bar.update(min(count, total))
+        if progress:
+            bar.update(min(count, total))
         count += 1
-        if count > total:
+        if progress and count > total:
             print(f"Count exceeds list size by {total - count}")
-    bar.finish()
+    if progress:
+        bar.finish()
+    return count
+
+def get_index_ranges(project_number, section, max_age_days=None):
+    """ Returns a list of inclusive (first, last) ID ranges containing up to INDEX_CHUNK_SIZE
+        entities each. Boundaries are found by seeking from the previous boundary on the primary
+        key, so the cost does not grow with the chunk index like OFFSET does.
+    """
+    qs = CLASS_MAPPING[section].objects.filter(project=project_number, meta__isnull=False)
+    if max_age_days:
+        min_modified = datetime.datetime.now() - datetime.timedelta(days=max_age_days)
+        qs = qs.filter(modified_datetime__gte=min_modified)
+    qs = qs.order_by('id').values_list('id', flat=True)
+    ranges = []
+    first = qs.first()
+    while first is not None:
+        chunk_qs = qs.filter(id__gte=first)
+        last = chunk_qs[INDEX_CHUNK_SIZE-1:INDEX_CHUNK_SIZE].first()
+        if last is None:
+            ranges.append((first, chunk_qs.last()))
+            break
+        ranges.append((first, last))
+        first = qs.filter(id__gt=last).first()
+    return ranges
+
+def _index_range(args):
+    """ Worker function for `parallelBuildSearchIndices`.
+    """
+    project_number, section, id_range = args
+    start = time.time()
+    count = buildSearchIndices(project_number, section, id_range=id_range, progress=False)
+    return id_range, count, time.time() - start, os.getpid()
+
+def _init_index_worker():
+    # Connections must not be shared with the parent process.
+    TatorSearch.setup_elasticsearch()
+    TatorCache.setup_redis()
+    clear_tator_stores()
+
+def parallelBuildSearchIndices(project_number, section, num_workers=4, max_age_days=None,
+                               restart=False):
+    """ Builds documents for a section using a pool of worker processes, one ID range per
+        task (see `get_index_ranges`). Completed ranges are checkpointed in redis, so calling
+        this again after a crash only indexes the remaining ranges. Set restart to True to
+        discard the checkpoint.
+    """
+    from django.db import connections
+    cache = TatorCache()
+    if restart:
+        cache.clear_reindex_ranges(project_number, section)
+
+    # Reuse the ranges of an interrupted run so that checkpoints line up.
+    ranges, done = cache.get_reindex_ranges(project_number, section)
+    if ranges is None:
+        ranges = get_index_ranges(project_number, section, max_age_days)
+        cache.set_reindex_ranges(project_number, section, ranges)
+    remaining = [id_range for id_range in ranges if id_range not in done]
+    logger.info(f"Indexing {len(remaining)} of {len(ranges)} ranges of {section} in project "
+                f"{project_number} with {num_workers} workers...")
+
+    # Forked workers must open their own database connections.
+    connections.close_all()
+    total = 0
+    start = time.time()
+    with multiprocessing.Pool(num_workers, initializer=_init_index_worker) as pool:
+        tasks = [(project_number, section, id_range) for id_range in remaining]
+        for id_range, count, elapsed, pid in pool.imap_unordered(_index_range, tasks):
+            cache.add_reindex_done(project_number, section, id_range)
+            total += count
+            rate = count / elapsed if elapsed > 0 else 0
+            logger.info(f"Worker {pid} indexed {count} documents for IDs {id_range[0]}-"
+                        f"{id_range[1]} in {elapsed:.1f}s ({rate:.1f} docs/s)")
+    elapsed = time.time() - start
+    rate = total / elapsed if elapsed > 0 else 0
+    logger.info(f"Indexed {total} documents in {elapsed:.1f}s ({rate:.1f} docs/s)")
+    cache.clear_reindex_ranges(project_number, section)
+    return total
 
 def makeDefaultVersion(project_number):
     """ Creates a default version for a project and sets all localizations